@@ -10,12 +10,15 @@ from compiler import Compiler
 from compiler import Compiler
 from vm_core import VM
 
-def run_file(path, mode, check_only=False):
+def run_file(path, mode, check_only=False, verbose=False, opt_level=1, dump_ir=(), jit_cache=None, emit=None):
     with open(path, "r") as f:
         source = f.read()
-    run(source, mode, check_only)
+    run(source, mode, check_only, verbose, opt_level, dump_ir, jit_cache, emit)
 
-def run(source, mode, check_only=False):
+def run(source, mode, check_only=False, verbose=False, opt_level=1, dump_ir=(), jit_cache=None, emit=None,
+        session=None):
+    # session: a dict the REPL keeps across lines; in --mode jit it holds the type
+    # checker and the JIT, so later lines can use what earlier ones defined
     # Phase 1: Lexing
     lexer = Lexer(source)
     tokens = lexer.scan_tokens()
@@ -31,21 +34,55 @@ def run(source, mode, check_only=False):
 
     # Phase 2.5: Type Checking
     from type_checker import TypeChecker
-    checker = TypeChecker()
+    checker = session.setdefault("checker", TypeChecker()) if session is not None and mode == "jit" else TypeChecker()
     if not checker.check(statements):
         print("Type checking failed. Aborting.")
         return
 
+    # Ahead-of-time compilation: emit = (kind, path), nothing is run
+    if emit:
+        from jit import ReynaJIT, JITError
+        kind, path = emit
+        try:
+            skipped = ReynaJIT(opt_level).emit(statements, kind, path)
+        except JITError as e:
+            print(f"Native compilation failed: {e}")
+            return
+        for name, reason in skipped.items():
+            print(f"warning: {name} was not compiled ({reason})")
+        if verbose:
+            print(f"emit: wrote {path}")
+        return
+
+    # Phase 2.75: AST optimizations (-O1: loops, -O2: also inlining; -O3 adds SSA in the compiler)
+    if opt_level >= 2:
+        from inliner import Inliner
+        statements = Inliner(verbose).inline(statements)
+    if opt_level >= 1:
+        from loop_optimizer import LoopOptimizer
+        statements = LoopOptimizer(checker.structs, verbose).optimize(statements)
+
     # Phase 3: Compilation
-    compiler = Compiler()
+    compiler = Compiler(use_ssa=opt_level >= 3, registers=mode in ("regvm", "pyvm"), tiered=mode == "tiered",
+                        verbose=verbose)
     chunk = compiler.compile(statements)
     # print("Debug: Compiled chunk")
 
     # Phase 4: Execution
-    if mode == "vm":
+    if mode in ("vm", "regvm", "pyvm", "tiered"):
         # Debug Disassembly
         # chunk.disassemble("Script")
-        vm = VM()
+        if mode == "regvm":
+            from register_vm import RegisterVM
+            vm = RegisterVM(verbose=verbose)
+        elif mode == "pyvm":
+            from register_vm import RegisterVM
+            vm = RegisterVM(promote_after=0, verbose=verbose)
+        elif mode == "tiered":
+            from tiered_vm import TieredVM
+            vm = TieredVM(opt_level=opt_level, verbose=verbose, structs=checker.struct_decls)
+        else:
+            vm = VM()
         try:
             vm.interpret(chunk)
         except Exception:
@@ -55,27 +92,57 @@ def run(source, mode, check_only=False):
             sys.stdout.flush()
     elif mode == "jit":
         from jit import ReynaJIT
-        jit = ReynaJIT()
+        jit = session.get("jit") if session is not None else None
+        if jit is None:
+            jit = ReynaJIT(opt_level, dump_ir, verbose, jit_cache)
+            if session is not None:
+                session["jit"] = jit
         jit.compile_and_run(statements)
 
 def main():
     parser = argparse.ArgumentParser(description="Reyna Programming Language")
     parser.add_argument("file", nargs="?", help="Source file to run")
-    parser.add_argument("--mode", choices=["vm", "jit"], default="vm", help="Execution mode")
+    parser.add_argument("--mode", choices=["vm", "regvm", "pyvm", "tiered", "jit"], default="vm",
+                        help="Execution mode (regvm: functions run on the register VM and move to "
+                             "Python once hot; pyvm: functions are compiled to Python right away; "
+                             "tiered: hot numeric functions are compiled to native code with LLVM)")
     parser.add_argument("--check", action="store_true", help="Type check only")
+    parser.add_argument("--verbose", action="store_true", help="Report what the optimizer did")
+    parser.add_argument("-O", dest="opt_level", type=int, choices=[0, 1, 2, 3], default=1,
+                        help="Optimization level: 0 none, 1 loops, 2 loops and inlining, 3 also SSA "
+                             "(with --mode jit, also the LLVM -O level)")
+    parser.add_argument("--dump-ir", choices=["before", "after"], action="append", default=[],
+                        help="With --mode jit, print the LLVM IR before and/or after optimization")
+    parser.add_argument("--jit-cache", metavar="DIR",
+                        help="Where --mode jit keeps compiled code between runs "
+                             "(default: $REYNA_JIT_CACHE or ~/.cache/reyna/jit)")
+    parser.add_argument("--no-jit-cache", action="store_true", help="Always compile from scratch in --mode jit")
+    parser.add_argument("--emit", choices=["obj", "asm", "so"],
+                        help="Compile the top-level functions ahead of time to an object file, assembly "
+                             "or a shared library that programs can import, instead of running")
+    parser.add_argument("-o", "--output", help="Output file for --emit (default: source name with .o, .s or .so)")
     
     args = parser.parse_args()
     
     if args.file:
-        run_file(args.file, args.mode, args.check)
+        jit_cache = None
+        if args.mode == "jit" and not args.no_jit_cache:
+            from jit_cache import ObjectCache
+            jit_cache = ObjectCache(args.jit_cache)
+        emit = None
+        if args.emit:
+            suffix = {"obj": ".o", "asm": ".s", "so": ".so"}[args.emit]
+            emit = (args.emit, args.output or os.path.splitext(args.file)[0] + suffix)
+        run_file(args.file, args.mode, args.check, args.verbose, args.opt_level, args.dump_ir, jit_cache, emit)
     else:
         # REPL (check ignored)
         print("Reyna v0.2 (Typed)")
+        session = {}
         while True:
             try:
                 line = input("> ")
                 if line == "exit": break
-                run(line, args.mode)
+                run(line, args.mode, opt_level=args.opt_level, session=session)
             except EOFError:
                 break
             except Exception as e:
@@ -0,0 +1,183 @@
+import ast_nodes
+from token_type import TokenType
+
+# Generic AST traversal plus the static analyses the compiler relies on.
+
+def children(node):
+    """Yield the direct child statements/expressions of an AST node."""
+    for value in vars(node).values():
+        yield from _nodes_in(value)
+
+def _nodes_in(value):
+    if isinstance(value, (ast_nodes.Stmt, ast_nodes.Expr)):
+        yield value
+    elif isinstance(value, ast_nodes.MatchCase):
+        yield from children(value)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _nodes_in(item)
+
+def walk(node):
+    """Pre-order traversal of node and everything below it."""
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        yield current
+        stack.extend(reversed(list(children(current))))
+
+def declares(node, name):
+    """Whether anything in node declares `name` with let, fn, class or struct."""
+    return any(isinstance(n, (ast_nodes.LetStmt, ast_nodes.FnDecl, ast_nodes.ClassDecl, ast_nodes.StructDecl))
+               and n.name.lexeme == name for n in walk(node))
+
+def non_escaping_functions(body):
+    """Find local functions declared in `body` that never escape their frame.
+
+    A function qualifies when every reference to its name is the callee of a
+    direct call made either from the enclosing function itself or from the
+    function's own body, it is never reassigned or redeclared, and it defines
+    no closures of its own. Such a function can only run while its defining
+    frame is live, so it may read the enclosing locals straight off the stack
+    instead of going through heap-allocated upvalues.
+
+    Returns the set of qualifying FnDecl nodes.
+    """
+    candidates = {}   # name -> FnDecl
+    declared = {}     # name -> declaration count
+    escaped = set()
+    callees = set()   # id() of Variable nodes used as a direct call target
+
+    def declare(name):
+        declared[name] = declared.get(name, 0) + 1
+
+    def scan(node, owner):
+        # owner: the nested FnDecl we're inside, or None for the enclosing body
+        if isinstance(node, ast_nodes.FnDecl):
+            declare(node.name.lexeme)
+            if owner is None:
+                candidates[node.name.lexeme] = node
+            for p_name, _ in node.params:
+                declare(p_name.lexeme)
+            for child in children(node.body):
+                scan(child, owner or node)
+            return
+        if isinstance(node, ast_nodes.ClassDecl):
+            declare(node.name.lexeme)
+            for method in node.methods:
+                for child in children(method.body):
+                    # Methods may run long after this frame is gone
+                    scan(child, method)
+            return
+        if isinstance(node, ast_nodes.LetStmt):
+            declare(node.name.lexeme)
+        elif isinstance(node, ast_nodes.Assign):
+            escaped.add(node.name.lexeme)
+        elif isinstance(node, ast_nodes.Call) and isinstance(node.callee, ast_nodes.Variable):
+            callees.add(id(node.callee))
+        elif isinstance(node, ast_nodes.Variable):
+            name = node.name.lexeme
+            if id(node) not in callees:
+                escaped.add(name)
+            elif owner is not None and (owner.name.lexeme != name or owner is not candidates.get(name)):
+                # Called from some other closure, which might outlive the frame
+                escaped.add(name)
+        for child in children(node):
+            scan(child, owner)
+
+    for stmt in body:
+        scan(stmt, None)
+
+    result = set()
+    for name, fn in candidates.items():
+        if name in escaped or declared.get(name, 0) != 1:
+            continue
+        if any(isinstance(n, (ast_nodes.FnDecl, ast_nodes.ClassDecl)) for n in walk(fn.body)):
+            continue
+        result.add(fn)
+    return result
+
+def replace_children(node, fn):
+    """Replace every direct child statement/expression of node with fn(child)."""
+    for attr, value in list(vars(node).items()):
+        setattr(node, attr, _replace_in(value, fn))
+
+def _replace_in(value, fn):
+    if isinstance(value, (ast_nodes.Stmt, ast_nodes.Expr)):
+        return fn(value)
+    if isinstance(value, ast_nodes.MatchCase):
+        replace_children(value, fn)
+        return value
+    if isinstance(value, list):
+        return [_replace_in(item, fn) for item in value]
+    if isinstance(value, tuple):
+        return tuple(_replace_in(item, fn) for item in value)
+    return value
+
+def unchecked_indexes(statements):
+    """Find a[i] reads inside `while (i < len(a))` loops that can skip bounds checks.
+
+    i must be a block-local declared with a non-negative int literal whose
+    only assignments in its scope are `i = i + c` with c > 0, so i can never
+    go negative. The upper bound is not trusted: the VM's unchecked read
+    still falls back to the checked path if the array shrank in the loop.
+
+    Returns the set of qualifying Index nodes.
+    """
+    result = set()
+    for block in (n for stmt in statements for n in walk(stmt)):
+        if not isinstance(block, ast_nodes.Block):
+            continue
+        for k, stmt in enumerate(block.statements):
+            if not (isinstance(stmt, ast_nodes.LetStmt) and isinstance(stmt.initializer, ast_nodes.Literal)
+                    and type(stmt.initializer.value) is int and stmt.initializer.value >= 0):
+                continue
+            name = stmt.name.lexeme
+            scope = [n for s in block.statements[k + 1:] for n in walk(s)]
+            if not all(_keeps_non_negative(n, name) for n in scope):
+                continue
+            for loop in scope:
+                if not isinstance(loop, ast_nodes.WhileStmt):
+                    continue
+                array = _length_bound(loop.condition, name)
+                if array is None:
+                    continue
+                for node in walk(loop.body):
+                    if isinstance(node, ast_nodes.Index) and _is_variable(node.index, name) \
+                            and _is_variable(node.target, array):
+                        result.add(node)
+    return result
+
+def _keeps_non_negative(node, name):
+    if isinstance(node, ast_nodes.Assign) and node.name.lexeme == name:
+        value = node.value
+        return isinstance(value, ast_nodes.Binary) and value.operator.type == TokenType.PLUS \
+            and _is_variable(value.left, name) and isinstance(value.right, ast_nodes.Literal) \
+            and type(value.right.value) is int and value.right.value > 0
+    # Any redeclaration could shadow the variable we reason about
+    if isinstance(node, (ast_nodes.LetStmt, ast_nodes.FnDecl, ast_nodes.ClassDecl)) and node.name.lexeme == name:
+        return False
+    if isinstance(node, ast_nodes.FnDecl):
+        return all(p_name.lexeme != name for p_name, _ in node.params)
+    if isinstance(node, ast_nodes.TryStmt):
+        return node.catch_var is None or node.catch_var.lexeme != name
+    if isinstance(node, ast_nodes.MatchExpr):
+        return not any(_is_variable(case.pattern, name) for case in node.cases)
+    return True
+
+def _length_bound(cond, name):
+    """Name of the array a for `name < len(a)` or `len(a) > name`."""
+    if not isinstance(cond, ast_nodes.Binary):
+        return None
+    if cond.operator.type == TokenType.LESS and _is_variable(cond.left, name):
+        call = cond.right
+    elif cond.operator.type == TokenType.GREATER and _is_variable(cond.right, name):
+        call = cond.left
+    else:
+        return None
+    if isinstance(call, ast_nodes.Call) and _is_variable(call.callee, "len") and len(call.arguments) == 1 \
+            and isinstance(call.arguments[0], ast_nodes.Variable):
+        return call.arguments[0].name.lexeme
+    return None
+
+def _is_variable(expr, name):
+    return isinstance(expr, ast_nodes.Variable) and expr.name.lexeme == name
@@ -167,6 +167,11 @@ class ArrayLiteral(Expr):
         self.elements = elements
     def accept(self, visitor): return visitor.visit_array_literal(self)
 
+class MapLiteral(Expr):
+    def __init__(self, entries):
+        self.entries = entries # List of (key_expr, value_expr)
+    def accept(self, visitor): return visitor.visit_map_literal(self)
+
 class IndexGet(Expr):
     def __init__(self, obj, index):
         self.obj = obj
@@ -180,6 +185,13 @@ class Index(Expr):
         self.index = index
     def accept(self, visitor): return visitor.visit_index_get(self)
 
+class Slice(Expr):
+    def __init__(self, target, start, end):
+        self.target = target
+        self.start = start # None = from the beginning
+        self.end = end     # None = to the end
+    def accept(self, visitor): return visitor.visit_slice_expr(self)
+
 class IndexSet(Expr):
     def __init__(self, obj, index, value):
         self.obj = obj
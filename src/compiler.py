@@ -1,20 +1,61 @@
-from reyna_chunk import OpCode, Chunk
+import operator
+from reyna_chunk import OpCode, Chunk, ExceptionTableEntry, JumpTable, RangeLoop
 from token_type import TokenType, Token
 import ast_nodes
 import reyna_vals as object
+from analysis import declares, non_escaping_functions, unchecked_indexes
+import ssa
+
+RANGE_COMPARES = {
+    TokenType.LESS: operator.lt,
+    TokenType.LESS_EQUAL: operator.le,
+    TokenType.GREATER: operator.gt,
+    TokenType.GREATER_EQUAL: operator.ge,
+}
+
+# Node attributes holding the token whose line an instruction is attributed to
+LINE_TOKENS = ("keyword", "operator", "name", "paren")
+
+def is_number_literal(expr):
+    return isinstance(expr, ast_nodes.Literal) and isinstance(expr.value, (int, float)) \
+        and not isinstance(expr.value, bool)
 
 class Compiler:
     # Module cache to prevent re-importing
     _module_cache = {}
     _base_path = "."  # Base path for resolving imports
     
-    def __init__(self, parent=None, function_type="script"):
+    def __init__(self, parent=None, function_type="script", direct_upvalues=False, use_ssa=False,
+                 registers=False, tiered=False, verbose=False):
         self.chunk = None
         self.locals = []
         self.scope_depth = 0
+        # Values the enclosing expressions have on the stack above the locals
+        # (the left operand of a binary while its right one is compiled, ...)
+        self.temps = 0
         self.parent = parent
         self.function_type = function_type
         self.upvalues = [] 
+        # Set for functions that never escape their defining frame: captured
+        # locals are then read straight off the enclosing frame's stack slots.
+        self.direct_upvalues = direct_upvalues
+        self.non_escaping = set() # Nested FnDecls that qualify for the above
+        # Index nodes whose index is proven non-negative (see unchecked_indexes)
+        self.unchecked = parent.unchecked if parent else set()
+        self.line = parent.line if parent else 1
+        # Interned string constants: equal literals in one compilation share one ObjString
+        self.strings = parent.strings if parent else {}
+        # Devirtualized calls: (class, method) -> FnDecl of top-level classes,
+        # and the compile-time ObjClosure each such method is bound to
+        self.class_methods = parent.class_methods if parent else {}
+        self.method_closures = parent.method_closures if parent else {}
+        # -O3: top-level functions go through the SSA middle end (see ssa.py)
+        self.use_ssa = parent.use_ssa if parent else use_ssa
+        # --mode regvm: the same functions become register code instead
+        self.registers = parent.registers if parent else registers
+        # --mode tiered: top-level functions keep their FnDecl for the JIT
+        self.tiered = parent.tiered if parent else tiered
+        self.verbose = parent.verbose if parent else verbose
         
         # Reserve slot 0 (Receiver)
         # For script/function: empty/function name
@@ -24,6 +65,12 @@ class Compiler:
 
     def compile(self, statements):
         self.chunk = Chunk()
+        self.non_escaping = non_escaping_functions(statements)
+        self.unchecked = unchecked_indexes(statements)
+        for stmt in statements:
+            if isinstance(stmt, ast_nodes.ClassDecl):
+                for method in stmt.methods:
+                    self.class_methods[(stmt.name.lexeme, method.name.lexeme)] = method
         for stmt in statements:
             self.compile_statement(stmt)
             # REPL mode might simplify this, but generally top level is a script fn
@@ -31,6 +78,7 @@ class Compiler:
         return self.chunk
 
     def compile_statement(self, stmt):
+        self.mark_line(stmt)
         if isinstance(stmt, ast_nodes.Print):
             self.compile_expression(stmt.expression)
             self.emit_byte(OpCode.OP_PRINT)
@@ -62,7 +110,8 @@ class Compiler:
                 self.compile_statement(s)
             self.end_scope()
         elif isinstance(stmt, ast_nodes.FnDecl):
-            self.compile_function(stmt, "function")
+            direct = self.scope_depth > 0 and stmt in self.non_escaping
+            self.compile_function(stmt, "function", direct)
             # Define name
             if self.scope_depth > 0:
                 self.declare_local(stmt.name)
@@ -71,73 +120,52 @@ class Compiler:
                 name_idx = self.make_constant(stmt.name.lexeme)
                 self.emit_bytes(OpCode.OP_DEFINE_GLOBAL, name_idx)
         elif isinstance(stmt, ast_nodes.IfStmt):
-            self.compile_expression(stmt.condition)
-            
-            self.emit_byte(OpCode.OP_JUMP_IF_FALSE)
-            self.emit_byte(0xff) 
-            self.emit_byte(0xff)
-            jump_if_offset = len(self.chunk.code) - 2
-
-            self.emit_byte(OpCode.OP_POP) # Pop condition
+            # Branch on the condition directly; nothing is left on the stack
+            false_jumps = self.compile_condition(stmt.condition, False)
 
             self.compile_statement(stmt.then_branch)
 
-            self.emit_byte(OpCode.OP_JUMP)
-            self.emit_byte(0xff)
-            self.emit_byte(0xff)
-            else_jump_offset = len(self.chunk.code) - 2
-
-            self.patch_jump(jump_if_offset)
-            self.emit_byte(OpCode.OP_POP) 
-
             if stmt.else_branch:
+                else_jump_offset = self.emit_jump(OpCode.OP_JUMP)
+                self.patch_jumps(false_jumps)
                 self.compile_statement(stmt.else_branch)
+                self.patch_jump(else_jump_offset)
+            else:
+                self.patch_jumps(false_jumps)
             
         elif isinstance(stmt, ast_nodes.StructDecl):
             name_idx = self.make_constant(stmt.name.lexeme)
             self.emit_bytes(OpCode.OP_STRUCT, name_idx)
             self.emit_bytes(OpCode.OP_DEFINE_GLOBAL, name_idx)
 
+        elif isinstance(stmt, ast_nodes.WhileStmt) and self.compile_range_loop(stmt):
+            pass
+
         elif isinstance(stmt, ast_nodes.WhileStmt):
             loop_start = len(self.chunk.code)
-            self.compile_expression(stmt.condition)
-            
-            self.emit_byte(OpCode.OP_JUMP_IF_FALSE)
-            self.emit_byte(0xff)
-            self.emit_byte(0xff)
-            exit_jump = len(self.chunk.code) - 2
+            exit_jumps = self.compile_condition(stmt.condition, False)
             
-            self.emit_byte(OpCode.OP_POP) 
             self.compile_statement(stmt.body)
+            self.emit_loop(loop_start)
             
-            self.emit_byte(OpCode.OP_LOOP)
-            
-            offset = len(self.chunk.code) - loop_start + 2
-            self.emit_byte((offset >> 8) & 0xff)
-            self.emit_byte(offset & 0xff)
-            
-            self.patch_jump(exit_jump)
-            self.emit_byte(OpCode.OP_POP)
+            self.patch_jumps(exit_jumps)
 
         elif isinstance(stmt, ast_nodes.TryStmt):
-            # Emit OP_TRY_BEGIN with offset to catch block
-            self.emit_byte(OpCode.OP_TRY_BEGIN)
-            self.emit_byte(0xff)
-            self.emit_byte(0xff)
-            try_jump = len(self.chunk.code) - 2
-            
-            # Compile try block
+            # Zero-cost try: the block compiles to straight-line code and its
+            # range goes into the chunk's exception table for OP_THROW to find
+            try_start = len(self.chunk.code)
             self.compile_statement(stmt.try_block)
+            try_end = len(self.chunk.code)
             
             # If try succeeds, skip catch block
-            self.emit_byte(OpCode.OP_TRY_END)
             self.emit_byte(OpCode.OP_JUMP)
             self.emit_byte(0xff)
             self.emit_byte(0xff)
             skip_catch = len(self.chunk.code) - 2
             
-            # Patch try_jump to here (start of catch)
-            self.patch_jump(try_jump)
+            # Nested trys finish compiling first, so inner entries precede outer ones
+            self.chunk.exception_table.append(
+                ExceptionTableEntry(try_start, try_end, len(self.chunk.code), len(self.locals)))
             
             # Catch block: exception is on stack
             self.begin_scope()
@@ -157,6 +185,7 @@ class Compiler:
             self.emit_byte(OpCode.OP_THROW)
 
         elif isinstance(stmt, ast_nodes.ClassDecl):
+            top_level = self.scope_depth == 0
             name_idx = self.make_constant(stmt.name.lexeme)
             self.emit_bytes(OpCode.OP_CLASS, name_idx)
             self.emit_bytes(OpCode.OP_DEFINE_GLOBAL, name_idx)
@@ -186,7 +215,7 @@ class Compiler:
                 self.emit_bytes(OpCode.OP_GET_GLOBAL, name_idx)
                 method_name_idx = self.make_constant(method.name.lexeme)
                 type = "initializer" if method.name.lexeme == "init" else "method"
-                self.compile_function(method, type)
+                self.compile_function(method, type, closure=self.method_closure(method) if top_level else None)
                 self.emit_bytes(OpCode.OP_METHOD, method_name_idx)
                 self.emit_byte(OpCode.OP_POP)
             
@@ -208,9 +237,19 @@ class Compiler:
                     self.emit_byte(OpCode.OP_NIL)
                 self.emit_byte(OpCode.OP_RETURN)
 
-    def compile_function(self, stmt, type):
-        func_compiler = Compiler(parent=self, function_type=type)
+    def method_closure(self, method):
+        """The single ObjClosure a top-level class method is bound to, created on first use."""
+        if method not in self.method_closures:
+            self.method_closures[method] = object.ObjClosure(None) # Function filled in by compile_function
+        return self.method_closures[method]
+
+    def compile_function(self, stmt, type, direct_upvalues=False, closure=None):
+        top_level = type == "function" and self.function_type == "script" and self.scope_depth == 0
+        if (self.use_ssa or self.registers) and top_level and self.compile_ssa_function(stmt):
+            return
+        func_compiler = Compiler(parent=self, function_type=type, direct_upvalues=direct_upvalues)
         func_compiler.chunk = Chunk()
+        func_compiler.non_escaping = non_escaping_functions(stmt.body.statements)
         func_compiler.begin_scope()
         
         # Params
@@ -228,18 +267,45 @@ class Compiler:
              func_compiler.emit_byte(OpCode.OP_RETURN)
         
         function_obj = object.ObjFunction(stmt.name.lexeme, len(stmt.params), func_compiler.chunk, len(func_compiler.upvalues))
+        # Capture descriptors live on the function so OP_CLOSURE doesn't
+        # decode them from the bytecode every time a closure is created
+        function_obj.upvalue_descriptors = [(up['is_local'], up['index'], up['direct']) for up in func_compiler.upvalues]
+        if self.tiered and top_level:
+            function_obj.decl = stmt
+        if closure is not None and not function_obj.upvalue_descriptors:
+            # Methods of top-level classes capture nothing: reuse one closure
+            # so devirtualized call sites and the class share the same object
+            closure.function = function_obj
+            self.emit_bytes(OpCode.OP_CONSTANT, self.make_constant(closure))
+            return
         const_idx = self.make_constant(function_obj)
         self.emit_bytes(OpCode.OP_CLOSURE, const_idx)
-        
-        for upvalue in func_compiler.upvalues:
-            is_local = 1 if upvalue['is_local'] else 0
-            self.emit_byte(is_local)
-            self.emit_byte(upvalue['index'])
+
+    def compile_ssa_function(self, stmt):
+        try:
+            if self.registers:
+                from register_vm import compile_function
+                code = compile_function(stmt, self.strings, self.unchecked, self.verbose)
+                chunk = Chunk()
+            else:
+                chunk = ssa.compile_function(stmt, self.strings, self.unchecked, self.verbose)
+        except ssa.Unsupported as e:
+            if self.verbose:
+                print(f"ssa: {stmt.name.lexeme}: kept on the direct path ({e})")
+            return False
+        function_obj = object.ObjFunction(stmt.name.lexeme, len(stmt.params), chunk, 0)
+        function_obj.upvalue_descriptors = []
+        if self.registers:
+            function_obj.registers = code
+        if self.tiered:
+            function_obj.decl = stmt
+        self.emit_bytes(OpCode.OP_CLOSURE, self.make_constant(function_obj))
+        return True
 
     def compile_expression(self, expr):
+        self.mark_line(expr)
         if isinstance(expr, ast_nodes.Binary):
-            self.compile_expression(expr.left)
-            self.compile_expression(expr.right)
+            self.compile_operands([expr.left, expr.right])
             dtype = expr.operator.type
             if dtype == TokenType.PLUS: self.emit_byte(OpCode.OP_ADD)
             elif dtype == TokenType.MINUS: self.emit_byte(OpCode.OP_SUBTRACT)
@@ -248,7 +314,23 @@ class Compiler:
             elif dtype == TokenType.EQUAL_EQUAL: self.emit_byte(OpCode.OP_EQUAL)
             elif dtype == TokenType.GREATER: self.emit_byte(OpCode.OP_GREATER)
             elif dtype == TokenType.LESS: self.emit_byte(OpCode.OP_LESS) 
-            # ... others
+            elif dtype == TokenType.BANG_EQUAL: self.emit_bytes(OpCode.OP_EQUAL, OpCode.OP_NOT)
+            elif dtype == TokenType.GREATER_EQUAL: self.emit_bytes(OpCode.OP_LESS, OpCode.OP_NOT)
+            elif dtype == TokenType.LESS_EQUAL: self.emit_bytes(OpCode.OP_GREATER, OpCode.OP_NOT)
+        elif isinstance(expr, ast_nodes.Unary):
+            self.compile_expression(expr.right)
+            if expr.operator.type == TokenType.BANG: self.emit_byte(OpCode.OP_NOT)
+            elif expr.operator.type == TokenType.MINUS: self.emit_byte(OpCode.OP_NEGATE)
+        elif isinstance(expr, ast_nodes.Logical):
+            # Short-circuit: the left value is the result unless we need the right
+            self.compile_expression(expr.left)
+            if expr.operator.type == TokenType.AND:
+                end_jump = self.emit_jump(OpCode.OP_JUMP_IF_FALSE)
+            else:
+                end_jump = self.emit_jump(OpCode.OP_JUMP_IF_TRUE)
+            self.emit_byte(OpCode.OP_POP)
+            self.compile_expression(expr.right)
+            self.patch_jump(end_jump)
         elif isinstance(expr, ast_nodes.Literal):
             if expr.value is None: self.emit_byte(OpCode.OP_NIL)
             elif expr.value is True: self.emit_byte(OpCode.OP_TRUE)
@@ -256,7 +338,7 @@ class Compiler:
             else:
                 val = expr.value
                 if isinstance(val, str):
-                    val = object.ObjString(val)
+                    val = self.strings.setdefault(val, object.ObjString(val))
                 const = self.make_constant(val)
                 self.emit_bytes(OpCode.OP_CONSTANT, const)
         elif isinstance(expr, ast_nodes.Super):
@@ -279,7 +361,7 @@ class Compiler:
             else:
                 idx = self.resolve_upvalue(expr.keyword)
                 if idx != -1:
-                    self.emit_bytes(OpCode.OP_GET_UPVALUE, idx)
+                    self.emit_get_upvalue(idx)
                 else:
                     print("Error: 'this' not found (are you in a class method?)")
         elif isinstance(expr, ast_nodes.Variable):
@@ -290,7 +372,7 @@ class Compiler:
             else:
                 idx = self.resolve_upvalue(expr.name)
                 if idx != -1:
-                    self.emit_bytes(OpCode.OP_GET_UPVALUE, idx)
+                    self.emit_get_upvalue(idx)
                 else:
                     idx = self.make_constant(expr.name.lexeme)
                     self.emit_bytes(OpCode.OP_GET_GLOBAL, idx)
@@ -304,44 +386,52 @@ class Compiler:
              else:
                  idx = self.resolve_upvalue(expr.name)
                  if idx != -1:
-                     self.emit_bytes(OpCode.OP_SET_UPVALUE, idx)
+                     self.emit_set_upvalue(idx)
                  else:
                      idx = self.make_constant(expr.name.lexeme)
                      self.emit_bytes(OpCode.OP_SET_GLOBAL, idx)
+        elif isinstance(expr, ast_nodes.Call) and getattr(expr, "devirtualized", None) in self.class_methods:
+            # Target fixed by the type checker: no property lookup, no bound method
+            self.compile_operands([expr.callee.obj] + expr.arguments)
+            closure = self.method_closure(self.class_methods[expr.devirtualized])
+            self.emit_bytes(OpCode.OP_INVOKE_DIRECT, self.make_constant(closure))
+            self.emit_byte(len(expr.arguments))
         elif isinstance(expr, ast_nodes.Call):
-            self.compile_expression(expr.callee)
-            arg_count = 0
-            for arg in expr.arguments:
-                self.compile_expression(arg)
-                arg_count += 1
-            self.emit_bytes(OpCode.OP_CALL, arg_count)
+            self.compile_operands([expr.callee] + expr.arguments)
+            self.emit_bytes(OpCode.OP_CALL, len(expr.arguments))
         elif isinstance(expr, ast_nodes.Get):
             self.compile_expression(expr.obj)
             name_idx = self.make_constant(expr.name.lexeme)
             self.emit_bytes(OpCode.OP_GET_FIELD, name_idx)
         elif isinstance(expr, ast_nodes.Set):
-            self.compile_expression(expr.obj)
-            self.compile_expression(expr.value)
+            self.compile_operands([expr.obj, expr.value])
             name_idx = self.make_constant(expr.name.lexeme)
             self.emit_bytes(OpCode.OP_SET_FIELD, name_idx)
 
         elif isinstance(expr, ast_nodes.ArrayLiteral):
-            count = 0
-            for el in expr.elements:
-                self.compile_expression(el)
-                count += 1
+            count = len(expr.elements)
             if count > 255: print("Tool many array elements"); return
+            self.compile_operands(expr.elements)
             self.emit_bytes(OpCode.OP_BUILD_ARRAY, count)
 
+        elif isinstance(expr, ast_nodes.MapLiteral):
+            if len(expr.entries) > 255: print("Too many map entries"); return
+            self.compile_operands([part for entry in expr.entries for part in entry])
+            self.emit_bytes(OpCode.OP_BUILD_MAP, len(expr.entries))
+
         elif isinstance(expr, ast_nodes.Index):
-            self.compile_expression(expr.target)
-            self.compile_expression(expr.index)
-            self.emit_byte(OpCode.OP_GET_INDEX)
+            self.compile_operands([expr.target, expr.index])
+            if expr in self.unchecked:
+                self.emit_byte(OpCode.OP_GET_INDEX_UNCHECKED)
+            else:
+                self.emit_byte(OpCode.OP_GET_INDEX)
+
+        elif isinstance(expr, ast_nodes.Slice):
+            self.compile_operands([expr.target, expr.start, expr.end])
+            self.emit_byte(OpCode.OP_SLICE)
 
         elif isinstance(expr, ast_nodes.IndexSet):
-            self.compile_expression(expr.target)
-            self.compile_expression(expr.index)
-            self.compile_expression(expr.value)
+            self.compile_operands([expr.obj, expr.index, expr.value])
             self.emit_byte(OpCode.OP_SET_INDEX)
 
         elif isinstance(expr, ast_nodes.ArrayLiteral):
@@ -353,82 +443,285 @@ class Compiler:
             self.emit_bytes(OpCode.OP_BUILD_ARRAY, count)
 
         elif isinstance(expr, ast_nodes.MatchExpr):
-            # Compile match as a series of if-else checks
-            # First, compile subject and store as temp
-            self.compile_expression(expr.subject)
-            
-            end_jumps = []  # List of jumps to patch at end
-            
-            for case in expr.cases:
-                # Duplicate subject for comparison
-                self.emit_byte(OpCode.OP_NIL)  # Placeholder for dup
-                # TODO: Add OP_DUP opcode for proper implementation
-                # For now, use a simpler approach: recompile subject
-                self.compile_expression(expr.subject)
-                
-                # Compile pattern as value
-                self.compile_expression(case.pattern)
-                
-                # Compare: subject == pattern
-                self.emit_byte(OpCode.OP_EQUAL)
-                
-                # Optional guard
-                if case.guard:
-                    # If pattern matched, also check guard
-                    self.emit_byte(OpCode.OP_JUMP_IF_FALSE)
-                    self.emit_byte(0xff)
-                    self.emit_byte(0xff)
-                    guard_skip = len(self.chunk.code) - 2
-                    
-                    self.emit_byte(OpCode.OP_POP)  # Pop true from pattern match
-                    self.compile_expression(case.guard)
-                    
-                    # Patch guard skip to here
-                    self.patch_jump(guard_skip)
-                
-                # Jump if false (pattern didn't match)
-                self.emit_byte(OpCode.OP_JUMP_IF_FALSE)
-                self.emit_byte(0xff)
-                self.emit_byte(0xff)
-                next_case = len(self.chunk.code) - 2
-                
-                self.emit_byte(OpCode.OP_POP)  # Pop true
-                self.emit_byte(OpCode.OP_POP)  # Pop placeholder
-                
-                # Compile body
-                if isinstance(case.body, ast_nodes.Block):
-                    self.compile_statement(case.body)
-                    self.emit_byte(OpCode.OP_NIL)  # Block needs to leave a value
-                else:
-                    self.compile_expression(case.body)
-                
-                # Jump to end
-                self.emit_byte(OpCode.OP_JUMP)
-                self.emit_byte(0xff)
-                self.emit_byte(0xff)
-                end_jumps.append(len(self.chunk.code) - 2)
-                
-                # Patch next_case to here
-                self.patch_jump(next_case)
-                self.emit_byte(OpCode.OP_POP)  # Pop false
-            
-            # Pop placeholder at end
-            self.emit_byte(OpCode.OP_POP)
-            
-            # Default: nil
-            self.emit_byte(OpCode.OP_NIL)
-            
-            # Patch all end jumps to here
-            for jump in end_jumps:
-                self.patch_jump(jump)
+            self.compile_match(expr)
 
         elif isinstance(expr, ast_nodes.AwaitExpr):
             # For demo: await just evaluates the expression
             # Real implementation would integrate with event loop
             self.compile_expression(expr.value)
 
+    def compile_match(self, expr):
+        # The subject is evaluated exactly once. It stays on the stack while
+        # the cases test copies of it, and is popped before a body runs.
+        self.compile_expression(expr.subject)
+
+        table = self.match_jump_table(expr)
+        if table is not None:
+            self.compile_match_table(expr, table)
+            return
+
+        end_jumps = []
+        self.temps += 1 # The subject, under the patterns and guards
+        for case in expr.cases:
+            miss_jumps = []
+            binding = None
+            if isinstance(case.pattern, ast_nodes.Variable):
+                if case.pattern.name.lexeme != "_":
+                    binding = case.pattern.name
+            else:
+                self.emit_byte(OpCode.OP_DUP)
+                self.compile_operands([case.pattern])
+                self.emit_byte(OpCode.OP_EQUAL)
+                miss_jumps.append(self.emit_jump(OpCode.OP_JUMP_IF_FALSE))
+                self.emit_byte(OpCode.OP_POP) # Pop true
+
+            if binding:
+                # The name is a local aliasing the subject's stack slot for guard and body
+                self.temps -= 1
+                temps = self.begin_temporary_scope()
+                self.add_local(binding)
+
+            if case.guard:
+                self.compile_expression(case.guard)
+                miss_jumps.append(self.emit_jump(OpCode.OP_JUMP_IF_FALSE))
+                self.emit_byte(OpCode.OP_POP) # Pop true
+
+            if binding:
+                # Overwrite the subject with the result and drop the binding
+                self.compile_match_body(case.body)
+                self.emit_bytes(OpCode.OP_SET_LOCAL, len(self.locals) - 1)
+                self.emit_byte(OpCode.OP_POP)
+                self.end_temporary_scope(temps)
+                self.temps += 1
+            else:
+                self.emit_byte(OpCode.OP_POP) # Pop subject
+                self.temps -= 1
+                self.compile_match_body(case.body)
+                self.temps += 1
+            end_jumps.append(self.emit_jump(OpCode.OP_JUMP))
+
+            if not miss_jumps:
+                break # Irrefutable case; anything after it is unreachable
+            for jump in miss_jumps:
+                self.patch_jump(jump)
+            self.emit_byte(OpCode.OP_POP) # Pop false
+        else:
+            # No case matched: discard the subject, evaluate to nil
+            self.emit_byte(OpCode.OP_POP)
+            self.emit_byte(OpCode.OP_NIL)
+        self.temps -= 1
+
+        for jump in end_jumps:
+            self.patch_jump(jump)
+
+    def match_jump_table(self, expr):
+        """Return the literal case values if the match can dispatch by table.
+
+        That needs every case to be an int or string literal without a
+        guard, optionally followed by a final unguarded `_` default.
+        """
+        cases = expr.cases
+        if cases and isinstance(cases[-1].pattern, ast_nodes.Variable) \
+                and cases[-1].pattern.name.lexeme == "_" and not cases[-1].guard:
+            cases = cases[:-1]
+        if not cases:
+            return None
+        keys = []
+        for case in cases:
+            pattern = case.pattern
+            if case.guard or not isinstance(pattern, ast_nodes.Literal):
+                return None
+            if isinstance(pattern.value, bool) or not isinstance(pattern.value, (int, str)):
+                return None
+            keys.append(pattern.value)
+        return keys
+
+    def compile_match_table(self, expr, keys):
+        table = JumpTable({}, None)
+        self.emit_bytes(OpCode.OP_MATCH_TABLE, self.make_constant(table))
+
+        end_jumps = []
+        for key, case in zip(keys, expr.cases):
+            table.targets.setdefault(key, len(self.chunk.code)) # First case wins
+            self.compile_match_body(case.body)
+            end_jumps.append(self.emit_jump(OpCode.OP_JUMP))
+
+        table.default = len(self.chunk.code)
+        if len(expr.cases) > len(keys):
+            self.compile_match_body(expr.cases[-1].body)
+        else:
+            self.emit_byte(OpCode.OP_NIL)
+
+        for jump in end_jumps:
+            self.patch_jump(jump)
+
+    def compile_match_body(self, body):
+        if isinstance(body, ast_nodes.Block):
+            # Statements address locals by slot, so give the temporaries theirs
+            temps = self.begin_temporary_scope()
+            self.compile_statement(body)
+            self.end_temporary_scope(temps)
+            self.emit_byte(OpCode.OP_NIL)  # Block needs to leave a value
+        else:
+            self.compile_expression(body)
+
+    def compile_operands(self, exprs):
+        """Compile exprs left to right, each staying on the stack under the next.
+
+        A missing (None) operand pushes nil.
+        """
+        for expr in exprs:
+            if expr is None:
+                self.emit_byte(OpCode.OP_NIL)
+            else:
+                self.compile_expression(expr)
+            self.temps += 1
+        self.temps -= len(exprs)
+
+    def begin_temporary_scope(self):
+        """Open a scope whose locals start above the pending temporaries.
+
+        Local slots are indexes into self.locals, which only counts locals.
+        Inside an expression the stack also holds self.temps values, so they
+        become unnamed locals for the scope and the count restarts at zero.
+        Returns what end_temporary_scope needs to undo it.
+        """
+        temps = self.temps
+        self.begin_scope()
+        for _ in range(temps):
+            self.locals.append({'name': None, 'depth': self.scope_depth, 'is_captured': False})
+        self.temps = 0
+        return temps
+
+    def end_temporary_scope(self, temps):
+        # The temporaries still belong to the expressions that pushed them: no pops
+        self.scope_depth -= 1
+        while self.locals and self.locals[-1]['depth'] > self.scope_depth:
+            self.locals.pop()
+        self.temps = temps
+
+    def compile_range_loop(self, stmt):
+        """Compile a counted loop with OP_FOR_RANGE if it has the canonical shape.
+
+        Matches what Parser.for_statement produces for
+        `for (let i = a; i < b; i = i + c)`: a comparison of a local against a
+        number, local or global, and a body Block ending in `i = i +/- <number>`
+        that declares no other i.
+        The bottom of the loop then becomes one instruction that increments,
+        compares and branches. Returns False to fall back to a plain while.
+        """
+        cond = stmt.condition
+        if not (isinstance(cond, ast_nodes.Binary) and cond.operator.type in RANGE_COMPARES
+                and isinstance(cond.left, ast_nodes.Variable)):
+            return False
+        name = cond.left.name
+        slot = self.resolve_local(name)
+        if slot == -1:
+            return False
+
+        body = stmt.body
+        if not (isinstance(body, ast_nodes.Block) and body.statements
+                and isinstance(body.statements[-1], ast_nodes.ExprStmt)):
+            return False
+        if declares(body, name.lexeme):
+            return False # A shadowing `let i` would make the body's i a different variable
+        step = self.induction_step(body.statements[-1].expression, name.lexeme)
+        if step is None:
+            return False
+
+        limit = cond.right
+        if is_number_literal(limit):
+            limit_kind, limit_operand = RangeLoop.LIMIT_CONSTANT, limit.value
+        elif isinstance(limit, ast_nodes.Variable):
+            limit_operand = self.resolve_local(limit.name)
+            limit_kind = RangeLoop.LIMIT_LOCAL
+            if limit_operand == -1:
+                if self.resolve_upvalue(limit.name) != -1:
+                    return False
+                limit_kind, limit_operand = RangeLoop.LIMIT_GLOBAL, limit.name.lexeme
+        else:
+            return False
+
+        # First test on entry, then the body, then OP_FOR_RANGE at the bottom.
+        # The induction variable is re-read from its slot every iteration, so
+        # assignments to it inside the body behave exactly as before.
+        exit_jumps = self.compile_condition(cond, False)
+        body_start = len(self.chunk.code)
+        self.begin_scope()
+        for s in body.statements[:-1]:
+            self.compile_statement(s)
+        self.end_scope()
+        loop = RangeLoop(slot, step, RANGE_COMPARES[cond.operator.type], limit_kind, limit_operand, body_start)
+        self.emit_bytes(OpCode.OP_FOR_RANGE, self.make_constant(loop))
+        self.patch_jumps(exit_jumps)
+        return True
+
+    def induction_step(self, expr, name):
+        """Return c for `name = name + c` / `name = name - c` with a numeric literal c."""
+        if not (isinstance(expr, ast_nodes.Assign) and expr.name.lexeme == name):
+            return None
+        value = expr.value
+        if not (isinstance(value, ast_nodes.Binary) and isinstance(value.left, ast_nodes.Variable)
+                and value.left.name.lexeme == name and is_number_literal(value.right)):
+            return None
+        if value.operator.type == TokenType.PLUS:
+            return value.right.value
+        if value.operator.type == TokenType.MINUS:
+            return -value.right.value
+        return None
+
+    def compile_condition(self, expr, jump_when):
+        """Compile expr as a branch condition that leaves nothing on the stack.
+
+        Emits code that jumps when the condition's truthiness equals
+        jump_when and falls through otherwise. `and`/`or` chains become
+        jumps between operands, so the right side only runs when needed.
+        Returns the jump offsets for the caller to patch.
+        """
+        if isinstance(expr, ast_nodes.Grouping):
+            return self.compile_condition(expr.expression, jump_when)
+        if isinstance(expr, ast_nodes.Unary) and expr.operator.type == TokenType.BANG:
+            return self.compile_condition(expr.right, not jump_when)
+        if isinstance(expr, ast_nodes.Logical):
+            # `and` fails fast on false, `or` succeeds fast on true
+            short_when = expr.operator.type == TokenType.OR
+            if jump_when == short_when:
+                return self.compile_condition(expr.left, jump_when) + self.compile_condition(expr.right, jump_when)
+            skip = self.compile_condition(expr.left, short_when)
+            jumps = self.compile_condition(expr.right, jump_when)
+            self.patch_jumps(skip)
+            return jumps
+
+        self.compile_expression(expr)
+        op = OpCode.OP_POP_JUMP_IF_TRUE if jump_when else OpCode.OP_POP_JUMP_IF_FALSE
+        return [self.emit_jump(op)]
+
+    def emit_loop(self, loop_start):
+        self.emit_byte(OpCode.OP_LOOP)
+        offset = len(self.chunk.code) - loop_start + 2
+        self.emit_byte((offset >> 8) & 0xff)
+        self.emit_byte(offset & 0xff)
+
+    def patch_jumps(self, offsets):
+        for offset in offsets:
+            self.patch_jump(offset)
+
+    def emit_jump(self, op):
+        self.emit_byte(op)
+        self.emit_byte(0xff)
+        self.emit_byte(0xff)
+        return len(self.chunk.code) - 2
+
+    def mark_line(self, node):
+        # Inlined code keeps the tokens, and so the lines, of the function it came from
+        for attr in LINE_TOKENS:
+            token = getattr(node, attr, None)
+            if isinstance(token, Token):
+                self.line = token.line
+                return
+
     def emit_byte(self, byte):
-        self.chunk.write(byte, 1) # TODO: Line numbers
+        self.chunk.write(byte, self.line)
 
     def emit_bytes(self, b1, b2):
         self.emit_byte(b1)
@@ -464,7 +757,7 @@ class Compiler:
         else:
             idx = self.resolve_upvalue(name_token)
             if idx != -1:
-                self.emit_bytes(OpCode.OP_GET_UPVALUE, idx)
+                self.emit_get_upvalue(idx)
             else:
                 print(f"Variable {name_token.lexeme} not found.")
 
@@ -479,23 +772,38 @@ class Compiler:
     
         local = self.parent.resolve_local(name)
         if local != -1:
+            if self.direct_upvalues:
+                # Parent's slot outlives every call to us; no ObjUpvalue needed
+                return self.add_upvalue(local, True, direct=True)
             self.parent.locals[local]['is_captured'] = True
             return self.add_upvalue(local, True)
             
         upvalue = self.parent.resolve_upvalue(name)
         if upvalue != -1:
-            return self.add_upvalue(upvalue, False)
+            return self.add_upvalue(upvalue, False, direct=self.parent.upvalues[upvalue]['direct'])
             
         return -1
         
-    def add_upvalue(self, index, is_local):
+    def add_upvalue(self, index, is_local, direct=False):
          # check if already exists
          for i, up in enumerate(self.upvalues):
              if up['index'] == index and up['is_local'] == is_local:
                  return i
-         self.upvalues.append({'index': index, 'is_local': is_local})
+         self.upvalues.append({'index': index, 'is_local': is_local, 'direct': direct})
          return len(self.upvalues) - 1
 
+    def emit_get_upvalue(self, idx):
+        if self.upvalues[idx]['direct']:
+            self.emit_bytes(OpCode.OP_GET_UPVALUE_DIRECT, idx)
+        else:
+            self.emit_bytes(OpCode.OP_GET_UPVALUE, idx)
+
+    def emit_set_upvalue(self, idx):
+        if self.upvalues[idx]['direct']:
+            self.emit_bytes(OpCode.OP_SET_UPVALUE_DIRECT, idx)
+        else:
+            self.emit_bytes(OpCode.OP_SET_UPVALUE, idx)
+
     def patch_jump(self, offset):
         jump =  len(self.chunk.code) - offset - 2
         
@@ -517,6 +825,19 @@ class Compiler:
         # Mark as imported to prevent circular imports
         Compiler._module_cache[module_path] = True
         
+        from native_lib import is_native_library, load_natives
+        if is_native_library(module_path):
+            try:
+                natives = load_natives(module_path)
+            except (OSError, ValueError) as e:
+                print(f"Error: Could not load native library '{stmt.path}': {e}")
+                return
+            for name, native in natives.items():
+                if stmt.names is None or name in [n.lexeme for n in stmt.names]:
+                    self.emit_bytes(OpCode.OP_CONSTANT, self.make_constant(native))
+                    self.emit_bytes(OpCode.OP_DEFINE_GLOBAL, self.make_constant(name))
+            return
+
         try:
             with open(module_path, 'r') as f:
                 source = f.read()
@@ -0,0 +1,142 @@
+import copy
+import ast_nodes
+from token_type import TokenType
+from analysis import walk, replace_children
+
+# Inlines calls to tiny top-level functions (`fn f(...) -> T { return expr; }`).
+# Runs on the type-checked AST before the loop optimizer, at -O2.
+
+NUMERIC = ("int64", "float64")
+# Nodes that make a function body unsuitable: effects, calls, binders
+IMPURE = (ast_nodes.Call, ast_nodes.Assign, ast_nodes.Set, ast_nodes.IndexSet, ast_nodes.AwaitExpr,
+          ast_nodes.MatchExpr, ast_nodes.This, ast_nodes.Super)
+
+class Inliner:
+    """Substitute small, non-recursive, non-capturing functions at call sites.
+
+    A function qualifies when it is declared once at the top level, is never
+    assigned to or imported over, and its body is a single `return expr;`
+    of at most MAX_NODES nodes without calls or side effects. Because it is
+    top-level and calls nothing it cannot capture variables or recurse.
+
+    A call site is rewritten only after the declaration has been passed, when
+    no local in the enclosing top-level statement shadows the callee or any
+    global it reads, and when every argument is a side-effect free
+    expression that cannot fail. Arguments used more than once must be a
+    literal or a variable so no work is duplicated. The inlined expression
+    keeps the callee's tokens, so its line numbers point into the callee.
+    """
+    MAX_NODES = 24
+
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.inlined = 0
+
+    def inline(self, statements):
+        declared = {}
+        assigned = set()
+        imported = set()
+        import_all = False
+        for stmt in statements:
+            if isinstance(stmt, (ast_nodes.FnDecl, ast_nodes.LetStmt, ast_nodes.ClassDecl, ast_nodes.StructDecl)):
+                declared[stmt.name.lexeme] = declared.get(stmt.name.lexeme, 0) + 1
+            for node in walk(stmt):
+                if isinstance(node, ast_nodes.Assign):
+                    assigned.add(node.name.lexeme)
+                elif isinstance(node, ast_nodes.ImportStmt):
+                    if node.names is None:
+                        import_all = True
+                    else:
+                        imported.update(getattr(n, "lexeme", n) for n in node.names)
+
+        self.available = {} # name -> FnDecl, in declaration order
+        for stmt in statements:
+            self.local_names = local_declarations(stmt)
+            replace_children(stmt, self.rewrite)
+            if isinstance(stmt, ast_nodes.FnDecl) and not import_all and declared[stmt.name.lexeme] == 1 \
+                    and stmt.name.lexeme not in assigned and stmt.name.lexeme not in imported \
+                    and self.inlinable(stmt):
+                self.available[stmt.name.lexeme] = stmt
+        if self.verbose:
+            print(f"inlined {self.inlined} call(s)")
+        return statements
+
+    def inlinable(self, fn):
+        body = fn.body.statements
+        if fn.is_async or len(body) != 1 or not isinstance(body[0], ast_nodes.ReturnStmt) or body[0].value is None:
+            return False
+        nodes = list(walk(body[0].value))
+        return len(nodes) <= self.MAX_NODES and not any(isinstance(n, IMPURE) for n in nodes)
+
+    def rewrite(self, node):
+        # Bottom-up, so arguments are inlined before the call that receives them
+        replace_children(node, self.rewrite)
+        if isinstance(node, ast_nodes.Call):
+            inlined = self.inline_call(node)
+            if inlined is not None:
+                return inlined
+        return node
+
+    def inline_call(self, call):
+        if not isinstance(call.callee, ast_nodes.Variable):
+            return None
+        name = call.callee.name.lexeme
+        fn = self.available.get(name)
+        if fn is None or name in self.local_names or len(call.arguments) != len(fn.params):
+            return None
+        expr = fn.body.statements[0].value
+        params = {p_name.lexeme: arg for (p_name, _), arg in zip(fn.params, call.arguments)}
+        for node in walk(expr):
+            if isinstance(node, ast_nodes.Variable) and node.name.lexeme not in params \
+                    and node.name.lexeme in self.local_names:
+                return None
+        for param, arg in params.items():
+            uses = sum(1 for n in walk(expr) if isinstance(n, ast_nodes.Variable) and n.name.lexeme == param)
+            if not pure(arg):
+                return None
+            if uses > 1 and not isinstance(arg, (ast_nodes.Literal, ast_nodes.Variable)):
+                return None
+
+        def substitute(node):
+            if isinstance(node, ast_nodes.Variable) and node.name.lexeme in params:
+                return copy.deepcopy(params[node.name.lexeme])
+            replace_children(node, substitute)
+            return node
+        result = ast_nodes.Grouping(substitute(copy.deepcopy(expr)))
+        result.static_type = getattr(call, "static_type", None)
+        if self.verbose:
+            print(f"inline: {name} at line {call.paren.line}")
+        self.inlined += 1
+        return result
+
+def pure(expr):
+    """Side-effect free and unable to fail: literals, variables and numeric arithmetic on them."""
+    if isinstance(expr, (ast_nodes.Literal, ast_nodes.Variable)):
+        return True
+    if isinstance(expr, ast_nodes.Grouping):
+        return pure(expr.expression)
+    if isinstance(expr, ast_nodes.Unary):
+        return getattr(expr.right, "static_type", None) in NUMERIC + ("bool",) and pure(expr.right)
+    if isinstance(expr, ast_nodes.Binary):
+        if expr.operator.type == TokenType.SLASH:
+            return False
+        if getattr(expr.left, "static_type", None) not in NUMERIC or \
+                getattr(expr.right, "static_type", None) not in NUMERIC:
+            return False
+        return pure(expr.left) and pure(expr.right)
+    return False
+
+def local_declarations(stmt):
+    """Every name a top-level statement declares below its own top level."""
+    names = set()
+    for node in walk(stmt):
+        if node is not stmt and isinstance(node, (ast_nodes.LetStmt, ast_nodes.FnDecl, ast_nodes.ClassDecl,
+                                                  ast_nodes.StructDecl)):
+            names.add(node.name.lexeme)
+        if isinstance(node, ast_nodes.FnDecl):
+            names.update(p_name.lexeme for p_name, _ in node.params)
+        elif isinstance(node, ast_nodes.TryStmt) and node.catch_var:
+            names.add(node.catch_var.lexeme)
+        elif isinstance(node, ast_nodes.MatchExpr):
+            names.update(c.pattern.name.lexeme for c in node.cases if isinstance(c.pattern, ast_nodes.Variable))
+    return names
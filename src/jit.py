@@ -1,86 +1,539 @@
 import llvmlite.ir as ir
 import llvmlite.binding as llvm
 from ast_nodes import *
+from token_type import TokenType
+from analysis import walk
+from jit_runtime import Runtime, STRING, global_string, load_host_libraries, flush_output, runtime_module
+from stdlib import MATH
+from native_lib import BAD_INDEX, OVERFLOW
 import ctypes
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+class JITError(Exception):
+    pass
+
+INT = ir.IntType(64)
+DOUBLE = ir.DoubleType()
+BOOL = ir.IntType(1)
+TYPES = {"int64": INT, "float64": DOUBLE, "bool": BOOL, "string": STRING}
+ARRAYS = {"int64[]": INT, "float64[]": DOUBLE}
+
+COMPARISONS = {
+    TokenType.LESS: "<", TokenType.LESS_EQUAL: "<=", TokenType.GREATER: ">",
+    TokenType.GREATER_EQUAL: ">=", TokenType.EQUAL_EQUAL: "==", TokenType.BANG_EQUAL: "!=",
+}
+
+def array_type(element):
+    # Arrays travel by value as {data pointer, length}; the data is never copied
+    return ir.LiteralStructType([element.as_pointer(), INT])
+
+def is_array(typ):
+    return isinstance(typ, ir.LiteralStructType)
+
+def is_soa(typ):
+    return isinstance(typ, ir.IdentifiedStructType) and typ.name.startswith("soa.")
+
+def indexes_arrays(nodes):
+    return any(isinstance(node, (Index, IndexGet, IndexSet)) for root in nodes for node in walk(root))
+
+def annotations(node):
+    """Names of the types written in node's own declaration."""
+    if isinstance(node, FnDecl):
+        tokens = [p_type for _, p_type in node.params] + ([node.return_type] if node.return_type else [])
+    elif isinstance(node, StructDecl):
+        tokens = [f_type for _, f_type in node.fields]
+    elif isinstance(node, LetStmt) and node.type_token:
+        tokens = [node.type_token]
+    else:
+        return []
+    return [token.lexeme.removesuffix("[]") for token in tokens]
 
 class CodeGen:
-    def __init__(self):
-        self.module = ir.Module(name="reyna_jit")
+    def __init__(self, embedded=False, linked=False, library=None):
+        # A private context, so struct type names never collide between modules
+        self.module = ir.Module(name="reyna_jit", context=ir.Context())
         self.module.triple = llvm.get_process_triple()
         self.builder = None
         self.func = None
-        self.named_values = {}
-        
-        # Declare printf
-        voidptr_ty = ir.IntType(8).as_pointer()
-        printf_ty = ir.FunctionType(ir.IntType(32), [voidptr_ty], var_arg=True)
-        self.printf = ir.Function(self.module, printf_ty, name="printf")
-        
-        # Declare format string once
-        c_str_val = ir.Constant(ir.ArrayType(ir.IntType(8), 4), bytearray(b"%f\n\0"))
-        self.c_str = ir.GlobalVariable(self.module, c_str_val.type, name="fstr")
-        self.c_str.linkage = 'internal'
-        self.c_str.global_constant = True
-        self.c_str.initializer = c_str_val
-
-    def generate(self, statements):
-        # Wrap top-level statements in a main function
+        self.scopes = []
+        self.globals = {}   # top-level let name -> ir.GlobalVariable
+        self.functions = {} # fn name -> ir.Function
+        self.structs = {}   # struct name -> (StructDecl, ir.IdentifiedStructType)
+        self.layouts = {}   # struct or SoA type name -> field names in order
+        # Where `S()` calls put their instance, see plan_instances; the rest go on the heap
+        self.stack_sites = set()
+        self.static_sites = set()
+        # Set when array indexing is compiled; calls then check reyna_fault on return
+        self.may_fault = False
+        self.fault_state = None
+        # Embedded code is called from the VM: no globals, no memory it cannot
+        # free, and only operations whose results match the VM's exactly
+        self.embedded = embedded
+        # C library functions and print/string helpers, see jit_runtime.py. A linked
+        # module is loaded into ReynaJIT next to the runtime library, and one that
+        # becomes a library itself exports its functions and globals from it
+        self.runtime = Runtime(self.module, shared=linked)
+        self.library = library
+        # Set when print is compiled; the VM must then flush its own output first
+        self.prints = False
+        # Set when array elements are stored, which the VM sees like output
+        self.stores = False
+        # Set when embedded int64 arithmetic checks for overflow, see int_arithmetic
+        self.overflows = False
+
+    def generate(self, statements, known=None):
+        """Compile a program, wrapping its top-level statements in `main`. known maps the
+        names an earlier module in the same JIT library chain defined to (FnDecl, StructDecl
+        or LetStmt, library name); statements use those as if they were their own."""
+        defined = {stmt.name.lexeme for stmt in statements if isinstance(stmt, (FnDecl, StructDecl, LetStmt))}
+        known = {name: found for name, found in (known or {}).items() if name not in defined}
+        earlier = [node for node, _ in known.values() if isinstance(node, FnDecl)]
+        self.may_fault = indexes_arrays(statements + earlier)
+        # Declare every struct, function and global first so uses may come before definitions
+        for stmt in [node for node, _ in known.values()] + statements:
+            if isinstance(stmt, StructDecl):
+                self.declare_struct(stmt)
+        decls = [stmt for stmt in statements if isinstance(stmt, FnDecl)]
+        self.plan_instances(decls + earlier, [stmt for stmt in statements if not isinstance(stmt, FnDecl)])
+        for name, (node, library) in known.items():
+            if isinstance(node, FnDecl):
+                self.declare_function(node, library)
+            elif isinstance(node, LetStmt):
+                self.globals[name] = ir.GlobalVariable(self.module, self.let_type(node), name=f"{library}.{name}")
+        for stmt in statements:
+            if isinstance(stmt, FnDecl):
+                self.declare_function(stmt)
+            elif isinstance(stmt, LetStmt):
+                typ = self.let_type(stmt)
+                name = stmt.name.lexeme
+                var = ir.GlobalVariable(self.module, typ, name=f"{self.library}.{name}" if self.library else name)
+                var.initializer = ir.Constant(typ, None)
+                self.globals[name] = var
+        for stmt in statements:
+            if isinstance(stmt, FnDecl):
+                self.visit(stmt)
+
+        # Wrap the remaining top-level statements in a main function
         func_type = ir.FunctionType(ir.VoidType(), [])
         self.func = ir.Function(self.module, func_type, name="main")
         block = self.func.append_basic_block(name="entry")
         self.builder = ir.IRBuilder(block)
-        
+
         for stmt in statements:
-            self.visit(stmt)
-            
+            if self.builder.block.is_terminated:
+                break
+            if isinstance(stmt, LetStmt):
+                if stmt.initializer:
+                    self.store(self.globals[stmt.name.lexeme], self.visit(stmt.initializer))
+            elif not isinstance(stmt, (FnDecl, StructDecl)):
+                self.visit(stmt)
+
         if not self.builder.block.is_terminated:
              self.builder.ret_void()
         return self.module
 
+    def generate_function(self, decl, resolve):
+        """Compile decl and every top-level function it calls, plus a C-compatible
+        `reyna_entry` wrapper for ctypes. resolve(name) returns the FnDecl or StructDecl
+        a name used in the code refers to, or None. Returns the names of all compiled functions."""
+        decls, structs = self.with_callees(decl, resolve)
+        self.compile_functions(decls.values(), structs.values())
+        if self.overflows and (self.prints or self.stores):
+            raise JITError("int64 arithmetic may overflow after output or array stores the VM cannot redo")
+        self.entry_point(self.functions[decl.name.lexeme], "reyna_entry")
+        return list(decls)
+
+    def generate_library(self, statements):
+        """Compile every top-level function the JIT supports, each exported under its
+        own name with a C ABI, plus a `reyna_signatures` string listing them one per
+        line as `name(type,...)->type`. Returns {name: reason} for the functions left
+        out. A function native code cannot compile also takes down everything that calls
+        it; one that merely cannot be called from the VM is still compiled for its callers."""
+        decls = {stmt.name.lexeme: stmt for stmt in statements if isinstance(stmt, FnDecl)}
+        structs = {stmt.name.lexeme: stmt for stmt in statements if isinstance(stmt, StructDecl)}
+        resolve = lambda name: decls.get(name) or structs.get(name)
+        skipped = {}
+        changed = True
+        while changed:
+            changed = False
+            for name, decl in list(decls.items()):
+                try:
+                    probe = CodeGen(embedded=True)
+                    needed, used_structs = probe.with_callees(decl, resolve)
+                    probe.compile_functions(needed.values(), used_structs.values())
+                except JITError as e:
+                    skipped[name] = str(e)
+                    del decls[name]
+                    changed = True
+        self.compile_functions(decls.values(), structs.values())
+        signatures = []
+        for name, stmt in decls.items():
+            try:
+                self.entry_point(self.functions[name], name)
+            except JITError as e:
+                skipped[name] = str(e)
+                continue
+            params = ",".join(p_type.lexeme for _, p_type in stmt.params)
+            signatures.append(f"{name}({params})->{stmt.return_type.lexeme if stmt.return_type else 'void'}")
+        global_string(self.module, "reyna_signatures", "\n".join(signatures), linkage='')
+        return skipped
+
+    def with_callees(self, decl, resolve):
+        """decl plus every top-level function it calls and struct it uses, transitively,
+        as ({name: FnDecl}, {name: StructDecl})."""
+        decls = {decl.name.lexeme: decl}
+        structs = {}
+        pending = [decl]
+        while pending:
+            for node in walk(pending.pop()):
+                called = isinstance(node, Call) and isinstance(node.callee, Variable)
+                for name in ([node.callee.name.lexeme] if called else []) + annotations(node):
+                    if name in decls or name in structs or name in TYPES:
+                        continue
+                    found = resolve(name)
+                    if isinstance(found, FnDecl):
+                        decls[name] = found
+                    elif isinstance(found, StructDecl):
+                        structs[name] = found
+                    elif (name == "len" or name in MATH) and called:
+                        continue # Builtin, see visit_call_expr
+                    else:
+                        raise JITError(f"'{name}' is not a top-level function or struct")
+                    pending.append(found)
+        return decls, structs
+
+    def compile_functions(self, decls, structs):
+        for stmt in structs:
+            self.declare_struct(stmt)
+        # Embedded callees may also stop on an overflow
+        self.may_fault = self.embedded or indexes_arrays(decls)
+        self.plan_instances(decls)
+        for stmt in decls:
+            self.declare_function(stmt)
+        for stmt in decls:
+            self.visit(stmt)
+
+    def entry_point(self, func, name):
+        # bool crosses the C boundary as a byte; i1 has no C equivalent, and an
+        # array becomes two arguments, its data pointer and its length
+        abi = lambda typ: ir.IntType(8) if typ == BOOL else typ
+        ret = func.function_type.return_type
+        if is_array(ret):
+            raise JITError("arrays cannot be returned from native code to the VM")
+        types = [ret] + [arg.type for arg in func.args]
+        if STRING in types:
+            raise JITError("strings cannot be passed between the VM and native code")
+        if any(isinstance(typ, ir.PointerType) or is_soa(typ) for typ in types):
+            raise JITError("structs and struct arrays cannot be passed between the VM and native code")
+        params = []
+        for arg in func.args:
+            params += arg.type.elements if is_array(arg.type) else [abi(arg.type)]
+        entry = ir.Function(self.module, ir.FunctionType(abi(ret), params), name=name)
+        self.builder = ir.IRBuilder(entry.append_basic_block(name="entry"))
+        incoming = iter(entry.args)
+        args = []
+        for param in func.args:
+            if is_array(param.type):
+                array = self.builder.insert_value(ir.Constant(param.type, ir.Undefined), next(incoming), 0)
+                args.append(self.builder.insert_value(array, next(incoming), 1))
+            elif param.type == BOOL:
+                args.append(self.builder.trunc(next(incoming), BOOL))
+            else:
+                args.append(next(incoming))
+        result = self.builder.call(func, args)
+        if self.prints:
+            # Hand the VM a flushed stdout, as it does before calling in
+            self.builder.call(self.runtime.function("fflush"), [ir.Constant(STRING, None)])
+        if ret == ir.VoidType():
+            self.builder.ret_void()
+        else:
+            self.builder.ret(self.builder.zext(result, abi(ret)) if ret == BOOL else result)
+
     def visit(self, node):
         return node.accept(self)
 
+    def unsupported(self, node):
+        raise JITError(f"{type(node).__name__} is not supported by the JIT")
+
+    def llvm_type(self, type_name, what):
+        if type_name in ARRAYS:
+            return array_type(ARRAYS[type_name])
+        if type_name in self.structs:
+            return self.structs[type_name][1].as_pointer() # Instances are shared by reference
+        if type_name and type_name.endswith("[]") and type_name[:-2] in self.structs:
+            return self.soa_type(type_name[:-2])
+        if type_name not in TYPES:
+            raise JITError(f"{what} has type {type_name}, the JIT only supports int64, float64, bool, "
+                           f"string, structs and arrays of numbers or structs")
+        return TYPES[type_name]
+
+    def let_type(self, stmt):
+        if stmt.type_token:
+            return self.llvm_type(stmt.type_token.lexeme, f"'{stmt.name.lexeme}'")
+        return self.llvm_type(getattr(stmt.initializer, "static_type", None), f"'{stmt.name.lexeme}'")
+
+    def coerce(self, value, typ):
+        if value.type == typ:
+            return value
+        if typ == DOUBLE and value.type == INT:
+            return self.builder.sitofp(value, typ)
+        raise JITError(f"cannot convert {value.type} to {typ}")
+
+    def store(self, ptr, value):
+        self.builder.store(self.coerce(value, ptr.type.pointee), ptr)
+
+    def lookup(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        if name in self.globals:
+            return self.globals[name]
+        if self.embedded:
+            raise JITError(f"global '{name}' is not available to native code")
+        raise JITError(f"undefined variable '{name}'")
+
+    def condition(self, expr):
+        value = self.visit(expr)
+        if value.type == DOUBLE:
+            return self.builder.fcmp_ordered('!=', value, ir.Constant(DOUBLE, 0.0))
+        if value.type == INT:
+            return self.builder.icmp_signed('!=', value, ir.Constant(INT, 0))
+        if value.type == STRING:
+            return ir.Constant(BOOL, 1) # Like every object, even the empty string
+        return value
+
+    # Functions
+
+    def declare_function(self, stmt, library=None):
+        # library: the JIT library an earlier module defined stmt in, see generate
+        name = stmt.name.lexeme
+        params = [self.llvm_type(p_type.lexeme, f"parameter '{p_name.lexeme}' of {name}")
+                  for p_name, p_type in stmt.params]
+        ret = self.llvm_type(stmt.return_type.lexeme, f"return value of {name}") if stmt.return_type else ir.VoidType()
+        library = library or self.library
+        if library:
+            func = ir.Function(self.module, ir.FunctionType(ret, params), name=f"{library}.{name}")
+        else:
+            # Prefixed so Reyna names never clash with main, printf or exported wrappers
+            func = ir.Function(self.module, ir.FunctionType(ret, params), name=f"reyna.{name}")
+            func.linkage = 'internal'
+        self.functions[name] = func
+
+    def visit_fn_decl(self, stmt):
+        if self.func is not None:
+            raise JITError(f"nested function '{stmt.name.lexeme}' is not supported by the JIT")
+        self.func = self.functions[stmt.name.lexeme]
+        self.builder = ir.IRBuilder(self.func.append_basic_block(name="entry"))
+        self.scopes.append({})
+        for (p_name, _), arg in zip(stmt.params, self.func.args):
+            arg.name = p_name.lexeme
+            ptr = self.builder.alloca(arg.type, name=p_name.lexeme)
+            self.builder.store(arg, ptr)
+            self.scopes[-1][p_name.lexeme] = ptr
+        self.visit(stmt.body)
+        if not self.builder.block.is_terminated:
+            ret = self.func.function_type.return_type
+            if ret == ir.VoidType():
+                self.builder.ret_void()
+            else:
+                self.builder.ret(ir.Constant(ret, None))
+        self.scopes.pop()
+        self.func = None
+
+    def visit_return_stmt(self, stmt):
+        ret = self.func.function_type.return_type
+        if stmt.value is None:
+            if ret != ir.VoidType():
+                raise JITError("missing return value")
+            self.builder.ret_void()
+        elif ret == ir.VoidType():
+            raise JITError("return with a value from main or a void function")
+        else:
+            self.builder.ret(self.coerce(self.visit(stmt.value), ret))
+
+    def visit_call_expr(self, expr):
+        if isinstance(expr.callee, Variable) and expr.callee.name.lexeme == "len" and "len" not in self.functions \
+                and len(expr.arguments) == 1:
+            array = self.visit(expr.arguments[0])
+            if not is_array(array.type) and not is_soa(array.type):
+                raise JITError("len() is only supported on arrays by the JIT")
+            return self.array_length(array)
+        if self.is_constructor(expr):
+            return self.construct(expr)
+        if isinstance(expr.callee, Variable) and expr.callee.name.lexeme in MATH \
+                and expr.callee.name.lexeme not in self.functions:
+            name = expr.callee.name.lexeme
+            if len(expr.arguments) != MATH[name]:
+                raise JITError(f"{name} expects {MATH[name]} arguments, got {len(expr.arguments)}")
+            args = [self.coerce(self.visit(arg), DOUBLE) for arg in expr.arguments]
+            return self.builder.call(self.runtime.intrinsic(name), args, name)
+        if not isinstance(expr.callee, Variable) or expr.callee.name.lexeme not in self.functions:
+            raise JITError("only calls to top-level functions are supported by the JIT")
+        func = self.functions[expr.callee.name.lexeme]
+        if len(expr.arguments) != len(func.args):
+            raise JITError(f"{expr.callee.name.lexeme} expects {len(func.args)} arguments, got {len(expr.arguments)}")
+        args = [self.coerce(self.visit(arg), param.type) for arg, param in zip(expr.arguments, func.args)]
+        result = self.builder.call(func, args)
+        if self.may_fault:
+            # The callee hit a bad index: unwind without running anything else
+            failed = self.builder.icmp_unsigned('!=', self.builder.load(self.fault_slot(0)), ir.Constant(INT, 0))
+            self.unwind_if(failed)
+        return result
+
+    # Arrays
+
+    def fault_slot(self, i):
+        """Pointer to word i of `reyna_fault` = {faulted, bad index, array length}, which the
+        VM reads after calling native code."""
+        if self.fault_state is None:
+            self.fault_state = self.runtime.fault_state()
+        return self.builder.gep(self.fault_state, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), i)])
+
+    def unwind_if(self, cond):
+        fail_bb = self.func.append_basic_block(name="fault")
+        ok_bb = self.func.append_basic_block(name="ok")
+        self.builder.cbranch(cond, fail_bb, ok_bb).set_weights([1, 1000])
+        self.builder.position_at_start(fail_bb)
+        self.unwind()
+        self.builder.position_at_start(ok_bb)
+
+    def unwind(self):
+        # Leave the current function right away with a dummy value
+        ret = self.func.function_type.return_type
+        if ret == ir.VoidType():
+            self.builder.ret_void()
+        else:
+            self.builder.ret(ir.Constant(ret, None))
+
+    def element_pointer(self, target, index_expr):
+        array = self.visit(target)
+        if is_soa(array.type):
+            raise JITError("elements of struct arrays can only be used as a[i].field in the JIT")
+        if not is_array(array.type):
+            raise JITError("only arrays can be indexed by the JIT")
+        index = self.checked_index(array, index_expr)
+        return self.builder.gep(self.builder.extract_value(array, 0, "data"), [index], inbounds=True)
+
+    def array_length(self, array):
+        return self.builder.extract_value(array, 0 if is_soa(array.type) else 1, "len")
+
+    def checked_index(self, array, index_expr):
+        index = self.visit(index_expr)
+        if index.type != INT:
+            raise JITError("array indexes must be int64 in the JIT")
+        length = self.array_length(array)
+        # One unsigned compare also rejects negative indexes, like the VM does
+        bad = self.builder.icmp_unsigned('>=', index, length, "outofbounds")
+        fail_bb = self.func.append_basic_block(name="badindex")
+        ok_bb = self.func.append_basic_block(name="inbounds")
+        self.builder.cbranch(bad, fail_bb, ok_bb).set_weights([1, 1000])
+        self.builder.position_at_start(fail_bb)
+        for i, value in enumerate((ir.Constant(INT, BAD_INDEX), index, length)):
+            self.builder.store(value, self.fault_slot(i))
+        if not self.embedded:
+            message = self.runtime.string("Index %lld out of bounds for array of length %lld.\n")
+            self.builder.call(self.runtime.function("printf"), [message, index, length])
+        self.unwind()
+        self.builder.position_at_start(ok_bb)
+        return index
+
+    def visit_index_get(self, expr):
+        target = getattr(expr, 'target', None) or getattr(expr, 'obj', None)
+        return self.builder.load(self.element_pointer(target, expr.index), "element")
+
+    def visit_index_set(self, expr):
+        self.stores = True
+        ptr = self.element_pointer(expr.obj, expr.index)
+        value = self.coerce(self.visit(expr.value), ptr.type.pointee)
+        self.builder.store(value, ptr)
+        return value
+
+    def visit_array_literal(self, expr):
+        type_name = getattr(expr, "static_type", None)
+        if type_name not in ARRAYS and not (type_name and type_name[:-2] in self.structs):
+            raise JITError("array literals need a declared array type in the JIT")
+        if self.embedded:
+            raise JITError("arrays created in native code cannot be handed to the VM")
+        if type_name not in ARRAYS:
+            return self.struct_array_literal(expr, self.llvm_type(type_name, "array literal"))
+        element = ARRAYS[type_name]
+        # Heap storage that lives for the rest of the run, since arrays may outlive the frame
+        size = ir.Constant(INT, max(len(expr.elements), 1) * 8)
+        data = self.builder.bitcast(self.builder.call(self.runtime.function("malloc"), [size]), element.as_pointer())
+        for i, el in enumerate(expr.elements):
+            ptr = self.builder.gep(data, [ir.Constant(INT, i)], inbounds=True)
+            self.builder.store(self.coerce(self.visit(el), element), ptr)
+        array = self.builder.insert_value(ir.Constant(array_type(element), ir.Undefined), data, 0)
+        return self.builder.insert_value(array, ir.Constant(INT, len(expr.elements)), 1)
+
+    def struct_array_literal(self, expr, typ):
+        # Columns copy values rather than share instances, so only fresh S() elements
+        # keep the VM's meaning; they are all zero, so each column is one zeroed block
+        if not all(self.is_constructor(el) and not el.arguments for el in expr.elements):
+            raise JITError("struct array literals must be written as [S(), S(), ...] in the JIT")
+        count = ir.Constant(INT, max(len(expr.elements), 1))
+        array = self.builder.insert_value(ir.Constant(typ, ir.Undefined), ir.Constant(INT, len(expr.elements)), 0)
+        for i, column in enumerate(typ.elements[1:]):
+            data = self.builder.call(self.runtime.function("calloc"), [count, ir.Constant(INT, 8)])
+            array = self.builder.insert_value(array, self.builder.bitcast(data, column), i + 1)
+        return array
+
+    # Statements
+
     def visit_expression_stmt(self, stmt):
         self.visit(stmt.expression)
 
     def visit_print_stmt(self, stmt):
-        value = self.visit(stmt.expression)
-        fmt_arg = self.builder.bitcast(self.c_str, ir.IntType(8).as_pointer())
-        self.builder.call(self.printf, [fmt_arg, value])
+        # A concatenation is printed piece by piece, so it never builds a string
+        self.prints = True
+        for piece in self.string_pieces(stmt.expression):
+            value = self.visit(piece)
+            if value.type not in (INT, DOUBLE, BOOL, STRING):
+                raise JITError("print only supports int64, float64, bool and string in the JIT")
+            self.runtime.write(self.builder, value)
+        self.runtime.newline(self.builder)
+
+    def string_pieces(self, expr):
+        if getattr(expr, "static_type", None) == "string":
+            if isinstance(expr, Grouping):
+                return self.string_pieces(expr.expression)
+            if isinstance(expr, Binary) and expr.operator.type == TokenType.PLUS:
+                return self.string_pieces(expr.left) + self.string_pieces(expr.right)
+        return [expr]
 
     def visit_block_stmt(self, stmt):
+        self.scopes.append({})
         for s in stmt.statements:
+            if self.builder.block.is_terminated:
+                break # Unreachable code after a return
             self.visit(s)
+        self.scopes.pop()
 
     def visit_if_stmt(self, stmt):
         # Create blocks
         then_bb = self.func.append_basic_block(name="then")
         else_bb = self.func.append_basic_block(name="else")
         merge_bb = self.func.append_basic_block(name="ifcont")
-        
-        # Condition
-        cond_val = self.visit(stmt.condition)
-        # Convert to bool (i1) if needed (assuming int/double 0 is false)
-        if cond_val.type == ir.DoubleType():
-            cond_val = self.builder.fcmp_ordered('!=', cond_val, ir.Constant(ir.DoubleType(), 0.0), 'ifcond')
-        elif cond_val.type == ir.IntType(64):
-            cond_val = self.builder.icmp_signed('!=', cond_val, ir.Constant(ir.IntType(64), 0), 'ifcond')
-            
-        self.builder.cbranch(cond_val, then_bb, else_bb)
-        
+
+        self.builder.cbranch(self.condition(stmt.condition), then_bb, else_bb)
+
         # Then
         self.builder.position_at_start(then_bb)
         self.visit(stmt.then_branch)
         if not self.builder.block.is_terminated:
              self.builder.branch(merge_bb)
-        
+
         # Else
         self.builder.position_at_start(else_bb)
         if stmt.else_branch:
             self.visit(stmt.else_branch)
         if not self.builder.block.is_terminated:
              self.builder.branch(merge_bb)
-             
+
         # Merge
         self.builder.position_at_start(merge_bb)
 
@@ -88,160 +541,482 @@ class CodeGen:
         cond_bb = self.func.append_basic_block(name="loopcond")
         body_bb = self.func.append_basic_block(name="loopbody")
         after_bb = self.func.append_basic_block(name="loopend")
-        
+
         # Jump to condition
         self.builder.branch(cond_bb)
-        
+
         # Condition
         self.builder.position_at_start(cond_bb)
-        cond_val = self.visit(stmt.condition)
-         # Convert to bool
-        if cond_val.type == ir.DoubleType():
-            cond_val = self.builder.fcmp_ordered('!=', cond_val, ir.Constant(ir.DoubleType(), 0.0), 'loopcond')
-        elif cond_val.type == ir.IntType(64):
-            cond_val = self.builder.icmp_signed('!=', cond_val, ir.Constant(ir.IntType(64), 0), 'loopcond')
-            
-        self.builder.cbranch(cond_val, body_bb, after_bb)
-        
+        self.builder.cbranch(self.condition(stmt.condition), body_bb, after_bb)
+
         # Body
         self.builder.position_at_start(body_bb)
         self.visit(stmt.body)
-        self.builder.branch(cond_bb)
-        
+        if not self.builder.block.is_terminated:
+            self.builder.branch(cond_bb)
+
         # After
         self.builder.position_at_start(after_bb)
 
     def visit_let_stmt(self, stmt):
-        # Determine type
-        typ = ir.DoubleType()
-        if stmt.type_token:
-            if stmt.type_token.lexeme == "int64": typ = ir.IntType(64)
-            elif stmt.type_token.lexeme == "float64": typ = ir.DoubleType()
-            elif stmt.type_token.lexeme == "bool": typ = ir.IntType(1)
-        
-        ptr = self.builder.alloca(typ, name=stmt.name.lexeme)
-        self.named_values[stmt.name.lexeme] = ptr
-        
+        typ = self.let_type(stmt)
+        # Allocas go in the entry block so mem2reg can promote them
+        with self.builder.goto_entry_block():
+            ptr = self.builder.alloca(typ, name=stmt.name.lexeme)
         if stmt.initializer:
-            init_val = self.visit(stmt.initializer)
-            # Basic cast if needed (extremely simple)
-            if init_val.type != typ:
-                if typ == ir.DoubleType() and init_val.type == ir.IntType(64):
-                    init_val = self.builder.sitofp(init_val, typ)
-                # TODO: more casts
-            self.builder.store(init_val, ptr)
-
-    # ... (binary expr etc as before) ...
+            self.store(ptr, self.visit(stmt.initializer))
+        self.scopes[-1][stmt.name.lexeme] = ptr
+
     def visit_binary_expr(self, expr):
         lhs = self.visit(expr.left)
         rhs = self.visit(expr.right)
-        
+
+        op = expr.operator.type
         op_str = expr.operator.lexeme
-        
-        # Float math (default)
-        if lhs.type == ir.DoubleType() or rhs.type == ir.DoubleType():
+
+        if lhs.type == BOOL and rhs.type == BOOL and op in (TokenType.EQUAL_EQUAL, TokenType.BANG_EQUAL):
+            return self.builder.icmp_unsigned(COMPARISONS[op], lhs, rhs, 'cmptmp')
+        if STRING in (lhs.type, rhs.type):
+            return self.string_binary(op, lhs, rhs)
+        if lhs.type not in (INT, DOUBLE) or rhs.type not in (INT, DOUBLE):
+            raise JITError(f"operator {op_str} is only supported on numbers by the JIT")
+
+        # Float math
+        if lhs.type == DOUBLE or rhs.type == DOUBLE:
              # Promo to double
-             if lhs.type == ir.IntType(64): lhs = self.builder.sitofp(lhs, ir.DoubleType())
-             if rhs.type == ir.IntType(64): rhs = self.builder.sitofp(rhs, ir.DoubleType())
-             
+             lhs, rhs = self.coerce(lhs, DOUBLE), self.coerce(rhs, DOUBLE)
+
              if op_str == '+': return self.builder.fadd(lhs, rhs, 'addtmp')
              elif op_str == '-': return self.builder.fsub(lhs, rhs, 'subtmp')
              elif op_str == '*': return self.builder.fmul(lhs, rhs, 'multmp')
              elif op_str == '/': return self.builder.fdiv(lhs, rhs, 'divtmp')
-             elif op_str == '<': return self.builder.fcmp_ordered('<', lhs, rhs, 'cmptmp')
+             elif op in COMPARISONS: return self.builder.fcmp_ordered(COMPARISONS[op], lhs, rhs, 'cmptmp')
         else:
              # Int math
-             if op_str == '+': return self.builder.add(lhs, rhs, 'addtmp')
-             elif op_str == '-': return self.builder.sub(lhs, rhs, 'subtmp')
-             elif op_str == '*': return self.builder.mul(lhs, rhs, 'multmp')
-             elif op_str == '/': return self.builder.sdiv(lhs, rhs, 'divtmp') # signed div
-             elif op_str == '<': return self.builder.icmp_signed('<', lhs, rhs, 'cmptmp')
+             if op_str == '+': return self.int_arithmetic('add', lhs, rhs)
+             elif op_str == '-': return self.int_arithmetic('sub', lhs, rhs)
+             elif op_str == '*': return self.int_arithmetic('mul', lhs, rhs)
+             elif op_str == '/':
+                 if self.embedded:
+                     raise JITError("integer division gives a float in the VM")
+                 return self.builder.sdiv(lhs, rhs, 'divtmp') # signed div
+             elif op in COMPARISONS: return self.builder.icmp_signed(COMPARISONS[op], lhs, rhs, 'cmptmp')
+
+        raise JITError(f"operator {op_str} is not supported by the JIT")
+
+    def int_arithmetic(self, op, lhs, rhs):
+        """lhs op rhs for op in add/sub/mul on int64. The VM's ints never overflow, so
+        embedded code that would wrap stores OVERFLOW in `reyna_fault` and unwinds, and
+        the VM runs the call itself instead (see TieredVM.call)."""
+        if not self.embedded:
+            return getattr(self.builder, op)(lhs, rhs, f'{op}tmp')
+        self.overflows = True
+        result = getattr(self.builder, f"s{op}_with_overflow")(lhs, rhs)
+        fail_bb = self.func.append_basic_block(name="overflow")
+        ok_bb = self.func.append_basic_block(name="nooverflow")
+        self.builder.cbranch(self.builder.extract_value(result, 1), fail_bb, ok_bb).set_weights([1, 1000])
+        self.builder.position_at_start(fail_bb)
+        self.builder.store(ir.Constant(INT, OVERFLOW), self.fault_slot(0))
+        self.unwind()
+        self.builder.position_at_start(ok_bb)
+        return self.builder.extract_value(result, 0, f'{op}tmp')
+
+    def string_binary(self, op, lhs, rhs):
+        if op == TokenType.PLUS:
+            if self.embedded:
+                raise JITError("strings built in native code cannot be freed when called from the VM")
+            # A new heap block that lives for the rest of the run, like arrays
+            lhs, rhs = self.runtime.to_string(self.builder, lhs), self.runtime.to_string(self.builder, rhs)
+            return self.builder.call(self.runtime.helper("concat"), [lhs, rhs], 'concattmp')
+        if lhs.type == rhs.type and op in (TokenType.EQUAL_EQUAL, TokenType.BANG_EQUAL):
+            order = self.builder.call(self.runtime.function("strcmp"), [lhs, rhs])
+            return self.builder.icmp_signed(COMPARISONS[op], order, ir.Constant(ir.IntType(32), 0), 'cmptmp')
+        raise JITError("strings only support + and equality in the JIT")
 
-        return lhs # Fallback
+    def visit_unary_expr(self, expr):
+        value = self.visit(expr.right)
+        if expr.operator.type == TokenType.BANG:
+            return self.builder.not_(self.coerce(value, BOOL), 'nottmp')
+        if value.type == DOUBLE:
+            return self.builder.fneg(value, 'negtmp')
+        return self.int_arithmetic('sub', ir.Constant(INT, 0), value)
+
+    def visit_logical_expr(self, expr):
+        # Short-circuit: the right operand only runs when it decides the result
+        lhs = self.coerce(self.visit(expr.left), BOOL)
+        lhs_bb = self.builder.block
+        rhs_bb = self.func.append_basic_block(name="logicrhs")
+        merge_bb = self.func.append_basic_block(name="logicend")
+        if expr.operator.type == TokenType.AND:
+            self.builder.cbranch(lhs, rhs_bb, merge_bb)
+        else:
+            self.builder.cbranch(lhs, merge_bb, rhs_bb)
+        self.builder.position_at_start(rhs_bb)
+        rhs = self.coerce(self.visit(expr.right), BOOL)
+        rhs_end = self.builder.block
+        self.builder.branch(merge_bb)
+        self.builder.position_at_start(merge_bb)
+        phi = self.builder.phi(BOOL, 'logictmp')
+        phi.add_incoming(lhs, lhs_bb)
+        phi.add_incoming(rhs, rhs_end)
+        return phi
 
+    def visit_grouping_expr(self, expr):
+        return self.visit(expr.expression)
 
     def visit_literal_expr(self, expr):
         if isinstance(expr.value, bool):
-             return ir.Constant(ir.IntType(1), 1 if expr.value else 0)
+             return ir.Constant(BOOL, 1 if expr.value else 0)
         if isinstance(expr.value, int):
-             return ir.Constant(ir.IntType(64), expr.value)
+             return ir.Constant(INT, expr.value)
         if isinstance(expr.value, float):
-             return ir.Constant(ir.DoubleType(), expr.value)
-        return ir.Constant(ir.DoubleType(), 0.0)
+             return ir.Constant(DOUBLE, expr.value)
+        if isinstance(expr.value, str):
+             return self.runtime.string(expr.value)
+        raise JITError(f"literal {expr.value!r} is not supported by the JIT")
 
     def visit_variable_expr(self, expr):
-        ptr = self.named_values.get(expr.name.lexeme)
-        if ptr:
-            return self.builder.load(ptr, expr.name.lexeme)
-        return ir.Constant(ir.DoubleType(), 0.0)
-        
+        return self.builder.load(self.lookup(expr.name.lexeme), expr.name.lexeme)
+
     def visit_assign_expr(self, expr):
-        val = self.visit(expr.value)
-        ptr = self.named_values.get(expr.name.lexeme)
-        if ptr:
-            self.builder.store(val, ptr)
+        ptr = self.lookup(expr.name.lexeme)
+        val = self.coerce(self.visit(expr.value), ptr.type.pointee)
+        self.builder.store(val, ptr)
         return val
 
+    # Structs
+
+    def declare_struct(self, stmt):
+        name = stmt.name.lexeme
+        typ = self.module.context.get_identified_type(f"struct.{name}")
+        # Registered before the body so fields may point at instances of the same struct
+        self.structs[name] = (stmt, typ)
+        self.layouts[typ.name] = [f_name.lexeme for f_name, _ in stmt.fields]
+        typ.set_body(*[self.llvm_type(f_type.lexeme, f"field '{f_name.lexeme}' of {name}")
+                       for f_name, f_type in stmt.fields])
+
+    def soa_type(self, name):
+        """Arrays of structs are laid out as a struct of arrays: {length, one column
+        per field}, so a loop over one field reads contiguous memory."""
+        typ = self.module.context.get_identified_type(f"soa.{name}")
+        if typ.is_opaque:
+            stmt, record = self.structs[name]
+            if not all(field in (INT, DOUBLE, BOOL) for field in record.elements):
+                raise JITError(f"arrays of {name} need int64, float64 and bool fields only")
+            typ.set_body(INT, *[field.as_pointer() for field in record.elements])
+            self.layouts[typ.name] = self.layouts[record.name]
+        return typ
+
     def visit_struct_decl(self, stmt):
-        pass # Structs ignored in JIT basics for now
+        if self.structs.get(stmt.name.lexeme, (None,))[0] is not stmt:
+            raise JITError(f"struct '{stmt.name.lexeme}' must be declared at the top level for the JIT")
+
+    def plan_instances(self, decls, main=()):
+        """Decide where the instance made by each `let v = S();` lives. If v never
+        escapes its function, that is, it is only used as `v.field` or passed to
+        parameters that do not escape either, the instance goes on the stack. Direct
+        top-level lets get static storage. Every other instance is heap allocated."""
+        names = {decl.name.lexeme for decl in decls}
+        escaping = set() # (function name, parameter index)
+
+        def escapes(name, roots):
+            nodes = [node for root in roots for node in walk(root)]
+            safe = set()
+            for node in nodes:
+                if isinstance(node, (Get, Set)) and isinstance(node.obj, Variable):
+                    safe.add(id(node.obj))
+                elif isinstance(node, Call) and isinstance(node.callee, Variable) and node.callee.name.lexeme in names:
+                    for i, arg in enumerate(node.arguments):
+                        if isinstance(arg, Variable) and (node.callee.name.lexeme, i) not in escaping:
+                            safe.add(id(arg))
+            return any(isinstance(node, Variable) and node.name.lexeme == name and id(node) not in safe
+                       for node in nodes)
+
+        changed = True
+        while changed:
+            changed = False
+            for decl in decls:
+                for i, (p_name, _) in enumerate(decl.params):
+                    key = (decl.name.lexeme, i)
+                    if key not in escaping and escapes(p_name.lexeme, [decl.body]):
+                        escaping.add(key)
+                        changed = True
 
-    def visit_get_expr(self, expr): pass
-    def visit_set_expr(self, expr): pass
+        for roots in [[decl.body] for decl in decls] + [list(main)]:
+            for node in (node for root in roots for node in walk(root)):
+                if isinstance(node, LetStmt) and self.is_constructor(node.initializer):
+                    if any(node is stmt for stmt in main):
+                        self.static_sites.add(id(node.initializer))
+                    elif not escapes(node.name.lexeme, roots):
+                        self.stack_sites.add(id(node.initializer))
+
+    def is_constructor(self, expr):
+        return isinstance(expr, Call) and isinstance(expr.callee, Variable) \
+            and expr.callee.name.lexeme in self.structs and expr.callee.name.lexeme not in self.functions
+
+    def construct(self, expr):
+        name = expr.callee.name.lexeme
+        if expr.arguments:
+            raise JITError(f"struct constructor {name} takes no arguments")
+        typ = self.structs[name][1]
+        if id(expr) in self.static_sites:
+            storage = ir.GlobalVariable(self.module, typ, name=f"{name}.static")
+            storage.initializer = ir.Constant(typ, None)
+            return storage
+        if id(expr) in self.stack_sites:
+            with self.builder.goto_entry_block():
+                ptr = self.builder.alloca(typ, name=name)
+        else:
+            if self.embedded:
+                raise JITError(f"an instance of {name} escapes its function, which native code "
+                               f"called from the VM does not support")
+            # The size of one instance, from the address of the second in an array at 0
+            size = self.builder.ptrtoint(self.builder.gep(ir.Constant(typ.as_pointer(), None),
+                                                          [ir.Constant(ir.IntType(32), 1)]), INT)
+            ptr = self.builder.bitcast(self.builder.call(self.runtime.function("malloc"), [size]), typ.as_pointer())
+        # Fields start out zero
+        self.builder.store(ir.Constant(typ, None), ptr)
+        return ptr
+
+    def field_pointer(self, obj, field):
+        if isinstance(obj, (Index, IndexGet)):
+            # A field of one element of a struct array: an element of that field's column
+            array = self.visit(getattr(obj, 'target', None) or getattr(obj, 'obj', None))
+            if not is_soa(array.type):
+                raise JITError("only elements of struct arrays have fields in the JIT")
+            column = self.field_index(array.type, field)
+            index = self.checked_index(array, obj.index)
+            return self.builder.gep(self.builder.extract_value(array, column + 1), [index], inbounds=True)
+        instance = self.visit(obj)
+        if not isinstance(instance.type, ir.PointerType) or not isinstance(instance.type.pointee, ir.IdentifiedStructType):
+            raise JITError("only struct instances have fields in the JIT")
+        column = self.field_index(instance.type.pointee, field)
+        return self.builder.gep(instance, [ir.Constant(ir.IntType(32), 0), ir.Constant(ir.IntType(32), column)],
+                                inbounds=True)
+
+    def field_index(self, typ, field):
+        fields = self.layouts[typ.name]
+        if field.lexeme not in fields:
+            raise JITError(f"{typ.name.split('.', 1)[1]} has no field '{field.lexeme}'")
+        return fields.index(field.lexeme)
+
+    def visit_get_expr(self, expr):
+        return self.builder.load(self.field_pointer(expr.obj, expr.name), expr.name.lexeme)
+
+    def visit_set_expr(self, expr):
+        ptr = self.field_pointer(expr.obj, expr.name)
+        value = self.coerce(self.visit(expr.value), ptr.type.pointee)
+        self.builder.store(value, ptr)
+        return value
+
+    def __getattr__(self, name):
+        # Every other visit_* method reports the node as unsupported
+        if name.startswith("visit_"):
+            return self.unsupported
+        raise AttributeError(name)
 
 
 class ReynaJIT:
-    def __init__(self):
-        try:
-            llvm.initialize()
-            llvm.initialize_native_target()
-            llvm.initialize_native_asmprinter()
-        except:
-             # Fallback for newer versions or broken envs?
-             try:
-                 llvm.initialize_all_targets()
-                 llvm.initialize_all_asmprinters()
-             except Exception as e:
-                 print(f"JIT Init Failed: {e}")
-                 return
-        
-        # Load standard C library for printf
-        try:
-            llvm.load_library_permanently("msvcrt.dll")
-        except:
-            pass 
-            
-        self.codegen = CodeGen()
+    """One long-lived ORC JIT. Every compiled module is linked into it as a library of
+    its own, which may use the symbols of libraries linked before it: the runtime
+    library (jit_runtime.runtime_module), built on first use, and in compile_and_run
+    the libraries of earlier calls. A library's code is freed once the ResourceTracker
+    link returns for it is no longer referenced; compile_and_run drops the ones nothing
+    current needs any more (see release_sessions)."""
+
+    def __init__(self, opt_level=2, dump_ir=(), verbose=False, cache=None):
+        llvm.initialize_native_target()
+        llvm.initialize_native_asmprinter()
+
+        # printf, malloc, libm and the rest come from the host C library
+        load_host_libraries()
+
+        self.opt_level = opt_level
+        self.dump_ir = dump_ir # Any of "before", "after"
+        self.verbose = verbose
+        self.cache = cache # jit_cache.ObjectCache for compile_and_run, or None
         self.target = llvm.Target.from_default_triple()
-        self.target_machine = self.target.create_target_machine()
+        # Tune instruction selection and scheduling for the CPU we are running on
+        self.cpu = llvm.get_host_cpu_name()
+        self.features = llvm.get_host_cpu_features().flatten()
+        self.target_machine = self.target.create_target_machine(cpu=self.cpu, features=self.features, opt=opt_level)
+        self.lljit = llvm.create_lljit_compiler(self.target_machine)
+        self.linked = 0      # Libraries linked so far, for unique names
+        self.runtime = None  # ResourceTracker of the runtime library
+        # What compile_and_run calls defined, for later calls: name -> (node, library
+        # name), and library name -> (tracker keeping it loaded, names of the earlier
+        # libraries its code may use)
+        self.definitions = {}
+        self.sessions = {}
+
+    def optimize(self, mod):
+        """Run LLVM's standard -O<n> pipeline: mem2reg/SROA, instcombine, GVN, and at -O2
+        and above loop unrolling and vectorization."""
+        if self.opt_level == 0:
+            return
+        pto = llvm.create_pipeline_tuning_options(speed_level=self.opt_level)
+        pto.loop_vectorization = self.opt_level >= 2
+        pto.slp_vectorization = self.opt_level >= 2
+        pto.loop_unrolling = self.opt_level >= 2
+        pb = llvm.create_pass_builder(self.target_machine, pto)
+        pb.getModulePassManager().run(mod, pb)
+
+    def compile_function(self, decl, resolve):
+        """Compile one top-level function and its callees for use from the VM (see
+        CodeGen.generate_function). Returns (library, address of `reyna_fault` or 0,
+        compiled names, whether it prints), where library["reyna_entry"] is the entry
+        point; raises JITError."""
+        codegen = CodeGen(embedded=True, linked=True)
+        names = codegen.generate_function(decl, resolve)
+        library = self.link(codegen.module, ["reyna_entry"], codegen.runtime.used)
+        fault = self.runtime_library()["reyna_fault"] if codegen.fault_state is not None else 0
+        return library, fault, names, codegen.prints
+
+    def link(self, module, exports, runtime=False):
+        """Optimize and compile an ir.Module and link it as a new library; see link_object."""
+        mod = llvm.parse_assembly(str(module))
+        mod.verify()
+        self.optimize(mod)
+        return self.link_object(self.target_machine.emit_object(mod), exports, runtime)
+
+    def link_object(self, obj, exports, runtime=False, name=None, libraries=()):
+        """Load object code as a new library that resolves symbols against the process
+        (the C library and libm), the runtime library if runtime is set, and the named
+        libraries. Returns its ResourceTracker, mapping each name in exports to an address."""
+        builder = llvm.JITLibraryBuilder().add_object_img(obj).add_current_process()
+        if runtime:
+            builder.add_jit_library(self.runtime_library().name)
+        for library in libraries:
+            builder.add_jit_library(library)
+        for symbol in exports:
+            builder.export_symbol(symbol)
+        return builder.link(self.lljit, name or self.library_name())
+
+    def library_name(self):
+        # Names of unloaded libraries cannot be reused either
+        self.linked += 1
+        return f"reyna.{self.linked}"
+
+    def runtime_library(self):
+        if self.runtime is None:
+            obj = self.object_code(str(runtime_module()))
+            self.runtime = self.link_object(obj, ["reyna_fault"], name="reyna.runtime")
+        return self.runtime
+
+    def object_code(self, ir_text, times=None):
+        """Machine code for a module, taken from the cache when an earlier run compiled the
+        same IR at the same -O level for the same CPU. Appends (step, seconds) to times."""
+        key = None
+        start = time.perf_counter()
+        if self.cache is not None and not (self.dump_ir and times is not None):
+            key = self.cache.key(ir_text, self.opt_level, llvm.get_process_triple(), self.cpu, self.features)
+            cached = self.cache.load(key)
+            if cached is not None:
+                if times is not None:
+                    times.append(("cached machine code", time.perf_counter() - start))
+                return cached
+        mod = llvm.parse_assembly(ir_text)
+        mod.verify()
+        if times is not None and "before" in self.dump_ir:
+            print("; LLVM IR before optimization")
+            print(str(mod))
+        self.optimize(mod)
+        if times is not None:
+            times.append((f"optimization (-O{self.opt_level})", time.perf_counter() - start))
+            if "after" in self.dump_ir:
+                print(f"; LLVM IR after optimization (-O{self.opt_level})")
+                print(str(mod))
+        start = time.perf_counter()
+        obj = self.target_machine.emit_object(mod)
+        if key is not None:
+            self.cache.store(key, obj)
+        if times is not None:
+            times.append(("machine code", time.perf_counter() - start))
+        return obj
+
+    def emit(self, statements, kind, path):
+        """Compile the program's top-level functions ahead of time (see
+        CodeGen.generate_library) into an object file, assembly or shared library
+        at path. Returns {name: reason} for the functions left out."""
+        codegen = CodeGen(embedded=True)
+        skipped = codegen.generate_library(statements)
+        mod = llvm.parse_assembly(str(codegen.module))
+        mod.verify()
+        self.optimize(mod)
+        # Position-independent so the object can be linked into a shared library
+        machine = self.target.create_target_machine(cpu=self.cpu, features=self.features,
+                                                    opt=self.opt_level, reloc="pic", codemodel="default")
+        if kind == "asm":
+            with open(path, "w") as f:
+                f.write(machine.emit_assembly(mod))
+        elif kind == "obj":
+            with open(path, "wb") as f:
+                f.write(machine.emit_object(mod))
+        else:
+            with tempfile.TemporaryDirectory() as temp:
+                obj = os.path.join(temp, "module.o")
+                with open(obj, "wb") as f:
+                    f.write(machine.emit_object(mod))
+                linker = os.environ.get("CC", "cc")
+                try:
+                    subprocess.run([linker, "-shared", "-o", path, obj], check=True)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    raise JITError(f"linking {path} with {linker} failed: {e}")
+        return skipped
 
     def compile_and_run(self, statements):
-        # Generate IR
-        llvm_mod = self.codegen.generate(statements)
-        
-        # Verify
-        print("Generated LLVM IR:")
-        print(str(llvm_mod))
-        
+        """Compile a program and run its top-level statements. Each call links one more
+        library, so functions, structs and globals defined by earlier calls stay usable."""
+        times = []
+        start = time.perf_counter()
+        name = self.library_name()
+        try:
+            # Generate IR
+            codegen = CodeGen(linked=True, library=name)
+            llvm_mod = codegen.generate(statements, self.definitions)
+        except JITError as e:
+            print(f"JIT Compilation Failed: {e}")
+            return
+        times.append(("IR generation", time.perf_counter() - start))
+
         try:
-            # Convert IR module to LLVM binding module
-            mod = llvm.parse_assembly(str(llvm_mod))
-            mod.verify()
-            
-            # Create Engine
-            engine = llvm.create_execution_engine()
-            engine.add_module(mod)
-            engine.finalize_object()
-            engine.run_static_constructors()
-            
-            # Lookup main
-            func_ptr = engine.get_function_address("main")
-            
+            obj = self.object_code(str(llvm_mod), times)
+            start = time.perf_counter()
+            session = self.link_object(obj, ["main"], codegen.runtime.used, name, list(self.sessions))
+            times.append(("linking", time.perf_counter() - start))
+            defined = {stmt.name.lexeme for stmt in statements if isinstance(stmt, (FnDecl, StructDecl, LetStmt))}
+            named = {n for stmt in statements for node in walk(stmt) for n in
+                     ([node.name.lexeme] if isinstance(node, (Variable, Assign)) else []) + annotations(node)}
+            uses = {library for known, (_, library) in self.definitions.items() if known in named - defined}
+            self.sessions[name] = (session, uses)
+            for stmt in statements:
+                if isinstance(stmt, (FnDecl, StructDecl, LetStmt)):
+                    self.definitions[stmt.name.lexeme] = (stmt, name)
+            if self.verbose:
+                print("jit: " + ", ".join(f"{what} {seconds * 1000:.1f}ms" for what, seconds in times))
+
             # Cast and Call
-            cfunc = ctypes.CFUNCTYPE(None)(func_ptr)
+            cfunc = ctypes.CFUNCTYPE(None)(session["main"])
+            # Python and C buffer stdout separately; keep their output in order
+            sys.stdout.flush()
             cfunc()
+            flush_output()
+            if self.runtime is not None:
+                # A bad index stops only the program that made it
+                ctypes.c_int64.from_address(self.runtime["reyna_fault"]).value = 0
+            self.release_sessions()
         except Exception as e:
             print(f"JIT Execution Failed: {str(e)}")
 
-
-
-
+    def release_sessions(self):
+        """Unload the libraries of earlier compile_and_run calls that define no current
+        name and that no library defining one may call into, e.g. one whose only
+        function has been redefined since, or one that only ran statements."""
+        live = {library for _, library in self.definitions.values()}
+        pending = list(live)
+        while pending:
+            for library in self.sessions[pending.pop()][1] - live:
+                live.add(library)
+                pending.append(library)
+        for library in [library for library in self.sessions if library not in live]:
+            del self.sessions[library]
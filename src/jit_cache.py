@@ -0,0 +1,70 @@
+import hashlib
+import os
+import tempfile
+
+# On-disk cache of JIT object code for `--mode jit`. An entry is the machine
+# code LLVM produced for one module, stored under a hash of everything that
+# determines it: the IR before optimization, the optimization level and the
+# target (triple, CPU name and CPU features). Files are touched on every hit
+# and the least recently used ones are deleted once the directory grows past
+# max_bytes.
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".cache", "reyna", "jit")
+MAX_BYTES = 64 * 1024 * 1024
+
+class ObjectCache:
+    def __init__(self, directory=None, max_bytes=MAX_BYTES):
+        self.directory = directory or os.environ.get("REYNA_JIT_CACHE") or DEFAULT_DIR
+        self.max_bytes = max_bytes
+
+    def key(self, ir_text, opt_level, triple, cpu, features):
+        digest = hashlib.sha256()
+        for part in (ir_text, str(opt_level), triple, cpu, features):
+            digest.update(part.encode("utf8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".o")
+
+    def load(self, key):
+        """Return the cached object code for key, or None."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path) # Most recently used
+            return data
+        except OSError:
+            return None
+
+    def store(self, key, data):
+        # Write to a temporary file first so readers never see a partial object
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(temp, self.path(key))
+            self.evict()
+        except OSError:
+            pass # A cache that cannot be written just stays cold
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".o"):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
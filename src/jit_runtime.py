@@ -0,0 +1,247 @@
+import ctypes
+import ctypes.util
+import functools
+import llvmlite.ir as ir
+import llvmlite.binding as llvm
+
+# Runtime support for JIT-compiled code: printing, strings and math. Everything
+# bottoms out in the host C library (printf, snprintf, strtod, malloc, ...) and
+# libm, which the JIT resolves when it links the code and `--emit so` leaves to
+# the dynamic linker. The helpers on top of them are defined in LLVM IR: the JIT
+# compiles them once into a runtime library that every later module links
+# against (see runtime_module), while `--emit` defines them in the module that
+# uses them, so no support library has to be built or shipped.
+#
+# Printed values must read exactly like the VM's, which prints with Python's
+# str(): floats use the shortest digits that read back as the same double,
+# switching to exponent form outside 1e-4 <= |x| < 1e16, bools are True/False.
+
+INT = ir.IntType(64)
+DOUBLE = ir.DoubleType()
+BOOL = ir.IntType(1)
+I32 = ir.IntType(32)
+CHAR = ir.IntType(8)
+STRING = CHAR.as_pointer()
+
+FLOAT_DIGITS = 17  # Enough significant digits for any double to read back exactly
+FLOAT_BUFFER = 32  # Bytes for the longest float text plus its terminator
+FAULT_STATE = ir.ArrayType(INT, 3) # {faulted, bad index, array length}
+
+# name -> (return type, parameter types) of the helpers, see the Runtime.define_* methods
+HELPERS = {
+    "format_float": (ir.VoidType(), [STRING, DOUBLE]),
+    "write_float": (ir.VoidType(), [DOUBLE]),
+    "int_string": (STRING, [INT]),
+    "float_string": (STRING, [DOUBLE]),
+    "concat": (STRING, [STRING, STRING]),
+}
+
+# name -> (return type, parameter types, varargs)
+C_FUNCTIONS = {
+    "printf": (I32, [STRING], True),
+    "snprintf": (I32, [STRING, INT, STRING], True),
+    "putchar": (I32, [I32], False),
+    "fflush": (I32, [STRING], False),
+    "strtod": (DOUBLE, [STRING, STRING.as_pointer()], False),
+    "strchr": (STRING, [STRING, I32], False),
+    "atoi": (I32, [STRING], False),
+    "strlen": (INT, [STRING], False),
+    "strcmp": (I32, [STRING, STRING], False),
+    "memcpy": (STRING, [STRING, STRING, INT], False),
+    "malloc": (STRING, [INT], False),
+    "calloc": (STRING, [INT, INT], False),
+}
+
+def load_host_libraries():
+    # Loaded globally into the process, where the JIT looks up printf, sin and the rest
+    for name in ("c", "m"):
+        path = ctypes.util.find_library(name)
+        if path:
+            llvm.load_library_permanently(path)
+
+@functools.lru_cache(maxsize=None)
+def libc():
+    return ctypes.CDLL(ctypes.util.find_library("c"))
+
+def flush_output():
+    """Write out whatever native code left in C's stdout buffer."""
+    libc().fflush(None)
+
+def runtime_module():
+    """A module defining every helper, plus the `reyna_fault` state, for modules
+    compiled with Runtime(shared=True) to link against."""
+    module = ir.Module(name="reyna_runtime")
+    module.triple = llvm.get_process_triple()
+    runtime = Runtime(module)
+    for name in HELPERS:
+        runtime.helper(name).linkage = ''
+    runtime.fault_state()
+    return module
+
+class Runtime:
+    """The C functions and helpers one module uses, each declared or defined the
+    first time code asks for it. A shared runtime only declares the helpers; they
+    come from the JIT's runtime library."""
+
+    def __init__(self, module, shared=False):
+        self.module = module
+        self.shared = shared
+        self.used = False # Whether anything from the runtime library was declared
+        self.strings = {} # text -> global holding it
+
+    def function(self, name):
+        if name not in self.module.globals:
+            ret, params, var_arg = C_FUNCTIONS[name]
+            ir.Function(self.module, ir.FunctionType(ret, params, var_arg=var_arg), name=name)
+        return self.module.globals[name]
+
+    def intrinsic(self, name):
+        # Every math builtin (stdlib.MATH) has an LLVM intrinsic of the same name. The
+        # optimizer folds and vectorizes those; the ones with no instruction become libm calls
+        return self.module.declare_intrinsic(f"llvm.{name}", [DOUBLE])
+
+    def string(self, text):
+        """An i8* constant pointing at text."""
+        if text not in self.strings:
+            self.strings[text] = global_string(self.module, f"str.{len(self.strings)}", text)
+        zero = ir.Constant(I32, 0)
+        return self.strings[text].gep([zero, zero])
+
+    def helper(self, name):
+        """The function reyna.rt.<name>, see the define_* methods."""
+        full = f"reyna.rt.{name}"
+        if full not in self.module.globals:
+            ret, params = HELPERS[name]
+            func = ir.Function(self.module, ir.FunctionType(ret, params), name=full)
+            if self.shared:
+                self.used = True
+            else:
+                func.linkage = 'internal'
+                getattr(self, f"define_{name}")(func, ir.IRBuilder(func.append_basic_block(name="entry")))
+        return self.module.globals[full]
+
+    def fault_state(self):
+        """The `reyna_fault` global, see CodeGen.fault_slot."""
+        fault = ir.GlobalVariable(self.module, FAULT_STATE, name="reyna_fault")
+        if self.shared:
+            self.used = True
+        else:
+            fault.initializer = ir.Constant(FAULT_STATE, None)
+        return fault
+
+    # Used by generated code
+
+    def write(self, builder, value):
+        """Print value with no newline."""
+        if value.type == INT:
+            builder.call(self.function("printf"), [self.string("%lld"), value])
+        elif value.type == DOUBLE:
+            builder.call(self.helper("write_float"), [value])
+        elif value.type == BOOL:
+            builder.call(self.function("printf"), [self.string("%s"), self.bool_name(builder, value)])
+        else:
+            builder.call(self.function("printf"), [self.string("%s"), value])
+
+    def newline(self, builder):
+        builder.call(self.function("putchar"), [ir.Constant(I32, ord("\n"))])
+
+    def to_string(self, builder, value):
+        """value as a string, for concatenation. Numbers are formatted into a new heap block."""
+        if value.type == INT:
+            return builder.call(self.helper("int_string"), [value])
+        if value.type == DOUBLE:
+            return builder.call(self.helper("float_string"), [value])
+        if value.type == BOOL:
+            return self.bool_name(builder, value)
+        return value
+
+    def bool_name(self, builder, value):
+        return builder.select(value, self.string("True"), self.string("False"))
+
+    # Helper definitions
+
+    def define_format_float(self, func, b):
+        # Fill buf with Python's repr(x): the fewest digits (1 to 17) that strtod reads
+        # back as x, written in fixed notation when the exponent is in [-4, 16)
+        buf, x = func.args
+        snprintf = self.function("snprintf")
+        size = ir.Constant(INT, FLOAT_BUFFER)
+        zero = ir.Constant(DOUBLE, 0.0)
+        special_bb, finite_bb, loop_bb, found_bb, fixed_bb, fraction_bb, whole_bb, done_bb = [
+            func.append_basic_block(name=name) for name in
+            ("special", "finite", "digits", "found", "fixed", "fraction", "whole", "done")]
+
+        # x - x is NaN exactly when x is infinite or NaN
+        b.cbranch(b.fcmp_ordered("==", b.fsub(x, x), zero), finite_bb, special_bb)
+        b.position_at_start(special_bb)
+        name = b.select(b.fcmp_unordered("uno", x, x), self.string("nan"),
+                        b.select(b.fcmp_ordered(">", x, zero), self.string("inf"), self.string("-inf")))
+        b.call(snprintf, [buf, size, self.string("%s"), name])
+        b.ret_void()
+
+        b.position_at_start(finite_bb)
+        b.branch(loop_bb)
+        b.position_at_start(loop_bb)
+        decimals = b.phi(I32, "decimals") # Digits after the first one
+        decimals.add_incoming(ir.Constant(I32, 0), finite_bb)
+        b.call(snprintf, [buf, size, self.string("%.*e"), decimals, x])
+        exact = b.fcmp_ordered("==", b.call(self.function("strtod"), [buf, ir.Constant(STRING.as_pointer(), None)]), x)
+        last = b.icmp_signed(">=", decimals, ir.Constant(I32, FLOAT_DIGITS - 1))
+        decimals.add_incoming(b.add(decimals, ir.Constant(I32, 1)), loop_bb)
+        b.cbranch(b.or_(exact, last), found_bb, loop_bb)
+
+        b.position_at_start(found_bb)
+        e = b.call(self.function("strchr"), [buf, ir.Constant(I32, ord("e"))])
+        exponent = b.call(self.function("atoi"), [b.gep(e, [ir.Constant(I32, 1)])])
+        scientific = b.or_(b.icmp_signed("<", exponent, ir.Constant(I32, -4)),
+                           b.icmp_signed(">=", exponent, ir.Constant(I32, 16)))
+        b.cbranch(scientific, done_bb, fixed_bb) # %e already matches, as in 1e+16 or 2.5e-05
+
+        b.position_at_start(fixed_bb)
+        places = b.sub(decimals, exponent)
+        b.cbranch(b.icmp_signed(">", places, ir.Constant(I32, 0)), fraction_bb, whole_bb)
+        b.position_at_start(fraction_bb)
+        b.call(snprintf, [buf, size, self.string("%.*f"), places, x])
+        b.branch(done_bb)
+        b.position_at_start(whole_bb)
+        b.call(snprintf, [buf, size, self.string("%.0f.0"), x])
+        b.branch(done_bb)
+
+        b.position_at_start(done_bb)
+        b.ret_void()
+
+    def define_write_float(self, func, b):
+        buf = b.bitcast(b.alloca(ir.ArrayType(CHAR, FLOAT_BUFFER)), STRING)
+        b.call(self.helper("format_float"), [buf, func.args[0]])
+        b.call(self.function("printf"), [self.string("%s"), buf])
+        b.ret_void()
+
+    def define_int_string(self, func, b):
+        size = ir.Constant(INT, 21) # "-9223372036854775808" and its terminator
+        buf = b.call(self.function("malloc"), [size])
+        b.call(self.function("snprintf"), [buf, size, self.string("%lld"), func.args[0]])
+        b.ret(buf)
+
+    def define_float_string(self, func, b):
+        buf = b.call(self.function("malloc"), [ir.Constant(INT, FLOAT_BUFFER)])
+        b.call(self.helper("format_float"), [buf, func.args[0]])
+        b.ret(buf)
+
+    def define_concat(self, func, b):
+        left, right = func.args
+        strlen, memcpy = self.function("strlen"), self.function("memcpy")
+        left_len = b.call(strlen, [left])
+        right_size = b.add(b.call(strlen, [right]), ir.Constant(INT, 1))
+        result = b.call(self.function("malloc"), [b.add(left_len, right_size)])
+        b.call(memcpy, [result, left, left_len])
+        b.call(memcpy, [b.gep(result, [left_len]), right, right_size])
+        b.ret(result)
+
+def global_string(module, name, text, linkage='internal'):
+    data = bytearray(text.encode("utf8") + b"\0")
+    value = ir.Constant(ir.ArrayType(CHAR, len(data)), data)
+    var = ir.GlobalVariable(module, value.type, name=name)
+    var.linkage = linkage
+    var.global_constant = True
+    var.initializer = value
+    return var
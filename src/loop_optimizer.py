@@ -0,0 +1,417 @@
+import copy
+import ast_nodes
+from token_type import TokenType, Token
+from analysis import walk, children, replace_children
+
+# AST-level loop optimizations, run between type checking and compilation.
+#
+# Only expressions without side effects are moved or rewritten, which is
+# decided from the static types the TypeChecker leaves on every expression
+# (expr.static_type). The one such expression that can fail is a field read,
+# which must not run before a loop that would never have read it: its temp is
+# computed behind a copy of the loop condition (see LoopOptimizer.guard).
+
+NUMERIC = ("int64", "float64")
+ARITHMETIC = (TokenType.PLUS, TokenType.MINUS, TokenType.STAR)
+COMPARISONS = (TokenType.LESS, TokenType.LESS_EQUAL, TokenType.GREATER, TokenType.GREATER_EQUAL)
+EQUALITY = (TokenType.EQUAL_EQUAL, TokenType.BANG_EQUAL)
+# Expressions that only read, so evaluating one an extra time changes nothing
+PURE = (ast_nodes.Literal, ast_nodes.Variable, ast_nodes.This, ast_nodes.Grouping, ast_nodes.Unary,
+        ast_nodes.Binary, ast_nodes.Logical, ast_nodes.Get, ast_nodes.Index)
+UNROLL_COMPARES = {
+    TokenType.LESS: lambda a, b: a < b,
+    TokenType.LESS_EQUAL: lambda a, b: a <= b,
+    TokenType.GREATER: lambda a, b: a > b,
+    TokenType.GREATER_EQUAL: lambda a, b: a >= b,
+}
+
+class LoopStats:
+    def __init__(self, line):
+        self.line = line
+        self.hoisted = 0
+        self.reduced = 0
+        self.unrolled = None # Trip count when the loop was fully unrolled
+
+    def __str__(self):
+        if self.unrolled is not None:
+            return f"loop@{self.line}: unrolled {self.unrolled} iterations"
+        return f"loop@{self.line}: hoisted {self.hoisted}, strength-reduced {self.reduced}"
+
+class LoopInfo:
+    """Names and effects observed anywhere inside one loop."""
+    def __init__(self, loop, assigned_in_functions):
+        self.assigned = set()   # Names assigned inside the loop
+        self.declared = set()   # Names declared inside the loop body
+        self.set_fields = set() # Field names written with obj.field = ...
+        self.has_calls = False
+        # Whether the condition can be tested once more ahead of the loop
+        self.pure_condition = all(isinstance(node, PURE) for node in walk(loop.condition))
+        for node in walk(loop):
+            if isinstance(node, ast_nodes.Assign):
+                self.assigned.add(node.name.lexeme)
+            elif isinstance(node, (ast_nodes.LetStmt, ast_nodes.ClassDecl, ast_nodes.StructDecl)):
+                self.declared.add(node.name.lexeme)
+            elif isinstance(node, ast_nodes.FnDecl):
+                self.declared.add(node.name.lexeme)
+                self.declared.update(p_name.lexeme for p_name, _ in node.params)
+            elif isinstance(node, ast_nodes.TryStmt) and node.catch_var:
+                self.declared.add(node.catch_var.lexeme)
+            elif isinstance(node, ast_nodes.MatchExpr):
+                for case in node.cases:
+                    if isinstance(case.pattern, ast_nodes.Variable):
+                        self.declared.add(case.pattern.name.lexeme)
+            elif isinstance(node, ast_nodes.Set):
+                self.set_fields.add(node.name.lexeme)
+            elif isinstance(node, (ast_nodes.Call, ast_nodes.AwaitExpr)):
+                self.has_calls = True
+        if self.has_calls:
+            # Any function reached from the loop may assign what it closes over
+            self.assigned |= assigned_in_functions
+
+    def variant(self, name):
+        return name in self.assigned or name in self.declared
+
+class LoopOptimizer:
+    """Loop-invariant code motion, strength reduction and full unrolling.
+
+    Inner loops are optimized before the loops that contain them. A loop with
+    a constant trip count of at most UNROLL_MAX_TRIPS (and a small body) is
+    replaced by copies of its body. Otherwise products `i * k` of the
+    induction variable and an invariant int are replaced by a running sum,
+    and invariant expressions are hoisted into `$licm` locals declared in a
+    block wrapped around the loop. Locals reading a field are declared behind
+    `if (<condition>)`, so they are only computed when the loop runs.
+    """
+    UNROLL_MAX_TRIPS = 8
+    UNROLL_MAX_NODES = 160      # Trip count times body size
+    STRENGTH_MIN_USES = 3       # A running sum costs one update per iteration
+
+    def __init__(self, structs=None, verbose=False):
+        self.structs = structs or {}
+        self.verbose = verbose
+        self.stats = []
+        self.temp_count = 0
+        self.assigned_in_functions = set()
+
+    def optimize(self, statements):
+        for node in (n for stmt in statements for n in walk(stmt)):
+            if isinstance(node, ast_nodes.FnDecl):
+                for inner in walk(node.body):
+                    if isinstance(inner, ast_nodes.Assign):
+                        self.assigned_in_functions.add(inner.name.lexeme)
+        statements = self.statements(statements, set(), local=False)
+        if self.verbose:
+            for stats in self.stats:
+                print(stats)
+        return statements
+
+    # --- Traversal ---
+    # `names` holds the locals of the frame being optimized; anything else is
+    # a global or upvalue, which is worth caching in a local.
+
+    def statements(self, stmts, names, local=True):
+        names = set(names)
+        result = []
+        for stmt in stmts:
+            if isinstance(stmt, ast_nodes.WhileStmt):
+                prev = result[-1] if result and isinstance(result[-1], ast_nodes.LetStmt) else None
+                result.extend(self.loop(stmt, names, prev))
+                continue
+            result.append(self.statement(stmt, names))
+            if local and isinstance(stmt, (ast_nodes.LetStmt, ast_nodes.FnDecl, ast_nodes.ClassDecl, ast_nodes.StructDecl)):
+                names.add(stmt.name.lexeme)
+        return result
+
+    def statement(self, stmt, names):
+        if isinstance(stmt, ast_nodes.Block):
+            stmt.statements = self.statements(stmt.statements, names)
+        elif isinstance(stmt, ast_nodes.WhileStmt):
+            result = self.loop(stmt, names, None)
+            return result[0] if len(result) == 1 else ast_nodes.Block(result)
+        elif isinstance(stmt, ast_nodes.FnDecl):
+            stmt.body = self.statement(stmt.body, {p_name.lexeme for p_name, _ in stmt.params})
+        elif isinstance(stmt, ast_nodes.ClassDecl):
+            stmt.methods = [self.statement(method, set()) for method in stmt.methods]
+        else:
+            replace_children(stmt, lambda child: self.statement(child, names) if isinstance(child, ast_nodes.Stmt)
+                             else self.expression(child, names))
+        return stmt
+
+    def expression(self, expr, names):
+        # Only reached to find statements nested in expressions (match arms)
+        replace_children(expr, lambda child: self.statement(child, names) if isinstance(child, ast_nodes.Stmt)
+                         else self.expression(child, names))
+        return expr
+
+    def loop(self, loop, names, prev):
+        """Optimize one WhileStmt; returns the statements that replace it."""
+        loop.body = self.statement(loop.body, names)
+        condition = copy.deepcopy(loop.condition) # Before the temps replace parts of it
+        stats = LoopStats(line_of(loop))
+        self.stats.append(stats)
+        info = LoopInfo(loop, self.assigned_in_functions)
+
+        trips = self.trip_count(loop, prev, info)
+        if trips is not None:
+            stats.unrolled = trips
+            return [copy.deepcopy(loop.body) for _ in range(trips)]
+
+        lets = []
+        self.strength_reduce(loop, info, names, lets, stats)
+        self.hoist(loop, info, names, lets, stats)
+        return [ast_nodes.Block(self.guard(lets, loop, condition))] if lets else [loop]
+
+    def guard(self, lets, loop, condition):
+        """The temps' declarations followed by the loop, with the ones that may
+        fail moved under `if (condition)`."""
+        safe = [let for let in lets if not any(isinstance(n, ast_nodes.Get) for n in walk(let.initializer))]
+        if len(safe) == len(lets):
+            return lets + [loop]
+        guarded = [let for let in lets if let not in safe]
+        return safe + [ast_nodes.IfStmt(condition, ast_nodes.Block(guarded + [loop]), None)]
+
+    # --- Unrolling ---
+
+    def trip_count(self, loop, prev, info):
+        """Trip count of `let i = a; while (i < b) { ...; i = i + c; }` with int literals, if small."""
+        if prev is None or not is_int_literal(prev.initializer):
+            return None
+        name = prev.name.lexeme
+        cond = loop.condition
+        if not (isinstance(cond, ast_nodes.Binary) and cond.operator.type in UNROLL_COMPARES
+                and is_variable(cond.left, name) and is_int_literal(cond.right)):
+            return None
+        step = induction_step(loop, name)
+        if not step or name in info.declared or name in self.assigned_in_functions:
+            return None
+        if any(isinstance(n, (ast_nodes.FnDecl, ast_nodes.ClassDecl)) for n in walk(loop.body)):
+            return None
+
+        compare = UNROLL_COMPARES[cond.operator.type]
+        i, trips = prev.initializer.value, 0
+        while compare(i, cond.right.value):
+            trips += 1
+            if trips > self.UNROLL_MAX_TRIPS:
+                return None
+            i += step
+        if trips * sum(1 for _ in walk(loop.body)) > self.UNROLL_MAX_NODES:
+            return None
+        return trips
+
+    # --- Strength reduction ---
+
+    def strength_reduce(self, loop, info, names, lets, stats):
+        """Replace `i * k` with a running sum updated just before `i = i + c`."""
+        body = loop.body
+        if not (isinstance(body, ast_nodes.Block) and body.statements
+                and isinstance(body.statements[-1], ast_nodes.ExprStmt)):
+            return
+        increment = body.statements[-1].expression
+        name = increment.name.lexeme if isinstance(increment, ast_nodes.Assign) else None
+        step = induction_step(loop, name) if name else None
+        if (not step or getattr(increment.value.left, "static_type", None) != "int64"
+                or name in info.declared or (info.has_calls and name in self.assigned_in_functions)):
+            return
+
+        def factor_of(expr):
+            if isinstance(expr, ast_nodes.Binary) and expr.operator.type == TokenType.STAR:
+                for var, factor in ((expr.left, expr.right), (expr.right, expr.left)):
+                    if is_variable(var, name) and getattr(factor, "static_type", None) == "int64" \
+                            and self.invariant(factor, info, names):
+                        return factor
+            return None
+
+        uses = {} # factor key -> (factor, weighted use count)
+        def count(node, depth):
+            if isinstance(node, (ast_nodes.FnDecl, ast_nodes.ClassDecl)):
+                return
+            factor = factor_of(node)
+            if factor is not None:
+                key = expr_key(factor)
+                uses[key] = (factor, uses.get(key, (None, 0))[1] + (self.STRENGTH_MIN_USES if depth else 1))
+                return
+            for child in children_of(node):
+                count(child, depth + isinstance(node, ast_nodes.WhileStmt))
+        count(loop.condition, 0)
+        for stmt in body.statements[:-1]:
+            count(stmt, 0)
+
+        temps = {}
+        for key, (factor, weight) in uses.items():
+            if weight < self.STRENGTH_MIN_USES:
+                continue
+            temp = self.new_temp("$sr", line_of(increment))
+            temps[key] = temp
+            lets.append(ast_nodes.LetStmt(temp, None, typed(ast_nodes.Binary(
+                typed(ast_nodes.Variable(increment.name), "int64"), star(temp.line), copy.deepcopy(factor)), "int64")))
+            if is_int_literal(factor):
+                delta = typed(ast_nodes.Literal(step * factor.value), "int64")
+            else:
+                delta = typed(ast_nodes.Binary(typed(ast_nodes.Literal(step), "int64"), star(temp.line),
+                                               copy.deepcopy(factor)), "int64")
+            update = ast_nodes.Assign(temp, typed(ast_nodes.Binary(
+                typed(ast_nodes.Variable(temp), "int64"), Token(TokenType.PLUS, "+", None, temp.line), delta), "int64"))
+            body.statements.insert(len(body.statements) - 1, ast_nodes.ExprStmt(update))
+            info.assigned.add(temp.lexeme)
+            stats.reduced += 1
+        if not temps:
+            return
+
+        def rewrite(node):
+            if isinstance(node, (ast_nodes.FnDecl, ast_nodes.ClassDecl)):
+                return node
+            factor = factor_of(node)
+            if factor is not None and expr_key(factor) in temps:
+                return typed(ast_nodes.Variable(temps[expr_key(factor)]), "int64")
+            replace_children(node, rewrite)
+            return node
+        loop.condition = rewrite(loop.condition)
+        body.statements[:-len(temps) - 1] = [rewrite(s) for s in body.statements[:-len(temps) - 1]]
+
+    # --- Invariant code motion ---
+
+    def hoist(self, loop, info, names, lets, stats):
+        temps = {} # expression key -> temp token
+
+        def visit(node):
+            if isinstance(node, (ast_nodes.FnDecl, ast_nodes.ClassDecl)):
+                return node
+            if isinstance(node, ast_nodes.Expr) and self.worth_hoisting(node, names) \
+                    and self.invariant(node, info, names):
+                key = expr_key(node)
+                if key not in temps:
+                    temps[key] = self.new_temp("$licm", line_of(node) or line_of(loop))
+                    lets.append(ast_nodes.LetStmt(temps[key], None, node))
+                    stats.hoisted += 1
+                return typed(ast_nodes.Variable(temps[key]), node.static_type)
+            if isinstance(node, ast_nodes.MatchExpr):
+                # Patterns are syntax, not values: leave them alone
+                node.subject = visit(node.subject)
+                for case in node.cases:
+                    if case.guard:
+                        case.guard = visit(case.guard)
+                    case.body = visit(case.body)
+                return node
+            replace_children(node, visit)
+            return node
+
+        loop.condition = visit(loop.condition)
+        loop.body = visit(loop.body)
+
+    def worth_hoisting(self, expr, names):
+        if isinstance(expr, ast_nodes.Grouping):
+            return self.worth_hoisting(expr.expression, names)
+        if isinstance(expr, (ast_nodes.Literal, ast_nodes.This)):
+            return False
+        if isinstance(expr, ast_nodes.Variable):
+            return expr.name.lexeme not in names # Globals and upvalues
+        return True
+
+    def invariant(self, expr, info, names):
+        """True if expr has the same value on every iteration and cannot raise."""
+        if isinstance(expr, (ast_nodes.Literal, ast_nodes.This)):
+            return True
+        if isinstance(expr, ast_nodes.Variable):
+            name = expr.name.lexeme
+            if getattr(expr, "static_type", None) is None or info.variant(name):
+                return False
+            return name in names or not info.has_calls
+        if isinstance(expr, ast_nodes.Grouping):
+            return self.invariant(expr.expression, info, names)
+        if isinstance(expr, ast_nodes.Unary):
+            operand = getattr(expr.right, "static_type", None)
+            if expr.operator.type == TokenType.MINUS and operand in NUMERIC or \
+                    expr.operator.type == TokenType.BANG and operand == "bool":
+                return self.invariant(expr.right, info, names)
+            return False
+        if isinstance(expr, ast_nodes.Binary):
+            op = expr.operator.type
+            left = getattr(expr.left, "static_type", None)
+            right = getattr(expr.right, "static_type", None)
+            numeric = left in NUMERIC and right in NUMERIC
+            if not (op in ARITHMETIC and numeric or op in COMPARISONS and numeric or op in EQUALITY
+                    or op == TokenType.PLUS and left == right == "string"):
+                return False
+            return self.invariant(expr.left, info, names) and self.invariant(expr.right, info, names)
+        if isinstance(expr, ast_nodes.Get):
+            # Nothing in the loop may write this field name. The field may be
+            # unset, so the read needs a guard; see guard
+            if info.has_calls or expr.name.lexeme in info.set_fields or not info.pure_condition:
+                return False
+            if getattr(expr.obj, "static_type", None) not in self.structs:
+                return False
+            return self.invariant(expr.obj, info, names)
+        return False
+
+    def new_temp(self, prefix, line):
+        self.temp_count += 1
+        return Token(TokenType.IDENTIFIER, f"{prefix}{self.temp_count}", None, line)
+
+def induction_step(loop, name):
+    """c for a loop body ending in `name = name +/- <int literal>` with no other assignment to name."""
+    body = loop.body
+    if not (isinstance(body, ast_nodes.Block) and body.statements
+            and isinstance(body.statements[-1], ast_nodes.ExprStmt)):
+        return None
+    assign = body.statements[-1].expression
+    if not (isinstance(assign, ast_nodes.Assign) and assign.name.lexeme == name):
+        return None
+    value = assign.value
+    if not (isinstance(value, ast_nodes.Binary) and is_variable(value.left, name) and is_int_literal(value.right)):
+        return None
+    if sum(1 for n in walk(loop) if isinstance(n, ast_nodes.Assign) and n.name.lexeme == name) != 1:
+        return None
+    if value.operator.type == TokenType.PLUS:
+        return value.right.value
+    if value.operator.type == TokenType.MINUS:
+        return -value.right.value
+    return None
+
+def children_of(node):
+    # Like analysis.children, but match patterns are not expressions to rewrite
+    if isinstance(node, ast_nodes.MatchExpr):
+        yield node.subject
+        for case in node.cases:
+            if case.guard:
+                yield case.guard
+            yield case.body
+        return
+    yield from children(node)
+
+def expr_key(expr):
+    """Structural identity of an invariant expression, used to share temps."""
+    if isinstance(expr, ast_nodes.Literal):
+        return ("literal", type(expr.value), expr.value)
+    if isinstance(expr, ast_nodes.Variable):
+        return ("variable", expr.name.lexeme)
+    if isinstance(expr, ast_nodes.This):
+        return ("this",)
+    if isinstance(expr, ast_nodes.Grouping):
+        return expr_key(expr.expression)
+    if isinstance(expr, ast_nodes.Unary):
+        return ("unary", expr.operator.type, expr_key(expr.right))
+    if isinstance(expr, ast_nodes.Binary):
+        return ("binary", expr.operator.type, expr_key(expr.left), expr_key(expr.right))
+    if isinstance(expr, ast_nodes.Get):
+        return ("get", expr_key(expr.obj), expr.name.lexeme)
+    return ("node", id(expr))
+
+def line_of(node):
+    for n in walk(node):
+        for value in vars(n).values():
+            if isinstance(value, Token):
+                return value.line
+    return 0
+
+def is_int_literal(expr):
+    return isinstance(expr, ast_nodes.Literal) and type(expr.value) is int
+
+def is_variable(expr, name):
+    return isinstance(expr, ast_nodes.Variable) and expr.name.lexeme == name
+
+def star(line):
+    return Token(TokenType.STAR, "*", None, line)
+
+def typed(expr, static_type):
+    expr.static_type = static_type
+    return expr
@@ -0,0 +1,116 @@
+import array
+import ctypes
+import os
+import sys
+from reyna_vals import ObjArray, ObjNative, PACKED_TYPES
+
+# Loads shared libraries built with `--emit so` so a program can `import` them.
+# Such a library exports each compiled function under its Reyna name with the C
+# calling convention, plus a `reyna_signatures` string holding one
+# `name(type,...)->type` line per function, which is all the type checker and
+# the VM need to call into it.
+#
+# Typed arrays cross as a data pointer plus a length. The VM keeps arrays in
+# Python lists; the first time one is passed to native code it is packed in
+# place into an array.array, whose buffer native code then reads and writes
+# directly, on that call and every later one.
+
+C_TYPES = {"int64": ctypes.c_int64, "float64": ctypes.c_double, "bool": ctypes.c_bool, "void": None}
+TYPECODES = {"int64[]": "q", "float64[]": "d"}
+LIBRARY_SUFFIXES = (".so", ".dylib", ".dll")
+
+def is_native_library(path):
+    return path.endswith(LIBRARY_SUFFIXES)
+
+def read_signatures(path):
+    """Return [(name, param_types, return_type)] for the functions path exports."""
+    lib = ctypes.CDLL(os.path.abspath(path))
+    # The symbol is the character array itself, not a pointer to it
+    symbol = ctypes.c_char.in_dll(lib, "reyna_signatures")
+    text = ctypes.cast(ctypes.addressof(symbol), ctypes.c_char_p).value
+    signatures = []
+    for line in text.decode("utf8").splitlines():
+        head, ret = line.split(")->")
+        name, params = head.split("(")
+        signatures.append((name, params.split(",") if params else [], ret))
+    return signatures
+
+def pack(value, type_name):
+    """Return the array.array behind value for a `type_name` parameter, or None.
+
+    A list-backed ObjArray is packed the first time, provided every element
+    already has the exact element type so the VM sees no difference. Views are
+    never packed: writes through them must not reach their parent."""
+    if type(value) is not ObjArray:
+        return None
+    code = TYPECODES[type_name]
+    elements = value.elements
+    if type(elements) is list:
+        kind = PACKED_TYPES[code]
+        if not all(type(e) is kind for e in elements):
+            return None
+        try:
+            elements = array.array(code, elements)
+        except OverflowError: # An int beyond 64 bits
+            return None
+        value.elements = elements
+    return elements if elements.typecode == code else None
+
+def argument_types(params):
+    types = []
+    for t in params:
+        types += [ctypes.c_void_p, ctypes.c_int64] if t in TYPECODES else [C_TYPES[t]]
+    return types
+
+# Values of the first `reyna_fault` word: a bad array index, or int64 arithmetic
+# that overflowed in code compiled for the tiered VM, which then re-runs the call
+BAD_INDEX, OVERFLOW = 1, 2
+
+def fault_state(address):
+    """The {faulted, index, length} words native code sets on a bad array index."""
+    return (ctypes.c_int64 * 3).from_address(address)
+
+def report_fault(fault):
+    fault[0] = 0
+    print(f"Index {fault[1]} out of bounds for array of length {fault[2]}.")
+
+def load_natives(path):
+    """Return {name: ObjNative} calling the functions of the library at path."""
+    lib = ctypes.CDLL(os.path.abspath(path))
+    try:
+        fault = fault_state(ctypes.addressof(ctypes.c_int64.in_dll(lib, "reyna_fault")))
+    except ValueError: # Nothing in the library indexes arrays
+        fault = None
+    natives = {}
+    for name, params, ret in read_signatures(path):
+        entry = getattr(lib, name)
+        entry.argtypes = argument_types(params)
+        entry.restype = C_TYPES[ret]
+        natives[name] = ObjNative(native_call(name, entry, params, fault), name)
+    return natives
+
+def native_call(name, entry, params, fault):
+    arrays = any(t in TYPECODES for t in params)
+
+    def call(args):
+        if arrays:
+            c_args = []
+            for i, (type_name, arg) in enumerate(zip(params, args)):
+                if type_name not in TYPECODES:
+                    c_args.append(arg)
+                    continue
+                buffer = pack(arg, type_name)
+                if buffer is None:
+                    print(f"{name}() expects argument {i} to be an array of {type_name[:-2]} values, got {arg}.")
+                    return None
+                c_args += [buffer.buffer_info()[0], len(buffer)]
+            args = c_args
+        # Native code prints through C's stdout and flushes it before returning;
+        # whatever the VM printed must come out first
+        sys.stdout.flush()
+        result = entry(*args)
+        if fault is not None and fault[0]:
+            report_fault(fault)
+            return None
+        return result
+    return call
@@ -1,4 +1,4 @@
-from token_type import TokenType
+from token_type import TokenType, Token
 import ast_nodes
 
 class ParseError(Exception):
@@ -130,7 +130,14 @@ class Parser:
     def parse_type(self):
         # Parses a type signature
         if self.match(TokenType.TYPE_INT64, TokenType.TYPE_FLOAT64, TokenType.TYPE_BOOL, TokenType.TYPE_STRING, TokenType.IDENTIFIER):
-            return self.previous()
+            base = self.previous()
+            if self.match(TokenType.LEFT_BRACKET):
+                # Typed array: `int64[]`, `float64[]` or `Point[]`, one token named after the whole type
+                self.consume(TokenType.RIGHT_BRACKET, "Expect ']' after '[' in array type.")
+                if base.type not in (TokenType.TYPE_INT64, TokenType.TYPE_FLOAT64, TokenType.IDENTIFIER):
+                    raise self.error(base, "Only int64[], float64[] and struct arrays are typed.")
+                return Token(base.type, base.lexeme + "[]", None, base.line)
+            return base
         raise self.error(self.peek(), "Expect type.")
 
     def statement(self):
@@ -299,7 +306,7 @@ class Parser:
         while self.match(TokenType.OR):
             op = self.previous()
             right = self.and_expression()
-            expr = ast_nodes.Logic(expr, op, right)
+            expr = ast_nodes.Logical(expr, op, right)
         return expr
 
     def and_expression(self):
@@ -307,7 +314,7 @@ class Parser:
         while self.match(TokenType.AND):
             op = self.previous()
             right = self.equality()
-            expr = ast_nodes.Logic(expr, op, right)
+            expr = ast_nodes.Logical(expr, op, right)
         return expr
 
     def equality(self):
@@ -358,9 +365,19 @@ class Parser:
                 name = self.consume(TokenType.IDENTIFIER, "Expect property name after '.'.")
                 expr = ast_nodes.Get(expr, name)
             elif self.match(TokenType.LEFT_BRACKET):
-                index = self.expression()
-                self.consume(TokenType.RIGHT_BRACKET, "Expect ']' after index.")
-                expr = ast_nodes.Index(expr, index)
+                # arr[i] or arr[a:b] (either bound may be omitted)
+                index = None
+                if not self.check(TokenType.COLON):
+                    index = self.expression()
+                if self.match(TokenType.COLON):
+                    end = None
+                    if not self.check(TokenType.RIGHT_BRACKET):
+                        end = self.expression()
+                    self.consume(TokenType.RIGHT_BRACKET, "Expect ']' after slice.")
+                    expr = ast_nodes.Slice(expr, index, end)
+                else:
+                    self.consume(TokenType.RIGHT_BRACKET, "Expect ']' after index.")
+                    expr = ast_nodes.Index(expr, index)
             else:
                 break
         return expr
@@ -445,6 +462,18 @@ class Parser:
             self.consume(TokenType.RIGHT_BRACKET, "Expect ']' after array elements.")
             return ast_nodes.ArrayLiteral(elements)
 
+        if self.match(TokenType.LEFT_BRACE):
+            # Map literal: { key: value, ... }
+            entries = []
+            if not self.check(TokenType.RIGHT_BRACE):
+                while True:
+                    key = self.expression()
+                    self.consume(TokenType.COLON, "Expect ':' after map key.")
+                    entries.append((key, self.expression()))
+                    if not self.match(TokenType.COMMA): break
+            self.consume(TokenType.RIGHT_BRACE, "Expect '}' after map entries.")
+            return ast_nodes.MapLiteral(entries)
+
 
         if self.match(TokenType.LEFT_PAREN):
             expr = self.expression()
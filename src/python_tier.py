@@ -0,0 +1,248 @@
+import re
+import ast_nodes
+import reyna_vals as object
+from token_type import TokenType
+from ssa import Unsupported
+
+# Closure compilation tier: a top-level function's AST is translated to
+# Python source, compiled with compile() and run as an ordinary Python
+# function. Locals become Python locals and loops become Python loops, so
+# there is no per-instruction dispatch left. The generated code works on the
+# VM's own values, globals and natives through the helpers in PythonTier.
+
+NUMERIC = ("int64", "float64")
+
+OPERATORS = {
+    TokenType.MINUS: "-", TokenType.STAR: "*", TokenType.SLASH: "/",
+    TokenType.EQUAL_EQUAL: "==", TokenType.LESS: "<", TokenType.GREATER: ">",
+}
+# Compiled as the negation of another comparison, exactly like the bytecode
+NEGATED = {TokenType.BANG_EQUAL: "==", TokenType.LESS_EQUAL: ">", TokenType.GREATER_EQUAL: "<"}
+
+class PythonCodeGen:
+    """Translate one FnDecl into the source of a Python function. Raises Unsupported."""
+
+    def __init__(self, decl, strings):
+        self.decl = decl
+        self.strings = strings
+        self.constants = {} # Python name -> value bound in the function's namespace
+        self.lines = []
+        self.scopes = [{}]
+        self.names = 0
+
+    def generate(self):
+        params = [self.declare(p_name.lexeme) for p_name, _ in self.decl.params]
+        self.function_name = self.local_name(self.decl.name.lexeme)
+        self.emit(0, f"def {self.function_name}({', '.join(params)}):")
+        self.block(self.decl.body.statements, 1)
+        self.emit(1, "return None")
+        return "\n".join(self.lines)
+
+    def emit(self, depth, line):
+        self.lines.append("    " * depth + line)
+
+    def local_name(self, name):
+        self.names += 1
+        return f"{re.sub(r'[^0-9A-Za-z_]', '_', name)}_{self.names}"
+
+    def declare(self, name):
+        python_name = self.local_name(name)
+        self.scopes[-1][name] = python_name
+        return python_name
+
+    def lookup(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return None
+
+    def constant(self, value):
+        name = f"k{len(self.constants)}"
+        self.constants[name] = value
+        return name
+
+    # Statements
+
+    def block(self, statements, depth):
+        self.scopes.append({})
+        start = len(self.lines)
+        for stmt in statements:
+            self.statement(stmt, depth)
+        if len(self.lines) == start:
+            self.emit(depth, "pass")
+        self.scopes.pop()
+
+    def statement(self, stmt, depth):
+        if isinstance(stmt, ast_nodes.Block):
+            self.block(stmt.statements, depth)
+        elif isinstance(stmt, ast_nodes.LetStmt):
+            value = self.expression(stmt.initializer) if stmt.initializer else "None"
+            self.emit(depth, f"{self.declare(stmt.name.lexeme)} = {value}")
+        elif isinstance(stmt, ast_nodes.ExprStmt):
+            expr = stmt.expression
+            if isinstance(expr, ast_nodes.Assign) and self.lookup(expr.name.lexeme):
+                self.emit(depth, f"{self.lookup(expr.name.lexeme)} = {self.expression(expr.value)}")
+            else:
+                self.emit(depth, self.expression(expr))
+        elif isinstance(stmt, ast_nodes.Print):
+            self.emit(depth, f"print({self.expression(stmt.expression)})")
+        elif isinstance(stmt, ast_nodes.IfStmt):
+            self.emit(depth, f"if {self.condition(stmt.condition)}:")
+            self.block([stmt.then_branch], depth + 1)
+            if stmt.else_branch:
+                self.emit(depth, "else:")
+                self.block([stmt.else_branch], depth + 1)
+        elif isinstance(stmt, ast_nodes.WhileStmt):
+            self.emit(depth, f"while {self.condition(stmt.condition)}:")
+            self.block([stmt.body], depth + 1)
+        elif isinstance(stmt, ast_nodes.ReturnStmt):
+            self.emit(depth, f"return {self.expression(stmt.value) if stmt.value else 'None'}")
+        elif isinstance(stmt, ast_nodes.ThrowStmt):
+            self.emit(depth, f"raise Thrown({self.expression(stmt.value)})")
+        else:
+            raise Unsupported(type(stmt).__name__)
+
+    # Expressions
+
+    def condition(self, expr):
+        code = self.expression(expr)
+        return code if getattr(expr, "static_type", None) == "bool" else f"truthy({code})"
+
+    def expression(self, expr):
+        if isinstance(expr, ast_nodes.Literal):
+            value = expr.value
+            if isinstance(value, str):
+                return self.constant(self.strings.setdefault(value, object.ObjString(value)))
+            return repr(value)
+        if isinstance(expr, ast_nodes.Grouping):
+            return self.expression(expr.expression)
+        if isinstance(expr, ast_nodes.Variable):
+            local = self.lookup(expr.name.lexeme)
+            return local if local else f"get_global({expr.name.lexeme!r})"
+        if isinstance(expr, ast_nodes.Assign):
+            value = self.expression(expr.value)
+            local = self.lookup(expr.name.lexeme)
+            if local:
+                return f"({local} := {value})"
+            return f"set_global({expr.name.lexeme!r}, {value})"
+        if isinstance(expr, ast_nodes.Binary):
+            left, right = self.expression(expr.left), self.expression(expr.right)
+            op = expr.operator.type
+            if op == TokenType.PLUS:
+                if getattr(expr.left, "static_type", None) in NUMERIC and \
+                        getattr(expr.right, "static_type", None) in NUMERIC:
+                    return f"({left} + {right})"
+                return f"add({left}, {right})"
+            if op in OPERATORS:
+                return f"({left} {OPERATORS[op]} {right})"
+            if op in NEGATED:
+                return f"(not ({left} {NEGATED[op]} {right}))"
+            raise Unsupported(expr.operator.lexeme)
+        if isinstance(expr, ast_nodes.Unary):
+            right = self.expression(expr.right)
+            return f"(-{right})" if expr.operator.type == TokenType.MINUS else f"(not {right})"
+        if isinstance(expr, ast_nodes.Logical):
+            left, right = self.expression(expr.left), self.expression(expr.right)
+            python_op = "and" if expr.operator.type == TokenType.AND else "or"
+            if getattr(expr.left, "static_type", None) == "bool":
+                return f"({left} {python_op} {right})"
+            # Reyna truthiness is not Python's: test the left value explicitly
+            temp = self.local_name("t")
+            if python_op == "and":
+                return f"({right} if truthy({temp} := {left}) else {temp})"
+            return f"({temp} if truthy({temp} := {left}) else {right})"
+        if isinstance(expr, ast_nodes.Call):
+            if getattr(expr, "devirtualized", None):
+                raise Unsupported("devirtualized call")
+            args = [self.expression(expr.callee)] + [self.expression(arg) for arg in expr.arguments]
+            return f"call({', '.join(args)})"
+        if isinstance(expr, ast_nodes.Index):
+            return f"get_index({self.expression(expr.target)}, {self.expression(expr.index)})"
+        if isinstance(expr, ast_nodes.IndexSet):
+            return f"set_index({self.expression(expr.obj)}, {self.expression(expr.index)}, " \
+                   f"{self.expression(expr.value)})"
+        if isinstance(expr, ast_nodes.Get):
+            return f"get_field({self.expression(expr.obj)}, {expr.name.lexeme!r})"
+        if isinstance(expr, ast_nodes.Set):
+            return f"set_field({self.expression(expr.obj)}, {expr.name.lexeme!r}, {self.expression(expr.value)})"
+        if isinstance(expr, ast_nodes.ArrayLiteral):
+            return f"new_array([{', '.join(self.expression(e) for e in expr.elements)}])"
+        if isinstance(expr, ast_nodes.MapLiteral):
+            parts = [self.expression(part) for entry in expr.entries for part in entry]
+            return f"new_map([{', '.join(parts)}])"
+        raise Unsupported(type(expr).__name__)
+
+class PythonTier:
+    """Compiles functions for one RegisterVM and provides the runtime their code calls into."""
+
+    def __init__(self, vm):
+        from register_vm import RuntimeFailure, Thrown
+        self.vm = vm
+        ObjArray, ObjClosure = object.ObjArray, object.ObjClosure
+
+        def result(ok):
+            if not ok:
+                raise RuntimeFailure()
+            return vm.stack.pop()
+
+        def get_global(name):
+            try:
+                return vm.globals[name]
+            except KeyError:
+                print(f"Undefined variable '{name}'.")
+                raise RuntimeFailure() from None
+
+        def truthy(value):
+            if value is None: return False
+            if isinstance(value, bool): return value
+            return value != 0
+
+        def add(a, b):
+            if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+                return a + b
+            return result(vm.add(a, b))
+
+        def call(callee, *args):
+            if type(callee) is ObjClosure:
+                code = callee.function.registers
+                if code is not None and len(args) == code.arity:
+                    return vm.invoke(code, args)
+            return vm.call_out(callee, list(args))
+
+        def get_index(arr, index):
+            if type(arr) is ObjArray and type(index) is int and 0 <= index < len(arr.elements):
+                return arr.elements[index]
+            return result(vm.get_index(arr, index))
+
+        def set_global(name, value):
+            if name in vm.globals:
+                vm.globals[name] = value
+            else:
+                print(f"Undefined variable '{name}'.")
+            return value
+
+        def new_array(elements):
+            arr = ObjArray(elements)
+            vm.gc.allocate(arr)
+            return arr
+
+        def new_map(parts):
+            map_obj = object.ObjMap({vm.intern(parts[k]): parts[k + 1] for k in range(0, len(parts), 2)})
+            vm.gc.allocate(map_obj)
+            return map_obj
+
+        self.namespace = {
+            "get_global": get_global, "Thrown": Thrown, "truthy": truthy, "add": add,
+            "call": call, "get_index": get_index, "set_global": set_global, "new_array": new_array,
+            "new_map": new_map,
+            "set_index": lambda arr, index, value: result(vm.set_index(arr, index, value)),
+            "get_field": lambda obj, name: result(vm.get_field(obj, name)),
+            "set_field": lambda obj, name, value: result(vm.set_field(obj, name, value)),
+        }
+
+    def compile(self, decl):
+        gen = PythonCodeGen(decl, self.vm.strings)
+        source = gen.generate()
+        namespace = dict(self.namespace, **gen.constants)
+        exec(compile(source, f"<reyna {decl.name.lexeme}>", "exec"), namespace)
+        return namespace[gen.function_name]
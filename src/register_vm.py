@@ -0,0 +1,448 @@
+import sys
+import reyna_vals as object
+import ssa
+from vm_core import VM, InterpretResult
+
+# Register machine backend for `--mode regvm`. Top-level functions the SSA
+# builder accepts are compiled to three-address code over a per-call register
+# file (`ADD r1, r2, r3`); everything else, including the script body, stays
+# on the stack VM. The two call each other through RegisterVM.call and
+# RegisterVM.call_out.
+#
+# Register 0 is scratch, 1..arity hold the parameters, then the SSA values
+# (sharing registers where their live ranges allow), then the constants,
+# which are preloaded from a template so no instruction loads them.
+
+class RegOp:
+    MOVE = 0
+    ADD = 1
+    SUB = 2
+    MUL = 3
+    DIV = 4
+    EQ = 5
+    LT = 6
+    GT = 7
+    NOT = 8
+    NEG = 9
+    GET_GLOBAL = 10
+    SET_GLOBAL = 11
+    CALL = 12
+    PRINT = 13
+    GET_INDEX = 14
+    SET_INDEX = 15
+    GET_FIELD = 16
+    SET_FIELD = 17
+    BUILD_ARRAY = 18
+    BUILD_MAP = 19
+    JUMP = 20
+    JUMP_IF_TRUE = 21
+    JUMP_IF_FALSE = 22
+    JUMP_IF_LT = 23   # Compare and branch in one instruction
+    JUMP_UNLESS_LT = 24
+    JUMP_IF_GT = 25
+    JUMP_UNLESS_GT = 26
+    JUMP_IF_EQ = 27
+    JUMP_UNLESS_EQ = 28
+    RETURN = 29
+    THROW = 30
+
+BINARY = {"add": RegOp.ADD, "sub": RegOp.SUB, "mul": RegOp.MUL, "div": RegOp.DIV,
+          "eq": RegOp.EQ, "lt": RegOp.LT, "gt": RegOp.GT}
+# (compare, jump when it holds) -> fused branch
+FUSED = {("lt", True): RegOp.JUMP_IF_LT, ("lt", False): RegOp.JUMP_UNLESS_LT,
+         ("gt", True): RegOp.JUMP_IF_GT, ("gt", False): RegOp.JUMP_UNLESS_GT,
+         ("eq", True): RegOp.JUMP_IF_EQ, ("eq", False): RegOp.JUMP_UNLESS_EQ}
+
+class RegisterCode:
+    def __init__(self, name, arity, code, template, decl=None):
+        self.name = name
+        self.arity = arity
+        self.code = code         # (op, a, b, c) tuples; jump targets are instruction indexes
+        self.template = template # Initial register file: None, then the constants
+        self.decl = decl         # FnDecl for the Python tier; None once promotion was tried
+        self.python = None       # The Python tier's function, once promoted
+        self.calls = 0
+
+    def disassemble(self):
+        names = {v: k for k, v in vars(RegOp).items() if not k.startswith("_")}
+        print(f"== {self.name} ({len(self.template)} registers) ==")
+        for pc, (op, a, b, c) in enumerate(self.code):
+            operands = ", ".join(repr(x) for x in (a, b, c) if x is not None)
+            print(f"{pc:04d} {names[op]:<15} {operands}")
+
+class RegisterCompiler(ssa.Lowering):
+    """Lower an optimized SSA function to register code.
+
+    Slot allocation is the stack lowering's; nothing is folded except a
+    comparison feeding its own block's branch, which becomes a fused
+    compare-and-jump. A back edge into a loop header that only tests its
+    condition repeats the test instead of jumping to it.
+    """
+
+    def lower(self):
+        fn = self.fn
+        ssa.split_critical_edges(fn)
+        self.order = ssa.reverse_postorder(fn)
+        self.users = ssa.use_def(fn)
+        self.folded = self.fuse_compares()
+        self.range_loops = {}
+        self.allocate_slots()
+        self.constants = {}
+        self.registers = [None] * self.slot_count
+        self.code = []
+
+        starts = {}
+        for position, block in enumerate(self.order):
+            starts[block] = len(self.code)
+            following = self.order[position + 1] if position + 1 < len(self.order) else None
+            for instr in block.instrs:
+                if instr.op != "const" and instr not in self.folded:
+                    self.instruction(instr)
+            term = block.term
+            if term.op in ("return", "throw"):
+                self.emit(RegOp.RETURN if term.op == "return" else RegOp.THROW, self.reg(term.args[0]))
+            elif term.op == "jump":
+                target = term.targets[0]
+                self.phi_moves(block, target)
+                if target in starts and self.only_tests(target):
+                    self.branch(target.term, following)
+                elif target is not following:
+                    self.emit(RegOp.JUMP, target)
+            else:
+                self.branch(term, following)
+        code = [tuple(starts[x] if isinstance(x, ssa.BasicBlock) else x for x in ins) for ins in self.code]
+        if len(self.registers) > 0xffff:
+            raise ssa.Unsupported("too many registers")
+        return RegisterCode(fn.name, fn.arity, code, self.registers)
+
+    def fuse_compares(self):
+        fused = set()
+        for block in self.fn.blocks:
+            cond = block.term.args[0] if block.term.op == "branch" else None
+            if cond is None or not block.instrs or block.instrs[-1] is not cond or self.users[cond] != [block.term]:
+                continue
+            if cond.op == "not" and len(block.instrs) > 1 and block.instrs[-2] is cond.args[0] \
+                    and cond.args[0].op in ("lt", "gt", "eq") and self.users[cond.args[0]] == [cond]:
+                fused.update((cond, cond.args[0]))
+            elif cond.op in ("lt", "gt", "eq"):
+                fused.add(cond)
+        return fused
+
+    def only_tests(self, block):
+        return block.term.op == "branch" and all(i in self.folded for i in block.instrs)
+
+    def reg(self, value):
+        if value.op == "const":
+            key = (type(value.attr), value.attr)
+            if key not in self.constants:
+                constant = value.attr
+                if isinstance(constant, str):
+                    constant = self.strings.setdefault(constant, object.ObjString(constant))
+                self.constants[key] = len(self.registers)
+                self.registers.append(constant)
+            return self.constants[key]
+        return self.slots[value]
+
+    def emit(self, op, a=None, b=None, c=None):
+        self.code.append((op, a, b, c))
+
+    def instruction(self, instr):
+        dest = self.slots.get(instr, 0)
+        args = [self.reg(arg) for arg in instr.args]
+        op = instr.op
+        if op in BINARY:
+            self.emit(BINARY[op], dest, *args)
+        elif op == "not":
+            self.emit(RegOp.NOT, dest, args[0])
+        elif op == "neg":
+            self.emit(RegOp.NEG, dest, args[0])
+        elif op == "copy":
+            self.emit(RegOp.MOVE, dest, args[0])
+        elif op == "global":
+            self.emit(RegOp.GET_GLOBAL, dest, instr.attr)
+        elif op == "set_global":
+            self.emit(RegOp.SET_GLOBAL, args[0], instr.attr)
+        elif op == "call":
+            self.emit(RegOp.CALL, dest, args[0], tuple(args[1:]))
+        elif op == "print":
+            self.emit(RegOp.PRINT, args[0])
+        elif op == "index":
+            self.emit(RegOp.GET_INDEX, dest, args[0], args[1])
+        elif op == "set_index":
+            self.emit(RegOp.SET_INDEX, *args)
+        elif op == "get_field":
+            self.emit(RegOp.GET_FIELD, dest, args[0], instr.attr)
+        elif op == "set_field":
+            self.emit(RegOp.SET_FIELD, args[0], instr.attr, args[1])
+        elif op == "build_array":
+            self.emit(RegOp.BUILD_ARRAY, dest, tuple(args))
+        elif op == "build_map":
+            self.emit(RegOp.BUILD_MAP, dest, tuple(args))
+        else:
+            raise ssa.Unsupported(op)
+
+    def branch(self, term, following):
+        then_block, else_block = term.targets
+        cond, holds = term.args[0], True
+        if cond.op == "not" and cond in self.folded:
+            cond, holds = cond.args[0], False
+        if then_block is following:
+            # Fall into the then-block, jump away when the condition fails
+            target, holds = else_block, not holds
+        else:
+            target = then_block
+        if cond in self.folded:
+            self.emit(FUSED[(cond.op, holds)], self.reg(cond.args[0]), self.reg(cond.args[1]), target)
+        else:
+            self.emit(RegOp.JUMP_IF_TRUE if holds else RegOp.JUMP_IF_FALSE, self.reg(cond), target)
+        if target is then_block and else_block is not following:
+            self.emit(RegOp.JUMP, else_block)
+
+    def phi_moves(self, block, target):
+        """Emit the phi copies on an edge as a parallel move, breaking cycles through register 0."""
+        k = target.preds.index(block)
+        pending = {self.slots[phi]: self.reg(phi.args[k]) for phi in target.phis}
+        pending = {dest: src for dest, src in pending.items() if dest != src}
+        while pending:
+            sources = set(pending.values())
+            ready = [dest for dest in pending if dest not in sources]
+            if ready:
+                for dest in ready:
+                    self.emit(RegOp.MOVE, dest, pending.pop(dest))
+                continue
+            # Only cycles remain: park one value in scratch and redirect its readers
+            dest, src = next(iter(pending.items()))
+            self.emit(RegOp.MOVE, 0, src)
+            pending = {d: (0 if s == src else s) for d, s in pending.items()}
+
+def compile_function(decl, strings, unchecked=(), verbose=False):
+    """Build, optimize and lower a top-level FnDecl to register code. Raises ssa.Unsupported."""
+    fn = ssa.Builder(decl, unchecked).build()
+    ssa.PassManager(verbose=verbose).run(fn)
+    code = RegisterCompiler(fn, strings).lower()
+    code.decl = decl
+    return code
+
+class RuntimeFailure(Exception):
+    """A runtime error inside register code; the message has already been printed."""
+
+class Thrown(Exception):
+    """A Reyna exception travelling out of register code."""
+    def __init__(self, value):
+        super().__init__(value)
+        self.value = value
+
+class RegisterVM(VM):
+    """The stack VM plus register functions.
+
+    A register function that has been called promote_after times is
+    compiled to Python by the closure tier (python_tier.py); 0 promotes
+    every function on its first call, None never promotes.
+    """
+    HOT_CALLS = 100
+
+    def __init__(self, promote_after=HOT_CALLS, verbose=False):
+        super().__init__()
+        self.promote_after = promote_after
+        self.verbose = verbose
+        self.python_tier = None
+        # Register and Python-tier functions call each other with Python calls
+        sys.setrecursionlimit(max(sys.getrecursionlimit(), 30000))
+
+    def call(self, closure, arg_count):
+        code = closure.function.registers
+        if code is None:
+            return super().call(closure, arg_count)
+        if arg_count != code.arity:
+            print(f"Expected {code.arity} arguments but got {arg_count}.")
+            return False
+        base = len(self.stack) - arg_count
+        args = self.stack[base:]
+        del self.stack[base - 1:]
+        try:
+            result = self.invoke(code, args)
+        except RuntimeFailure:
+            return False
+        except RecursionError:
+            if self.frame_floor:
+                raise # Report it from the outermost register call, where the stack has room
+            print("Stack overflow.")
+            return False
+        except Thrown as thrown:
+            # Raised as if by the call instruction in the calling stack frame
+            if self.throw(thrown.value):
+                return True
+            if self.frame_floor:
+                raise
+            self.uncaught(thrown.value)
+            return False
+        self.push(result)
+        return True
+
+    def invoke(self, code, args):
+        """Run a register function in its fastest available tier."""
+        if code.python is not None:
+            return code.python(*args)
+        code.calls += 1
+        if code.decl is not None and self.promote_after is not None and code.calls > self.promote_after:
+            self.promote(code)
+            if code.python is not None:
+                return code.python(*args)
+        return self.execute(code, args)
+
+    def promote(self, code):
+        from python_tier import PythonTier
+        if self.python_tier is None:
+            self.python_tier = PythonTier(self)
+        try:
+            code.python = self.python_tier.compile(code.decl)
+        except ssa.Unsupported as e:
+            if self.verbose:
+                print(f"tier: {code.name} stays on the register VM ({e})")
+        else:
+            if self.verbose:
+                print(f"tier: {code.name} compiled to Python after {code.calls} call(s)")
+        code.decl = None
+
+    def uncaught(self, exception):
+        if self.frame_floor:
+            # Escaped the stack frames a register function called into
+            raise Thrown(exception)
+        return super().uncaught(exception)
+
+    def call_out(self, callee, args):
+        """Call any value from register code and return its result."""
+        base = len(self.stack)
+        depth = len(self.frames)
+        self.stack.append(callee)
+        self.stack.extend(args)
+        try:
+            if not self.call_value(callee, len(args)):
+                raise RuntimeFailure()
+            if len(self.frames) > depth:
+                # A stack-VM function: run it to its return
+                floor, self.frame_floor = self.frame_floor, depth
+                try:
+                    result = self.run()
+                finally:
+                    self.frame_floor = floor
+                if result != InterpretResult.OK:
+                    raise RuntimeFailure()
+            return self.stack.pop()
+        finally:
+            del self.stack[base:]
+
+    def result(self, ok):
+        """Pop what a shared VM helper pushed, or fail if it reported an error."""
+        if not ok:
+            raise RuntimeFailure()
+        return self.stack.pop()
+
+    def execute(self, function, args):
+        regs = function.template[:]
+        regs[1:1 + len(args)] = args
+        code = function.code
+        globals = self.globals
+        ObjArray, ObjClosure = object.ObjArray, object.ObjClosure
+        pc = 0
+        while True:
+            op, a, b, c = code[pc]
+            pc += 1
+            if op == RegOp.MOVE:
+                regs[a] = regs[b]
+            elif op == RegOp.ADD:
+                x = regs[b]
+                y = regs[c]
+                if isinstance(x, (int, float)) and isinstance(y, (int, float)):
+                    regs[a] = x + y
+                else:
+                    regs[a] = self.result(self.add(x, y))
+            elif op == RegOp.JUMP_UNLESS_LT:
+                if not regs[a] < regs[b]:
+                    pc = c
+            elif op == RegOp.JUMP_IF_LT:
+                if regs[a] < regs[b]:
+                    pc = c
+            elif op == RegOp.SUB:
+                regs[a] = regs[b] - regs[c]
+            elif op == RegOp.MUL:
+                regs[a] = regs[b] * regs[c]
+            elif op == RegOp.GET_INDEX:
+                arr = regs[b]
+                index = regs[c]
+                if type(arr) is ObjArray and type(index) is int and 0 <= index < len(arr.elements):
+                    regs[a] = arr.elements[index]
+                else:
+                    regs[a] = self.result(self.get_index(arr, index))
+            elif op == RegOp.JUMP:
+                pc = a
+            elif op == RegOp.JUMP_IF_FALSE:
+                if not self.is_truthy(regs[a]):
+                    pc = b
+            elif op == RegOp.JUMP_IF_TRUE:
+                if self.is_truthy(regs[a]):
+                    pc = b
+            elif op == RegOp.JUMP_UNLESS_GT:
+                if not regs[a] > regs[b]:
+                    pc = c
+            elif op == RegOp.JUMP_IF_GT:
+                if regs[a] > regs[b]:
+                    pc = c
+            elif op == RegOp.JUMP_UNLESS_EQ:
+                if not regs[a] == regs[b]:
+                    pc = c
+            elif op == RegOp.JUMP_IF_EQ:
+                if regs[a] == regs[b]:
+                    pc = c
+            elif op == RegOp.LT:
+                regs[a] = regs[b] < regs[c]
+            elif op == RegOp.GT:
+                regs[a] = regs[b] > regs[c]
+            elif op == RegOp.EQ:
+                regs[a] = regs[b] == regs[c]
+            elif op == RegOp.DIV:
+                regs[a] = regs[b] / regs[c]
+            elif op == RegOp.NOT:
+                regs[a] = not regs[b]
+            elif op == RegOp.NEG:
+                regs[a] = -regs[b]
+            elif op == RegOp.CALL:
+                callee = regs[b]
+                if type(callee) is ObjClosure and callee.function.registers is not None \
+                        and len(c) == callee.function.arity:
+                    regs[a] = self.invoke(callee.function.registers, [regs[r] for r in c])
+                else:
+                    regs[a] = self.call_out(callee, [regs[r] for r in c])
+            elif op == RegOp.GET_GLOBAL:
+                if b not in globals:
+                    print(f"Undefined variable '{b}'.")
+                    raise RuntimeFailure()
+                regs[a] = globals[b]
+            elif op == RegOp.SET_GLOBAL:
+                if b in globals:
+                    globals[b] = regs[a]
+                else:
+                    print(f"Undefined variable '{b}'.")
+            elif op == RegOp.RETURN:
+                return regs[a]
+            elif op == RegOp.PRINT:
+                print(regs[a])
+            elif op == RegOp.SET_INDEX:
+                self.result(self.set_index(regs[a], regs[b], regs[c]))
+            elif op == RegOp.GET_FIELD:
+                regs[a] = self.result(self.get_field(regs[b], c))
+            elif op == RegOp.SET_FIELD:
+                self.result(self.set_field(regs[a], b, regs[c]))
+            elif op == RegOp.BUILD_ARRAY:
+                arr = ObjArray([regs[r] for r in b])
+                self.gc.allocate(arr)
+                regs[a] = arr
+            elif op == RegOp.BUILD_MAP:
+                entries = {}
+                for k in range(0, len(b), 2):
+                    entries[self.intern(regs[b[k]])] = regs[b[k + 1]]
+                map_obj = object.ObjMap(entries)
+                self.gc.allocate(map_obj)
+                regs[a] = map_obj
+            elif op == RegOp.THROW:
+                raise Thrown(regs[a])
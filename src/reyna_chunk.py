@@ -6,6 +6,7 @@ class OpCode(Enum):
     OP_TRUE = auto()
     OP_FALSE = auto()
     OP_POP = auto()
+    OP_DUP = auto()
     OP_GET_LOCAL = auto()
     OP_SET_LOCAL = auto()
     OP_GET_GLOBAL = auto()
@@ -23,34 +24,78 @@ class OpCode(Enum):
     OP_PRINT = auto()
     OP_JUMP = auto()
     OP_JUMP_IF_FALSE = auto()
+    OP_JUMP_IF_TRUE = auto()
+    OP_POP_JUMP_IF_FALSE = auto() # Fused condition + pop for branches
+    OP_POP_JUMP_IF_TRUE = auto()
+    OP_MATCH_TABLE = auto() # Pop a value and jump through a JumpTable constant
     OP_LOOP = auto()
+    OP_FOR_RANGE = auto() # Increment, compare and branch back via a RangeLoop constant
     OP_CALL = auto()
     OP_RETURN = auto()
     OP_GET_FIELD = auto()
     OP_SET_FIELD = auto()
     OP_STRUCT = auto()
     OP_BUILD_ARRAY = auto()
+    OP_BUILD_MAP = auto()
     OP_GET_INDEX = auto()
+    OP_GET_INDEX_UNCHECKED = auto() # a[i] with i proven non-negative
     OP_SET_INDEX = auto()
+    OP_SLICE = auto()
     OP_CLOSURE = auto()
     OP_GET_UPVALUE = auto()
     OP_SET_UPVALUE = auto()
+    OP_GET_UPVALUE_DIRECT = auto() # Non-escaping closure: upvalue is a stack slot
+    OP_SET_UPVALUE_DIRECT = auto()
     OP_CLOSE_UPVALUE = auto()
     OP_CLASS = auto()
     OP_METHOD = auto()
     OP_INHERIT = auto()
+    OP_INVOKE_DIRECT = auto() # Call a statically resolved method closure on the receiver
     OP_GET_SUPER = auto()
     
-    # Error handling
-    OP_TRY_BEGIN = auto()   # Push exception handler
-    OP_TRY_END = auto()     # Pop exception handler
+    # Error handling (try blocks are described by Chunk.exception_table)
     OP_THROW = auto()       # Throw exception
 
+class ExceptionTableEntry:
+    def __init__(self, start, end, handler, stack_depth):
+        self.start = start             # First offset covered by the try block
+        self.end = end                 # One past the last covered offset
+        self.handler = handler         # Offset of the catch block
+        self.stack_depth = stack_depth # Stack slots in use (relative to the frame) at try entry
+
+class JumpTable:
+    def __init__(self, targets, default):
+        self.targets = targets # Case value (int or str) -> code offset
+        self.default = default # Offset taken when no case value matches
+
+    def __repr__(self):
+        return f"<jump table {len(self.targets)} cases>"
+
+class RangeLoop:
+    """Operands of one OP_FOR_RANGE, kept as a constant so the VM decodes a single byte."""
+    LIMIT_CONSTANT = 0
+    LIMIT_LOCAL = 1
+    LIMIT_GLOBAL = 2
+
+    def __init__(self, slot, step, compare, limit_kind, limit, body_start):
+        self.slot = slot             # Local slot of the induction variable
+        self.step = step             # Added to the variable every iteration
+        self.compare = compare       # operator.lt/le/gt/ge applied as compare(i, limit)
+        self.limit_kind = limit_kind
+        self.limit = limit           # The constant, local slot or global name
+        self.body_start = body_start # Offset to branch back to while compare holds
+
+    def __repr__(self):
+        return f"<range loop slot={self.slot} step={self.step}>"
+
 class Chunk:
     def __init__(self):
         self.code = []
         self.lines = []
         self.constants = []
+        # Static try/catch ranges, innermost first. Nothing runs on entry to a
+        # try block; OP_THROW searches this table while unwinding.
+        self.exception_table = []
 
     def write(self, byte, line):
         self.code.append(byte)
@@ -23,6 +23,7 @@ class GC:
         
         self.mark_roots()
         self.trace_references()
+        self.remove_white_strings()
         self.sweep()
         
         after = len(self.heap)
@@ -36,7 +37,7 @@ class GC:
         # Globals
         for name, value in self.vm.globals.items():
             self.mark_value(value)
-        
+
         # Locals (if any tracked outside stack)
         pass
 
@@ -58,11 +59,28 @@ class GC:
         if isinstance(obj, object.ObjInstance):
             for field in obj.fields.values():
                 self.mark_value(field)
+        elif isinstance(obj, object.ObjArray):
+            for element in obj.elements:
+                self.mark_value(element)
+        elif isinstance(obj, object.ObjMap):
+            for key, value in obj.entries.items():
+                self.mark_value(key)
+                self.mark_value(value)
+        elif isinstance(obj, object.ObjArrayView):
+            # Keep the shared parent buffer alive for as long as the view is
+            self.mark_object(obj.array)
         elif isinstance(obj, object.ObjFunction):
              # Mark upvalues or constants? 
              pass
         # Strings have no outgoing refs
 
+    def remove_white_strings(self):
+        # The intern table holds its strings weakly: drop the ones nothing reached,
+        # so keys built at run time don't live for the rest of the process
+        strings = self.vm.strings
+        for key in [key for key, value in strings.items() if not value.marked]:
+            del strings[key]
+
     def sweep(self):
         # Remove unmarked objects
         # In Python list, efficient removal is tricky. Rebuild list?
@@ -9,6 +9,8 @@ class ObjType(Enum):
     CLASS = auto()
     BOUND_METHOD = auto()
     ARRAY = auto()
+    ARRAY_VIEW = auto()
+    MAP = auto()
 
 
 
@@ -27,6 +29,7 @@ class ObjString(Obj):
     def __init__(self, value):
         super().__init__(ObjType.STRING)
         self.value = value
+        self.hash = hash(value) # Cached so map lookups don't rehash
     
     def __repr__(self):
         return f"'{self.value}'"
@@ -35,10 +38,10 @@ class ObjString(Obj):
         return self.value
     
     def __hash__(self):
-        return hash(self.value)
+        return self.hash
 
     def __eq__(self, other):
-        return isinstance(other, ObjString) and self.value == other.value
+        return self is other or (isinstance(other, ObjString) and self.value == other.value)
 
 class ObjStruct(Obj):
     def __init__(self, name):
@@ -48,12 +51,57 @@ class ObjStruct(Obj):
     def __repr__(self):
         return f"<struct {self.name}>"
 
+# Element types of arrays packed into an array.array buffer for native code
+PACKED_TYPES = {"q": int, "d": float}
+
 class ObjArray(Obj):
     def __init__(self, elements):
         super().__init__(ObjType.ARRAY)
-        self.elements = elements
-    def __repr__(self): return str(self.elements)
-    def __str__(self): return str(self.elements)
+        self.elements = elements # A list, or an array.array once packed (see native_lib.pack)
+    def __repr__(self): return str(self.elements if type(self.elements) is list else self.elements.tolist())
+    def __str__(self): return self.__repr__()
+
+    def writable(self, values):
+        """Return elements ready to store values, unpacking a packed buffer that cannot hold them."""
+        elements = self.elements
+        if type(elements) is not list:
+            kind = PACKED_TYPES[elements.typecode]
+            if not all(type(v) is kind and (kind is float or -2 ** 63 <= v < 2 ** 63) for v in values):
+                elements = self.elements = elements.tolist()
+        return elements
+
+class ObjArrayView(Obj):
+    """A window [start, start + length) onto another array's buffer.
+
+    Reads go straight to the parent's list. The first write copies the
+    window into a private ObjArray (copy-on-write), so the parent is never
+    modified through a view.
+    """
+    def __init__(self, array, start, length):
+        super().__init__(ObjType.ARRAY_VIEW)
+        self.array = array # Parent ObjArray (shared until first write)
+        self.start = start
+        self.length = length
+        self.owns_buffer = False
+
+    def window(self):
+        return self.array.elements[self.start:self.start + self.length]
+
+    def __repr__(self):
+        window = self.window()
+        return str(window if type(window) is list else window.tolist())
+    def __str__(self): return self.__repr__()
+
+class ObjMap(Obj):
+    def __init__(self, entries=None):
+        super().__init__(ObjType.MAP)
+        # key -> value. String keys are interned ObjStrings, so lookups with
+        # an interned key hit the dict's identity fast path.
+        self.entries = entries if entries is not None else {}
+
+    def __repr__(self):
+        return "{" + ", ".join(f"{k!r}: {v!r}" for k, v in self.entries.items()) + "}"
+    def __str__(self): return self.__repr__()
 
 class ObjInstance(Obj):
     def __init__(self, struct):
@@ -71,6 +119,11 @@ class ObjFunction(Obj):
         self.arity = arity
         self.chunk = chunk
         self.upvalue_count = upvalue_count
+        self.upvalue_descriptors = [] # (is_local, index, direct) per upvalue
+        self.registers = None # RegisterCode when compiled for the register VM
+        self.decl = None # FnDecl of a top-level function under --mode tiered
+        self.native = None # NativeFunction once the tiered VM has JIT-compiled it
+        self.calls = 0
     
     def __repr__(self):
         return f"<fn {self.name}>"
@@ -89,7 +142,7 @@ class ObjClosure(Obj):
     def __init__(self, function):
         super().__init__(ObjType.FUNCTION)
         self.function = function
-        self.upvalues = [] # List of ObjUpvalue
+        self.upvalues = [] # ObjUpvalue, or an absolute stack slot for direct captures
         
     def __repr__(self):
         return f"<closure {self.function.name}>"
@@ -0,0 +1,957 @@
+import operator
+import ast_nodes
+import reyna_vals as object
+from token_type import TokenType, Token
+from reyna_chunk import OpCode, Chunk, RangeLoop
+
+# SSA middle end: a control-flow graph of SSA values per function, built from
+# the AST, improved by a pipeline of passes and lowered back to Chunk bytecode.
+#
+# Each Instr is the value it defines. Phis sit at the top of a block and take
+# one argument per predecessor, in block.preds order. Every block ends in a
+# terminator: jump, branch (cond, [then, else]), return or throw.
+
+class Unsupported(Exception):
+    """The function uses something the IR does not model; compile it directly instead."""
+
+# Operations by how freely passes may touch them
+PURE_OPS = {"const", "param", "phi", "copy", "add", "sub", "mul", "div", "neg", "not", "eq", "lt", "gt"}
+LOAD_OPS = {"global", "index", "get_field"}   # Read memory: no effects, but order matters
+EFFECT_OPS = {"set_global", "call", "print", "set_index", "set_field", "build_array", "build_map"}
+COMMUTATIVE = {"mul", "eq"}
+NUMERIC = ("int64", "float64")
+
+BINARY_OPS = {
+    TokenType.PLUS: "add", TokenType.MINUS: "sub", TokenType.STAR: "mul", TokenType.SLASH: "div",
+    TokenType.EQUAL_EQUAL: "eq", TokenType.LESS: "lt", TokenType.GREATER: "gt",
+}
+NEGATED_OPS = {TokenType.BANG_EQUAL: "eq", TokenType.LESS_EQUAL: "gt", TokenType.GREATER_EQUAL: "lt"}
+LINE_TOKENS = ("keyword", "operator", "name", "paren")
+
+# --- IR ---
+
+class Instr:
+    def __init__(self, op, args=(), attr=None, line=0):
+        self.op = op
+        self.args = list(args)
+        self.attr = attr          # Constant value, global/field name, param index or arg count
+        self.line = line
+        self.block = None
+        self.targets = []         # Successor blocks, terminators only
+        self.static_type = None   # From the type checker, when known
+        self.id = 0
+
+    def can_raise(self):
+        """False only for operations that provably cannot fail at run time."""
+        if self.op in ("const", "param", "phi", "copy", "not", "eq"):
+            return False
+        if self.op in ("add", "sub", "mul", "lt", "gt"):
+            return not all(a.static_type in NUMERIC for a in self.args)
+        if self.op == "neg":
+            return self.args[0].static_type not in NUMERIC
+        return True
+
+    def __repr__(self):
+        return f"v{self.id}"
+
+class BasicBlock:
+    def __init__(self, id):
+        self.id = id
+        self.phis = []
+        self.instrs = []
+        self.term = None
+        self.preds = []
+
+    @property
+    def succs(self):
+        return self.term.targets if self.term else []
+
+    def __repr__(self):
+        return f"b{self.id}"
+
+class Function:
+    def __init__(self, name, arity):
+        self.name = name
+        self.arity = arity
+        self.blocks = []
+        self.params = []
+        self.next_id = 0
+
+    @property
+    def entry(self):
+        return self.blocks[0]
+
+    def new_block(self):
+        block = BasicBlock(len(self.blocks) and max(b.id for b in self.blocks) + 1)
+        self.blocks.append(block)
+        return block
+
+    def number(self, instr):
+        self.next_id += 1
+        instr.id = self.next_id
+        return instr
+
+    def instructions(self):
+        for block in self.blocks:
+            yield from block.phis
+            yield from block.instrs
+            if block.term:
+                yield block.term
+
+    def replace_uses(self, old, new):
+        for instr in self.instructions():
+            instr.args = [new if a is old else a for a in instr.args]
+
+    def __str__(self):
+        lines = [f"fn {self.name}({', '.join(map(repr, self.params))}):"]
+        for block in self.blocks:
+            lines.append(f"  {block!r}:  ; preds {block.preds}")
+            for instr in block.phis + block.instrs + [block.term]:
+                if instr is None:
+                    continue
+                attr = "" if instr.attr is None else f" {instr.attr!r}"
+                targets = f" -> {instr.targets}" if instr.targets else ""
+                result = "" if instr is block.term else f"{instr!r} = "
+                lines.append(f"    {result}{instr.op}{attr} {', '.join(map(repr, instr.args))}{targets}")
+        return "\n".join(lines)
+
+# --- Construction (Braun et al., "Simple and Efficient Construction of SSA Form") ---
+
+class Variable:
+    def __init__(self, name):
+        self.name = name
+
+class Builder:
+    """Build SSA for one top-level FnDecl straight from its AST."""
+
+    def __init__(self, decl, unchecked=()):
+        self.decl = decl
+        self.unchecked = unchecked
+        self.fn = Function(decl.name.lexeme, len(decl.params))
+        self.block = None
+        self.line = decl.name.line
+        self.scopes = [{}]
+        self.current_def = {}     # (Variable, block) -> value
+        self.sealed = set()
+        self.incomplete = {}      # block -> {Variable: phi}
+        self.filling = set()      # Phis whose operands add_phi_operands is reading
+        self.constants = {}
+
+    def build(self):
+        self.block = self.fn.new_block()
+        self.sealed.add(self.block)
+        for index, (p_name, p_type) in enumerate(self.decl.params):
+            param = self.fn.number(Instr("param", attr=index + 1, line=p_name.line))
+            param.block = self.block
+            param.static_type = p_type.lexeme
+            self.fn.params.append(param)
+            self.declare(p_name.lexeme, param)
+        self.statement(self.decl.body)
+        if self.block.term is None:
+            self.terminate("return", [self.const(None)])
+        remove_unreachable(self.fn)
+        return self.fn
+
+    # Variables
+
+    def declare(self, name, value):
+        var = Variable(name)
+        self.scopes[-1][name] = var
+        self.current_def[(var, self.block)] = value
+
+    def lookup(self, name):
+        for scope in reversed(self.scopes):
+            if name in scope:
+                return scope[name]
+        return None
+
+    def read_variable(self, var, block):
+        if (var, block) in self.current_def:
+            return self.current_def[(var, block)]
+        if block not in self.sealed:
+            value = self.new_phi(block)
+            self.incomplete.setdefault(block, {})[var] = value
+        elif len(block.preds) == 1:
+            value = self.read_variable(var, block.preds[0])
+        elif not block.preds:
+            value = self.const(None) # Unreachable code
+        else:
+            value = self.new_phi(block)
+            self.current_def[(var, block)] = value
+            value = self.add_phi_operands(var, value)
+        self.current_def[(var, block)] = value
+        return value
+
+    def new_phi(self, block):
+        phi = self.fn.number(Instr("phi", line=self.line))
+        phi.block = block
+        block.phis.append(phi)
+        return phi
+
+    def add_phi_operands(self, var, phi):
+        self.filling.add(phi)
+        for pred in phi.block.preds:
+            # Reading may simplify other phis, and replace_uses then rebuilds phi.args
+            value = self.read_variable(var, pred)
+            phi.args.append(value)
+        self.filling.discard(phi)
+        return self.remove_trivial_phi(phi)
+
+    def complete(self, phi):
+        """Whether phi has all its operands, so that it may be simplified."""
+        return phi not in self.filling and phi not in self.incomplete.get(phi.block, {}).values()
+
+    def remove_trivial_phi(self, phi):
+        same = None
+        for arg in phi.args:
+            if arg is same or arg is phi:
+                continue
+            if same is not None:
+                return phi
+            same = arg
+        if same is None:
+            same = self.const(None)
+        users = [i for i in self.fn.instructions() if phi in i.args and i is not phi]
+        phi.block.phis.remove(phi)
+        self.fn.replace_uses(phi, same)
+        for key, value in self.current_def.items():
+            if value is phi:
+                self.current_def[key] = same
+        for user in users:
+            # A phi still missing operands only looks trivial; it is checked once complete
+            if user.op == "phi" and user in user.block.phis and self.complete(user):
+                self.remove_trivial_phi(user)
+        return same
+
+    def seal(self, block):
+        for var, phi in self.incomplete.pop(block, {}).items():
+            self.add_phi_operands(var, phi)
+        self.sealed.add(block)
+
+    # Instructions and edges
+
+    def const(self, value):
+        key = (type(value), value)
+        if key not in self.constants:
+            instr = self.fn.number(Instr("const", attr=value))
+            instr.block = self.fn.entry
+            instr.static_type = {bool: "bool", int: "int64", float: "float64", str: "string"}.get(type(value))
+            self.fn.entry.instrs.insert(0, instr)
+            self.constants[key] = instr
+        return self.constants[key]
+
+    def emit(self, op, args=(), attr=None, static_type=None):
+        if self.block.term is not None:
+            # Code after a return: keep building into an unreachable block
+            self.block = self.fn.new_block()
+            self.sealed.add(self.block)
+        instr = self.fn.number(Instr(op, args, attr, self.line))
+        instr.block = self.block
+        instr.static_type = static_type
+        self.block.instrs.append(instr)
+        return instr
+
+    def terminate(self, op, args=(), targets=()):
+        if self.block.term is not None:
+            return
+        term = Instr(op, args, line=self.line)
+        term.block = self.block
+        term.targets = list(targets)
+        self.block.term = term
+        for target in targets:
+            target.preds.append(self.block)
+
+    def jump(self, target):
+        self.terminate("jump", targets=[target])
+
+    def branch(self, cond, then_block, else_block):
+        self.terminate("branch", [cond], [then_block, else_block])
+
+    def mark_line(self, node):
+        for attr in LINE_TOKENS:
+            token = getattr(node, attr, None)
+            if isinstance(token, Token):
+                self.line = token.line
+                return
+
+    # Statements
+
+    def statement(self, stmt):
+        self.mark_line(stmt)
+        if isinstance(stmt, ast_nodes.Block):
+            self.scopes.append({})
+            for s in stmt.statements:
+                self.statement(s)
+            self.scopes.pop()
+        elif isinstance(stmt, ast_nodes.LetStmt):
+            value = self.expression(stmt.initializer) if stmt.initializer else self.const(None)
+            self.declare(stmt.name.lexeme, value)
+        elif isinstance(stmt, ast_nodes.ExprStmt):
+            self.expression(stmt.expression)
+        elif isinstance(stmt, ast_nodes.Print):
+            self.emit("print", [self.expression(stmt.expression)])
+        elif isinstance(stmt, ast_nodes.IfStmt):
+            cond = self.expression(stmt.condition)
+            then_block, merge = self.fn.new_block(), self.fn.new_block()
+            else_block = self.fn.new_block() if stmt.else_branch else merge
+            self.branch(cond, then_block, else_block)
+            for block, body in ((then_block, stmt.then_branch), (else_block, stmt.else_branch)):
+                if body is None:
+                    continue
+                self.seal(block)
+                self.block = block
+                self.statement(body)
+                self.jump(merge)
+            self.seal(merge)
+            self.block = merge
+        elif isinstance(stmt, ast_nodes.WhileStmt):
+            header, body, exit = self.fn.new_block(), self.fn.new_block(), self.fn.new_block()
+            self.jump(header)
+            self.block = header
+            self.branch(self.expression(stmt.condition), body, exit)
+            self.seal(body)
+            self.block = body
+            self.statement(stmt.body)
+            self.jump(header)
+            self.seal(header)
+            self.seal(exit)
+            self.block = exit
+        elif isinstance(stmt, ast_nodes.ReturnStmt):
+            value = self.expression(stmt.value) if stmt.value else self.const(None)
+            self.terminate("return", [value])
+        elif isinstance(stmt, ast_nodes.ThrowStmt):
+            self.terminate("throw", [self.expression(stmt.value)])
+        else:
+            raise Unsupported(type(stmt).__name__)
+
+    # Expressions
+
+    def expression(self, expr):
+        self.mark_line(expr)
+        static_type = getattr(expr, "static_type", None)
+        if isinstance(expr, ast_nodes.Literal):
+            return self.const(expr.value)
+        if isinstance(expr, ast_nodes.Grouping):
+            return self.expression(expr.expression)
+        if isinstance(expr, ast_nodes.Variable):
+            var = self.lookup(expr.name.lexeme)
+            if var is not None:
+                return self.read_variable(var, self.block)
+            return self.emit("global", attr=expr.name.lexeme, static_type=static_type)
+        if isinstance(expr, ast_nodes.Assign):
+            value = self.expression(expr.value)
+            var = self.lookup(expr.name.lexeme)
+            if var is not None:
+                self.current_def[(var, self.block)] = value
+            else:
+                self.emit("set_global", [value], expr.name.lexeme)
+            return value
+        if isinstance(expr, ast_nodes.Binary):
+            left, right = self.expression(expr.left), self.expression(expr.right)
+            op = expr.operator.type
+            if op in BINARY_OPS:
+                return self.emit(BINARY_OPS[op], [left, right], static_type=static_type)
+            if op in NEGATED_OPS:
+                return self.emit("not", [self.emit(NEGATED_OPS[op], [left, right], static_type="bool")],
+                                 static_type="bool")
+            raise Unsupported(expr.operator.lexeme)
+        if isinstance(expr, ast_nodes.Unary):
+            right = self.expression(expr.right)
+            return self.emit("neg" if expr.operator.type == TokenType.MINUS else "not", [right],
+                             static_type=static_type)
+        if isinstance(expr, ast_nodes.Logical):
+            left = self.expression(expr.left)
+            left_block = self.block
+            right_block, merge = self.fn.new_block(), self.fn.new_block()
+            if expr.operator.type == TokenType.AND:
+                self.branch(left, right_block, merge)
+            else:
+                self.branch(left, merge, right_block)
+            self.seal(right_block)
+            self.block = right_block
+            right = self.expression(expr.right)
+            self.jump(merge)
+            self.seal(merge)
+            self.block = merge
+            phi = self.new_phi(merge)
+            phi.args = [left if pred is left_block else right for pred in merge.preds]
+            phi.static_type = static_type
+            return phi
+        if isinstance(expr, ast_nodes.Call):
+            if getattr(expr, "devirtualized", None):
+                raise Unsupported("devirtualized call")
+            callee = self.expression(expr.callee)
+            args = [self.expression(arg) for arg in expr.arguments]
+            return self.emit("call", [callee] + args, len(args), static_type)
+        if isinstance(expr, ast_nodes.Index):
+            return self.emit("index", [self.expression(expr.target), self.expression(expr.index)],
+                             expr in self.unchecked)
+        if isinstance(expr, ast_nodes.IndexSet):
+            obj, index, value = self.expression(expr.obj), self.expression(expr.index), self.expression(expr.value)
+            self.emit("set_index", [obj, index, value])
+            return value
+        if isinstance(expr, ast_nodes.Get):
+            return self.emit("get_field", [self.expression(expr.obj)], expr.name.lexeme, static_type)
+        if isinstance(expr, ast_nodes.Set):
+            obj, value = self.expression(expr.obj), self.expression(expr.value)
+            self.emit("set_field", [obj, value], expr.name.lexeme)
+            return value
+        if isinstance(expr, ast_nodes.ArrayLiteral):
+            if len(expr.elements) > 255:
+                raise Unsupported("array literal")
+            return self.emit("build_array", [self.expression(e) for e in expr.elements], len(expr.elements))
+        if isinstance(expr, ast_nodes.MapLiteral):
+            if len(expr.entries) > 255:
+                raise Unsupported("map literal")
+            args = [self.expression(part) for entry in expr.entries for part in entry]
+            return self.emit("build_map", args, len(expr.entries))
+        raise Unsupported(type(expr).__name__)
+
+def remove_unreachable(fn):
+    reachable = set(reverse_postorder(fn))
+    for block in fn.blocks:
+        if block not in reachable:
+            continue
+        for k in reversed(range(len(block.preds))):
+            if block.preds[k] not in reachable:
+                del block.preds[k]
+                for phi in block.phis:
+                    del phi.args[k]
+    fn.blocks = [b for b in fn.blocks if b in reachable]
+    CopyPropagation().run(fn) # Phis may have become trivial
+
+# --- Analyses ---
+
+def reverse_postorder(fn):
+    # Successors are explored last-first so a branch's then-block comes
+    # right after it, which the lowering turns into a fallthrough
+    order, seen = [], set()
+    stack = [(fn.entry, reversed(fn.entry.succs))]
+    seen.add(fn.entry)
+    while stack:
+        block, succs = stack[-1]
+        for succ in succs:
+            if succ not in seen:
+                seen.add(succ)
+                stack.append((succ, reversed(succ.succs)))
+                break
+        else:
+            stack.pop()
+            order.append(block)
+    order.reverse()
+    return order
+
+def dominators(fn):
+    """Immediate dominators (Cooper, Harvey & Kennedy). Returns {block: idom}; the entry maps to None."""
+    order = reverse_postorder(fn)
+    index = {block: i for i, block in enumerate(order)}
+    idom = {fn.entry: fn.entry}
+
+    def intersect(a, b):
+        while a is not b:
+            while index[a] > index[b]:
+                a = idom[a]
+            while index[b] > index[a]:
+                b = idom[b]
+        return a
+
+    changed = True
+    while changed:
+        changed = False
+        for block in order[1:]:
+            preds = [p for p in block.preds if p in idom]
+            new = preds[0]
+            for pred in preds[1:]:
+                new = intersect(pred, new)
+            if idom.get(block) is not new:
+                idom[block] = new
+                changed = True
+    idom[fn.entry] = None
+    return idom
+
+def dominator_tree(fn):
+    children = {block: [] for block in fn.blocks}
+    for block, parent in dominators(fn).items():
+        if parent is not None:
+            children[parent].append(block)
+    return children
+
+def use_def(fn):
+    """Map each value to the instructions (terminators included) that use it."""
+    users = {instr: [] for instr in fn.instructions()}
+    users.update({param: [] for param in fn.params})
+    for instr in fn.instructions():
+        for arg in instr.args:
+            users.setdefault(arg, []).append(instr)
+    return users
+
+def liveness(fn, operands=lambda instr: instr.args):
+    """Live-in/live-out value sets per block.
+
+    A phi argument is live out of the predecessor it flows from, not live
+    into the phi's block. `operands` lets a client redefine which values an
+    instruction reads (the lowering folds some operands into their user).
+    """
+    defs, uses = {}, {}
+    for block in fn.blocks:
+        defined, used = set(block.phis), set()
+        for instr in block.instrs + ([block.term] if block.term else []):
+            used.update(v for v in operands(instr) if v not in defined)
+            defined.add(instr)
+        defs[block], uses[block] = defined, used
+    live_in = {block: set() for block in fn.blocks}
+    live_out = {block: set() for block in fn.blocks}
+    changed = True
+    while changed:
+        changed = False
+        for block in reversed(reverse_postorder(fn)):
+            out = set()
+            for succ in block.succs:
+                out |= live_in[succ] - set(succ.phis)
+                k = succ.preds.index(block)
+                out.update(v for phi in succ.phis for v in operands_of_phi(phi, k, operands))
+            new_in = uses[block] | (out - defs[block]) | set(block.phis)
+            if out != live_out[block] or new_in != live_in[block]:
+                live_out[block], live_in[block] = out, new_in
+                changed = True
+    return live_in, live_out
+
+def operands_of_phi(phi, k, operands):
+    # A phi argument is read at the end of its predecessor like any operand
+    carrier = Instr("copy", [phi.args[k]])
+    return operands(carrier)
+
+# --- Passes ---
+
+class Pass:
+    name = "pass"
+
+    def run(self, fn):
+        """Transform fn in place; return the number of changes made."""
+        raise NotImplementedError
+
+class PassManager:
+    def __init__(self, passes=None, verbose=False):
+        self.passes = passes if passes is not None else default_pipeline()
+        self.verbose = verbose
+
+    def run(self, fn):
+        for p in self.passes:
+            changes = p.run(fn)
+            if self.verbose and changes:
+                print(f"ssa: {fn.name}: {p.name} made {changes} change(s)")
+        return fn
+
+class CopyPropagation(Pass):
+    """Forward `copy` instructions and trivial phis to their single source."""
+    name = "copy-propagation"
+
+    def run(self, fn):
+        changes = 0
+        changed = True
+        while changed:
+            changed = False
+            for block in fn.blocks:
+                for instr in list(block.phis) + list(block.instrs):
+                    source = None
+                    if instr.op == "copy":
+                        source = instr.args[0]
+                    elif instr.op == "phi":
+                        distinct = {id(a): a for a in instr.args if a is not instr}
+                        if len(distinct) == 1:
+                            source = next(iter(distinct.values()))
+                    if source is None:
+                        continue
+                    (block.phis if instr.op == "phi" else block.instrs).remove(instr)
+                    fn.replace_uses(instr, source)
+                    changes += 1
+                    changed = True
+        return changes
+
+class GlobalValueNumbering(Pass):
+    """Replace recomputations of a pure value with a copy of the dominating one.
+
+    Pure operations are numbered along the dominator tree. Loads are only
+    numbered within a block and forgotten at the first effect.
+    """
+    name = "gvn"
+
+    def run(self, fn):
+        self.changes = 0
+        self.children = dominator_tree(fn)
+        self.visit(fn.entry, {})
+        return self.changes
+
+    def visit(self, block, table):
+        table = dict(table)
+        loads = {}
+        for phi in block.phis:
+            self.number(phi, ("phi", block.id) + tuple(leader_of(a).id for a in phi.args), table)
+        for instr in block.instrs:
+            if instr.op in EFFECT_OPS:
+                loads.clear()
+            elif instr.op in LOAD_OPS:
+                self.number(instr, self.key(instr), loads)
+            elif instr.op in PURE_OPS and instr.op not in ("param", "copy"):
+                self.number(instr, self.key(instr), table)
+        for child in self.children[block]:
+            self.visit(child, table)
+
+    def key(self, instr):
+        if instr.op == "const":
+            return ("const", type(instr.attr), instr.attr)
+        ids = [leader_of(a).id for a in instr.args]
+        if instr.op in COMMUTATIVE:
+            ids.sort()
+        return (instr.op, instr.attr) + tuple(ids)
+
+    def number(self, instr, key, table):
+        leader = table.get(key)
+        if leader is None:
+            table[key] = instr
+        elif leader is not instr:
+            instr.op, instr.args, instr.attr = "copy", [leader], None
+            self.changes += 1
+
+def leader_of(value):
+    while value.op == "copy":
+        value = value.args[0]
+    return value
+
+class DeadCodeElimination(Pass):
+    """Drop values nobody uses whose evaluation cannot fail or have effects."""
+    name = "dce"
+
+    def run(self, fn):
+        changes = 0
+        changed = True
+        while changed:
+            changed = False
+            users = use_def(fn)
+            for block in fn.blocks:
+                for instr in list(block.phis) + list(block.instrs):
+                    if instr.op in EFFECT_OPS or instr.can_raise() or users.get(instr):
+                        continue
+                    (block.phis if instr.op == "phi" else block.instrs).remove(instr)
+                    changes += 1
+                    changed = True
+        return changes
+
+class DeadStoreElimination(Pass):
+    """Remove a global store overwritten later in the same block before anything can observe it.
+
+    Reads of the global, calls, and anything that might raise (a caller's
+    catch block could read the global) make the earlier store observable.
+    """
+    name = "dead-store-elimination"
+
+    def run(self, fn):
+        changes = 0
+        for block in fn.blocks:
+            pending = {} # global name -> store not yet observed
+            for instr in list(block.instrs):
+                if instr.op == "set_global":
+                    if instr.attr in pending:
+                        block.instrs.remove(pending[instr.attr])
+                        changes += 1
+                    pending[instr.attr] = instr
+                elif instr.op == "global":
+                    pending.pop(instr.attr, None)
+                elif instr.op in EFFECT_OPS or instr.can_raise():
+                    pending.clear()
+        return changes
+
+def default_pipeline():
+    return [CopyPropagation(), GlobalValueNumbering(), CopyPropagation(), DeadStoreElimination(),
+            DeadCodeElimination()]
+
+# --- Lowering to bytecode ---
+
+OPCODES = {
+    "add": OpCode.OP_ADD, "sub": OpCode.OP_SUBTRACT, "mul": OpCode.OP_MULTIPLY, "div": OpCode.OP_DIVIDE,
+    "neg": OpCode.OP_NEGATE, "not": OpCode.OP_NOT, "eq": OpCode.OP_EQUAL, "lt": OpCode.OP_LESS,
+    "gt": OpCode.OP_GREATER, "print": OpCode.OP_PRINT, "index": OpCode.OP_GET_INDEX,
+    "set_index": OpCode.OP_SET_INDEX,
+}
+WITH_OPERAND = {
+    "global": OpCode.OP_GET_GLOBAL, "set_global": OpCode.OP_SET_GLOBAL, "get_field": OpCode.OP_GET_FIELD,
+    "set_field": OpCode.OP_SET_FIELD, "call": OpCode.OP_CALL, "build_array": OpCode.OP_BUILD_ARRAY,
+    "build_map": OpCode.OP_BUILD_MAP,
+}
+NAME_OPERANDS = ("global", "set_global", "get_field", "set_field")
+# (compare op, negated) -> the RangeLoop comparison it amounts to
+RANGE_COMPARES = {("lt", False): operator.lt, ("gt", False): operator.gt,
+                  ("gt", True): operator.le, ("lt", True): operator.ge}
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def split_critical_edges(fn):
+    for block in list(fn.blocks):
+        if len(block.succs) < 2:
+            continue
+        for k, succ in enumerate(block.succs):
+            if len(succ.preds) < 2:
+                continue
+            middle = fn.new_block()
+            jump = Instr("jump", line=block.term.line)
+            jump.block, jump.targets = middle, [succ]
+            middle.term = jump
+            middle.preds = [block]
+            block.term.targets[k] = middle
+            succ.preds[succ.preds.index(block)] = middle
+
+class Lowering:
+    """Turn SSA into stack bytecode.
+
+    A value used once, later in its own block, with no effect in between is
+    not stored: it is computed right where its user needs it on the stack.
+    Constants are rematerialized at every use. Every other value gets a local
+    slot, and slots are shared between values whose live ranges do not
+    overlap (greedy coloring in dominance order). Phis become copies at the
+    end of each predecessor, pushed together and then stored so they happen
+    in parallel.
+    """
+
+    def __init__(self, fn, strings):
+        self.fn = fn
+        self.strings = strings
+        self.chunk = Chunk()
+        self.line = 0
+
+    def lower(self):
+        fn = self.fn
+        split_critical_edges(fn)
+        self.order = reverse_postorder(fn)
+        self.users = use_def(fn)
+        self.folded = self.fold_operands()
+        self.range_loops = self.find_range_loops()
+        self.allocate_slots()
+
+        for _ in range(self.slot_count - 1 - fn.arity):
+            self.write(OpCode.OP_NIL)
+        starts, forward = {}, []
+        for position, block in enumerate(self.order):
+            starts[block] = len(self.chunk.code)
+            following = self.order[position + 1] if position + 1 < len(self.order) else None
+            for instr in block.instrs:
+                if instr.op == "const" or instr in self.folded:
+                    continue
+                self.line = instr.line
+                self.compute(instr)
+                if instr in self.slots:
+                    self.write(OpCode.OP_SET_LOCAL, self.slots[instr])
+                    self.write(OpCode.OP_POP)
+                elif instr.op != "print":
+                    self.write(OpCode.OP_POP)
+            term = block.term
+            self.line = term.line
+            if term.op in ("return", "throw"):
+                self.push(term.args[0])
+                self.write(OpCode.OP_RETURN if term.op == "return" else OpCode.OP_THROW)
+            elif term.op == "jump" and block in self.range_loops:
+                header, phi, step, compare, limit = self.range_loops[block]
+                self.phi_copies(block, header, skip=phi)
+                then_block, else_block = header.term.targets
+                if limit.op == "const":
+                    limit_kind, limit_operand = RangeLoop.LIMIT_CONSTANT, limit.attr
+                else:
+                    limit_kind, limit_operand = RangeLoop.LIMIT_LOCAL, self.slots[limit]
+                loop = RangeLoop(self.slots[phi], step, compare, limit_kind, limit_operand, starts[then_block])
+                self.write(OpCode.OP_FOR_RANGE, self.constant(loop))
+                self.goto(else_block, following, starts, forward)
+            elif term.op == "jump":
+                target = term.targets[0]
+                self.phi_copies(block, target)
+                self.goto(target, following, starts, forward)
+            else:
+                then_block, else_block = term.targets
+                self.push(term.args[0])
+                if else_block in starts:
+                    # Conditional jumps only go forward: hop over a backward OP_LOOP
+                    self.write(OpCode.OP_POP_JUMP_IF_TRUE, 0, 3)
+                    self.loop_to(starts[else_block])
+                else:
+                    self.write(OpCode.OP_POP_JUMP_IF_FALSE, 0xff, 0xff)
+                    forward.append((len(self.chunk.code) - 2, else_block))
+                self.goto(then_block, following, starts, forward)
+        for offset, target in forward:
+            jump = starts[target] - offset - 2
+            self.chunk.code[offset] = (jump >> 8) & 0xff
+            self.chunk.code[offset + 1] = jump & 0xff
+        return self.chunk
+
+    # Operand folding and slots
+
+    def fold_operands(self):
+        folded = set()
+        for block in self.fn.blocks:
+            position = {instr: k for k, instr in enumerate(block.instrs)}
+            position[block.term] = len(block.instrs)
+            for k, instr in enumerate(block.instrs):
+                users = self.users.get(instr, [])
+                if instr.op in EFFECT_OPS or instr.op == "const" or len(users) != 1:
+                    continue
+                user = users[0]
+                if user.block is not block or user.op == "phi" or user not in position:
+                    continue
+                between = block.instrs[k + 1:position[user]]
+                # Moving instr down must not reorder it with effects or other failures
+                if any(b.op in EFFECT_OPS or (b.can_raise() and instr.can_raise()) for b in between):
+                    continue
+                folded.add(instr)
+        return folded
+
+    def find_range_loops(self):
+        """Latches whose back edge can be a single OP_FOR_RANGE.
+
+        The loop header must hold nothing but its phis and `i < limit` (or
+        >, <=, >=) feeding the branch, and the latch must step i by a number.
+        The increment is then done by OP_FOR_RANGE in i's slot, so it is
+        treated as folded into the phi.
+        """
+        loops = {}
+        for header in self.fn.blocks:
+            term = header.term
+            if term.op != "branch" or len(header.preds) != 2 or not all(i in self.folded for i in header.instrs):
+                continue
+            cond, negated = term.args[0], False
+            if cond.op == "not":
+                cond, negated = cond.args[0], True
+            if (cond.op, negated) not in RANGE_COMPARES or len(header.instrs) != 1 + negated:
+                continue
+            phi, limit = cond.args
+            if phi not in header.phis or (limit.op == "const" and not is_number(limit.attr)):
+                continue
+            latch = header.preds[1]
+            step = phi.args[1]
+            if latch.term.op != "jump" or self.order.index(latch) <= self.order.index(header) or step.block is not latch \
+                    or step.op not in ("add", "sub") or step.args[0] is not phi \
+                    or step.args[1].op != "const" or not is_number(step.args[1].attr) \
+                    or self.users[step] != [phi]:
+                continue
+            amount = step.args[1].attr if step.op == "add" else -step.args[1].attr
+            self.folded.add(step)
+            loops[latch] = (header, phi, amount, RANGE_COMPARES[(cond.op, negated)], limit)
+        return loops
+
+    def operands(self, instr):
+        """Slotted values an instruction reads once folded operands are expanded."""
+        result = []
+        for arg in instr.args:
+            if arg.op == "const":
+                continue
+            if arg in self.folded:
+                result.extend(self.operands(arg))
+            else:
+                result.append(arg)
+        return result
+
+    def allocate_slots(self):
+        fn = self.fn
+        live_in, live_out = liveness(fn, self.operands)
+        interferes = {}
+
+        def conflict(value, live):
+            for other in live:
+                if other is not value:
+                    interferes.setdefault(value, set()).add(other)
+                    interferes.setdefault(other, set()).add(value)
+
+        for block in fn.blocks:
+            live = set(live_out[block])
+            executed = [block.term] + [i for i in reversed(block.instrs) if i.op != "const" and i not in self.folded]
+            for instr in executed:
+                if instr is not block.term and self.users.get(instr):
+                    conflict(instr, live)
+                    live.discard(instr)
+                live.update(self.operands(instr))
+            heads = block.phis + (fn.params if block is fn.entry else [])
+            for head in heads:
+                conflict(head, live | set(heads))
+
+        self.slots = {param: k + 1 for k, param in enumerate(fn.params)}
+        for block in self.order:
+            for value in block.phis + [i for i in block.instrs if i.op != "const" and i not in self.folded]:
+                if value not in block.phis and not self.users.get(value):
+                    continue
+                taken = {self.slots[o] for o in interferes.get(value, ()) if o in self.slots}
+                slot = 1
+                while slot in taken:
+                    slot += 1
+                self.slots[value] = slot
+        self.slot_count = max(self.slots.values(), default=fn.arity) + 1
+        if self.slot_count > 256:
+            raise Unsupported("too many locals")
+
+    # Emission
+
+    def write(self, *bytes):
+        for byte in bytes:
+            self.chunk.write(byte, self.line)
+
+    def constant(self, value):
+        index = self.chunk.add_constant(value)
+        if index > 255:
+            raise Unsupported("too many constants")
+        return index
+
+    def push(self, value):
+        if value.op == "const":
+            if value.attr is None: self.write(OpCode.OP_NIL)
+            elif value.attr is True: self.write(OpCode.OP_TRUE)
+            elif value.attr is False: self.write(OpCode.OP_FALSE)
+            elif isinstance(value.attr, str):
+                string = self.strings.setdefault(value.attr, object.ObjString(value.attr))
+                self.write(OpCode.OP_CONSTANT, self.constant(string))
+            else: self.write(OpCode.OP_CONSTANT, self.constant(value.attr))
+        elif value in self.folded:
+            self.compute(value)
+        else:
+            self.write(OpCode.OP_GET_LOCAL, self.slots[value])
+
+    def compute(self, instr):
+        for arg in instr.args:
+            self.push(arg)
+        if instr.op == "index" and instr.attr:
+            self.write(OpCode.OP_GET_INDEX_UNCHECKED)
+        elif instr.op in OPCODES:
+            self.write(OPCODES[instr.op])
+        elif instr.op in NAME_OPERANDS:
+            self.write(WITH_OPERAND[instr.op], self.constant(instr.attr))
+        elif instr.op in WITH_OPERAND:
+            self.write(WITH_OPERAND[instr.op], instr.attr)
+        elif instr.op != "copy":
+            raise Unsupported(instr.op)
+
+    def phi_copies(self, block, target, skip=None):
+        if not target.phis:
+            return
+        k = target.preds.index(block)
+        # Values already sitting in the phi's slot need no copy
+        copies = [phi for phi in target.phis if phi is not skip and (
+            self.slots.get(phi.args[k]) != self.slots[phi] or phi.args[k] in self.folded)]
+        for phi in copies:
+            self.push(phi.args[k])
+        for phi in reversed(copies):
+            self.write(OpCode.OP_SET_LOCAL, self.slots[phi])
+            self.write(OpCode.OP_POP)
+
+    def goto(self, target, following, starts, forward):
+        if target is following:
+            return
+        if target in starts:
+            self.loop_to(starts[target])
+        else:
+            self.write(OpCode.OP_JUMP, 0xff, 0xff)
+            forward.append((len(self.chunk.code) - 2, target))
+
+    def loop_to(self, start):
+        offset = len(self.chunk.code) + 3 - start
+        self.write(OpCode.OP_LOOP, (offset >> 8) & 0xff, offset & 0xff)
+
+def compile_function(decl, strings, unchecked=(), verbose=False):
+    """Build, optimize and lower a top-level FnDecl. Raises Unsupported to request a fallback."""
+    fn = Builder(decl, unchecked).build()
+    PassManager(verbose=verbose).run(fn)
+    return Lowering(fn, strings).lower()
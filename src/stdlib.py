@@ -1,3 +1,6 @@
+import ctypes
+import ctypes.util
+import functools
 import time
 import sys
 from reyna_vals import ObjNative
@@ -46,6 +49,144 @@ def exec_native(*args):
         print(f"Python Error: {e}")
         return False
 
+# Array natives mutate ObjArray.elements in place. Python lists already give
+# amortized O(1) append/pop at the end, so nothing is ever copied here.
+
+def len_native(args):
+    if len(args) < 1: return 0
+    target = args[0]
+    if isinstance(target, object.ObjArray): return len(target.elements)
+    if isinstance(target, object.ObjArrayView): return target.length
+    if isinstance(target, object.ObjMap): return len(target.entries)
+    if isinstance(target, object.ObjString): return len(target.value)
+    print(f"len() expects an array or string, got {type(target).__name__}.")
+    return None
+
+def push_native(args):
+    if len(args) < 2 or not isinstance(args[0], object.ObjArray):
+        print("push() expects an array and a value.")
+        return None
+    args[0].writable(args[1:2]).append(args[1])
+    return len(args[0].elements)
+
+def pop_native(args):
+    if len(args) < 1 or not isinstance(args[0], object.ObjArray):
+        print("pop() expects an array.")
+        return None
+    elements = args[0].elements
+    if not elements:
+        print("pop() from empty array.")
+        return None
+    return elements.pop()
+
+def insert_native(args):
+    if len(args) < 3 or not isinstance(args[0], object.ObjArray):
+        print("insert() expects an array, an index and a value.")
+        return None
+    elements = args[0].elements
+    idx = int(args[1])
+    if not 0 <= idx <= len(elements):
+        print(f"Index {idx} out of bounds for insert into array of length {len(elements)}.")
+        return None
+    args[0].writable(args[2:3]).insert(idx, args[2])
+    return len(args[0].elements)
+
+def extend_native(args):
+    if len(args) < 2 or not isinstance(args[0], object.ObjArray):
+        print("extend() expects two arrays.")
+        return None
+    source = args[1]
+    if isinstance(source, object.ObjArray):
+        args[0].writable(source.elements).extend(source.elements)
+    elif isinstance(source, object.ObjArrayView):
+        args[0].writable(source.window()).extend(source.window())
+    else:
+        print("extend() expects two arrays.")
+        return None
+    return len(args[0].elements)
+
+def keys_native(args):
+    if len(args) < 1 or not isinstance(args[0], object.ObjMap):
+        print("keys() expects a map.")
+        return None
+    return object.ObjArray(list(args[0].entries.keys()))
+
+def values_native(args):
+    if len(args) < 1 or not isinstance(args[0], object.ObjMap):
+        print("values() expects a map.")
+        return None
+    return object.ObjArray(list(args[0].entries.values()))
+
+def has_native(args):
+    if len(args) < 2 or not isinstance(args[0], object.ObjMap):
+        print("has() expects a map and a key.")
+        return None
+    return args[1] in args[0].entries
+
+def slice_value(target, start, end):
+    """Slice an array (as a view sharing its buffer) or a string (as a copy).
+
+    Bounds may be nil and are clamped to the target, like Python slices
+    without negative indexing. Returns None if the target can't be sliced.
+    """
+    if isinstance(target, object.ObjArray):
+        array, offset, length = target, 0, len(target.elements)
+    elif isinstance(target, object.ObjArrayView):
+        array, offset, length = target.array, target.start, target.length
+    elif isinstance(target, object.ObjString):
+        array, offset, length = None, 0, len(target.value)
+    else:
+        print(f"Can only slice arrays and strings, got {type(target).__name__}.")
+        return None
+
+    lo = 0 if start is None else min(max(int(start), 0), length)
+    hi = length if end is None else min(max(int(end), lo), length)
+    if array is None:
+        return object.ObjString(target.value[lo:hi])
+    # Views of views point at the root buffer so chains stay one hop deep
+    return object.ObjArrayView(array, offset + lo, hi - lo)
+
+def slice_native(args):
+    if len(args) < 1: return None
+    start = args[1] if len(args) > 1 else None
+    end = args[2] if len(args) > 2 else None
+    return slice_value(args[0], start, end)
+
+def copy_native(args):
+    if len(args) < 1: return None
+    target = args[0]
+    if isinstance(target, object.ObjArrayView):
+        return object.ObjArray(target.window())
+    if isinstance(target, object.ObjArray):
+        return object.ObjArray(list(target.elements))
+    return target
+
+# Math builtins and their argument counts. All take and return float64 and call
+# libm, the same functions JIT-compiled code calls, so every mode computes
+# identical results.
+MATH = {"sqrt": 1, "sin": 1, "cos": 1, "exp": 1, "log": 1, "pow": 2, "floor": 1, "ceil": 1}
+
+@functools.lru_cache(maxsize=None)
+def libm():
+    return ctypes.CDLL(ctypes.util.find_library("m") or "msvcrt")
+
+def math_native(name):
+    arity = MATH[name]
+    fn = getattr(libm(), name)
+    fn.restype = ctypes.c_double
+    fn.argtypes = [ctypes.c_double] * arity
+
+    def call(args):
+        if len(args) != arity or not all(type(a) in (int, float) for a in args):
+            print(f"{name}() expects {arity} number argument{'s' if arity > 1 else ''}.")
+            return None
+        try:
+            return fn(*args)
+        except ctypes.ArgumentError: # An int beyond the range of float64
+            print(f"{name}() argument out of range.")
+            return None
+    return call
+
 def register_stdlib(vm):
     vm.globals['clock'] = ObjNative(clock_native, 'clock')
     vm.globals['input'] = ObjNative(input_native, 'input')
@@ -73,6 +214,24 @@ def register_stdlib(vm):
          
     vm.globals['float'] = ObjNative(float_conv, 'float')
 
+    # Arrays
+    vm.globals['len'] = ObjNative(len_native, 'len')
+    vm.globals['push'] = ObjNative(push_native, 'push')
+    vm.globals['pop'] = ObjNative(pop_native, 'pop')
+    vm.globals['insert'] = ObjNative(insert_native, 'insert')
+    vm.globals['extend'] = ObjNative(extend_native, 'extend')
+    vm.globals['slice'] = ObjNative(slice_native, 'slice')
+    vm.globals['copy'] = ObjNative(copy_native, 'copy')
+
+    # Maps
+    vm.globals['keys'] = ObjNative(keys_native, 'keys')
+    vm.globals['values'] = ObjNative(values_native, 'values')
+    vm.globals['has'] = ObjNative(has_native, 'has')
+
+    # Math
+    for name in MATH:
+        vm.globals[name] = ObjNative(math_native(name), name)
+
 
 
 
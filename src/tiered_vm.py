@@ -0,0 +1,151 @@
+import ctypes
+import sys
+import reyna_vals as object
+from vm_core import VM
+from tracing import Tracer
+from native_lib import TYPECODES, OVERFLOW, pack, argument_types, fault_state, report_fault
+
+# VM for `--mode tiered`. Every function starts out on the stack VM. Once a
+# top-level function has been called HOT_CALLS times it is handed to the LLVM
+# JIT (jit.py) together with the top-level functions it calls; this only
+# succeeds for purely numeric code. Later calls run the machine code through
+# a ctypes trampoline, unboxing the arguments and boxing the result. Hot
+# loops are traced and compiled on their own (tracing.py), so numeric loops in
+# code the function tier rejects, like the script body, get compiled too.
+# Typed arrays are handed over without copying (see native_lib.pack).
+
+C_TYPES = {"int64": ctypes.c_int64, "float64": ctypes.c_double, "bool": ctypes.c_bool}
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+class NativeFunction:
+    """Machine code for one function plus the guards that say when it may run."""
+
+    def __init__(self, library, fault, decl, bindings, prints):
+        self.params = [p_type.lexeme for _, p_type in decl.params]
+        restype = C_TYPES[decl.return_type.lexeme] if decl.return_type else None
+        self.library = library # The code is unloaded along with this object
+        self.entry = ctypes.CFUNCTYPE(restype, *argument_types(self.params))(library["reyna_entry"])
+        self.fault = fault_state(fault) if fault else None
+        self.arrays = any(t in TYPECODES for t in self.params)
+        self.bindings = bindings # Global name -> ObjClosure its calls were compiled against
+        self.prints = prints # Writes through C's stdout, which it flushes before returning
+
+    def current(self, globals):
+        # False once a callee has been redefined since compilation
+        return all(globals.get(name) is value for name, value in self.bindings.items())
+
+    def accepts(self, args):
+        for type_name, arg in zip(self.params, args):
+            kind = type(arg)
+            if type_name == "int64":
+                if kind is not int or not INT64_MIN <= arg <= INT64_MAX:
+                    return False
+            elif type_name == "float64":
+                # An int would come back as a float, where the VM keeps the int
+                if kind is not float:
+                    return False
+            elif type_name in TYPECODES:
+                if pack(arg, type_name) is None:
+                    return False
+            elif kind is not bool:
+                return False
+        return True
+
+    def unbox(self, args):
+        # Each array becomes its buffer address and length
+        c_args = []
+        for type_name, arg in zip(self.params, args):
+            if type_name in TYPECODES:
+                c_args += [arg.elements.buffer_info()[0], len(arg.elements)]
+            else:
+                c_args.append(arg)
+        return c_args
+
+class Rejected:
+    """Stands in for the native code of a function the JIT could not compile. Its
+    decl stays, so functions that call it may still compile it as a callee."""
+
+    def current(self, globals):
+        return True
+
+    def accepts(self, args):
+        return False
+
+REJECTED = Rejected()
+
+class TieredVM(VM):
+    HOT_CALLS = 1000
+
+    def __init__(self, threshold=HOT_CALLS, opt_level=2, verbose=False, structs=None):
+        super().__init__()
+        self.threshold = threshold
+        self.structs = structs or {} # Struct name -> StructDecl, so native code can build instances
+        self.verbose = verbose
+        try:
+            from jit import ReynaJIT
+            self.jit = ReynaJIT(opt_level)
+        except ImportError: # No llvmlite: only loops are compiled, to Python
+            self.jit = None
+        self.tracer = Tracer(self, self.jit, verbose)
+
+    def call(self, closure, arg_count):
+        function = closure.function
+        native = function.native
+        if native is not None and not native.current(self.globals):
+            # Drop code compiled against an old callee, which frees it, and start
+            # counting towards compiling against the new one
+            function.native = native = None
+            function.calls = 0
+        if native is None and function.decl is not None:
+            function.calls += 1
+            if function.calls > self.threshold:
+                native = self.compile(function)
+        if native is not None and arg_count == function.arity:
+            base = len(self.stack) - arg_count
+            args = self.stack[base:]
+            if native.accepts(args):
+                if native.prints:
+                    sys.stdout.flush()
+                result = native.entry(*(native.unbox(args) if native.arrays else args))
+                if native.fault is not None and native.fault[0]:
+                    if native.fault[0] == OVERFLOW:
+                        # The result outgrew int64; the arguments are still on the stack
+                        native.fault[0] = 0
+                        return super().call(closure, arg_count)
+                    report_fault(native.fault)
+                    return False
+                del self.stack[base - 1:]
+                self.push(result)
+                return True
+        return super().call(closure, arg_count)
+
+    def compile(self, function):
+        if self.jit is None:
+            function.decl = None
+            return None
+        from jit import JITError
+        bindings = {}
+
+        def resolve(name):
+            # Calls are bound to the functions and structs the globals hold right now
+            value = self.globals.get(name)
+            if isinstance(value, object.ObjClosure) and value.function.decl is not None \
+                    and value.function.decl.name.lexeme == name:
+                bindings[name] = value
+                return value.function.decl
+            if isinstance(value, object.ObjStruct) and value.name == name and name in self.structs:
+                bindings[name] = value
+                return self.structs[name]
+            return None
+
+        try:
+            library, fault, names, prints = self.jit.compile_function(function.decl, resolve)
+        except JITError as e:
+            if self.verbose:
+                print(f"jit: {function.name} stays interpreted ({e})")
+            function.native = REJECTED
+            return None
+        function.native = NativeFunction(library, fault, function.decl, bindings, prints)
+        if self.verbose:
+            print(f"jit: {', '.join(names)} compiled to native code after {function.calls} call(s)")
+        return function.native
@@ -0,0 +1,535 @@
+import ctypes
+from reyna_chunk import OpCode, RangeLoop
+
+# Tracing JIT for hot loops under --mode tiered. The VM reports every taken
+# loop back-edge to Tracer.backedge. Once a loop has gone round HOT_LOOP
+# times, its next iteration is executed by a Recorder, which logs every
+# instruction together with the types it saw into a linear trace; branches
+# become guards. The trace is compiled to a native loop with LLVM, or to a
+# Python function when llvmlite is missing, and from then on the loop runs
+# there until a guard fails. The exit writes the loop's locals, globals and
+# temporaries back so the interpreter resumes at the failing instruction.
+#
+# Values in a trace are numbered; each has the Python type (int, float or
+# bool) it had while recording, and inputs are guarded to have that type
+# every time the trace is entered.
+
+HOT_LOOP = 50
+MAX_TRACE = 1000 # Instructions in one iteration
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+COMPARES = {OpCode.OP_EQUAL: "eq", OpCode.OP_GREATER: "gt", OpCode.OP_LESS: "lt"}
+ARITHMETIC = {OpCode.OP_ADD: "add", OpCode.OP_SUBTRACT: "sub", OpCode.OP_MULTIPLY: "mul"}
+BRANCHES = { # opcode -> (jumps when the value is truthy, pops the value)
+    OpCode.OP_JUMP_IF_FALSE: (False, False), OpCode.OP_JUMP_IF_TRUE: (True, False),
+    OpCode.OP_POP_JUMP_IF_FALSE: (False, True), OpCode.OP_POP_JUMP_IF_TRUE: (True, True),
+}
+PYTHON_OPS = {"add": "+", "sub": "-", "mul": "*", "div": "/", "eq": "==", "lt": "<", "gt": ">", "le": "<=", "ge": ">="}
+
+class Abort(Exception):
+    pass
+
+def value_type(value):
+    kind = type(value)
+    if kind is int and not INT64_MIN <= value <= INT64_MAX:
+        raise Abort("integer outside 64 bits")
+    if kind not in (int, float, bool):
+        raise Abort(f"{kind.__name__} value")
+    return kind
+
+class Trace:
+    def __init__(self, header, height, types, inputs, carried, body, exits):
+        self.header = header
+        self.height = height   # Frame-relative stack height at the loop header
+        self.types = types     # Value number -> int, float or bool
+        self.inputs = inputs   # (kind, key, value) read on entry; kind is "local" (key: slot) or "global"
+        self.carried = carried # Input value -> value it has at the end of an iteration
+        self.body = body       # (op, dest, operands...) tuples
+        self.exits = exits     # (ip, height, [(kind, key, value)]) per guard
+        self.run = None        # Set by a backend: run(input values) -> (exit index, output values)
+        self.library = None    # The LLVM backend's JIT library; run's code lives as long as it
+
+class Recorder:
+    """Execute one loop iteration on the live VM state while recording it."""
+
+    def __init__(self, vm, frame):
+        chunk = frame.closure.function.chunk
+        self.vm = vm
+        self.frame = frame
+        self.code = chunk.code
+        self.constants = chunk.constants
+        self.header = frame.ip
+        self.base = frame.slots
+        self.entry_stack = vm.stack[frame.slots:]
+        self.height = len(self.entry_stack)
+        self.entry_globals = {}
+        self.types = []
+        self.body = []
+        self.snapshots = []
+        self.inputs = {}                # (kind, key) -> value number
+        self.sym = [None] * self.height # Stack slot -> value number, None while untouched
+        self.globals = {}               # Global name -> value number
+
+    def record(self):
+        """Returns a Trace, or raises Abort with the VM stopped before the unsupported instruction."""
+        for _ in range(MAX_TRACE):
+            if self.step():
+                return self.finish()
+        raise Abort("trace too long")
+
+    # Values
+
+    def new(self, kind):
+        self.types.append(kind)
+        return len(self.types) - 1
+
+    def input(self, kind, key, value):
+        if (kind, key) not in self.inputs:
+            self.inputs[kind, key] = self.new(value_type(value))
+        return self.inputs[kind, key]
+
+    def read(self, slot):
+        if self.sym[slot] is None:
+            self.sym[slot] = self.input("local", slot, self.entry_stack[slot])
+        return self.sym[slot]
+
+    def emit(self, op, kind, *operands):
+        dest = self.new(kind)
+        self.body.append((op, dest) + operands)
+        return dest
+
+    def constant(self, value):
+        return self.emit("const", value_type(value), value)
+
+    def snapshot(self, ip):
+        """Exit resuming at ip with the stack and globals as they are now."""
+        self.snapshots.append((ip, list(self.sym), dict(self.globals)))
+        return len(self.snapshots) - 1
+
+    # Instructions
+
+    def step(self):
+        vm, frame, stack = self.vm, self.frame, self.vm.stack
+        ip = frame.ip
+        op = self.code[ip]
+        if op == OpCode.OP_CONSTANT:
+            value = self.constants[self.code[ip + 1]]
+            self.sym.append(self.constant(value))
+            stack.append(value)
+            frame.ip = ip + 2
+        elif op == OpCode.OP_TRUE or op == OpCode.OP_FALSE:
+            self.sym.append(self.constant(op == OpCode.OP_TRUE))
+            stack.append(op == OpCode.OP_TRUE)
+            frame.ip = ip + 1
+        elif op == OpCode.OP_POP:
+            self.sym.pop()
+            stack.pop()
+            frame.ip = ip + 1
+        elif op == OpCode.OP_DUP:
+            self.sym.append(self.sym[-1] if self.sym[-1] is not None else self.read(len(self.sym) - 1))
+            stack.append(stack[-1])
+            frame.ip = ip + 1
+        elif op == OpCode.OP_GET_LOCAL:
+            slot = self.code[ip + 1]
+            self.sym.append(self.read(slot))
+            stack.append(stack[self.base + slot])
+            frame.ip = ip + 2
+        elif op == OpCode.OP_SET_LOCAL:
+            slot = self.code[ip + 1]
+            self.sym[slot] = self.top()
+            stack[self.base + slot] = stack[-1]
+            frame.ip = ip + 2
+        elif op == OpCode.OP_GET_GLOBAL:
+            name = self.constants[self.code[ip + 1]]
+            if name not in vm.globals:
+                raise Abort(f"undefined global '{name}'")
+            self.sym.append(self.get_global(name))
+            stack.append(vm.globals[name])
+            frame.ip = ip + 2
+        elif op == OpCode.OP_SET_GLOBAL:
+            name = self.constants[self.code[ip + 1]]
+            if name not in vm.globals:
+                raise Abort(f"undefined global '{name}'")
+            value = self.top()
+            self.entry_globals.setdefault(name, vm.globals[name])
+            self.globals[name] = value
+            vm.globals[name] = stack[-1]
+            frame.ip = ip + 2
+        elif op in COMPARES:
+            a, b = self.operands(stack, numeric=op != OpCode.OP_EQUAL)
+            if op == OpCode.OP_EQUAL and (self.types[a] is bool) != (self.types[b] is bool):
+                raise Abort("comparison of bool and number")
+            self.binary(COMPARES[op], bool, a, b, None)
+            frame.ip = ip + 1
+        elif op in ARITHMETIC or op == OpCode.OP_DIVIDE:
+            a, b = self.operands(stack, numeric=True)
+            x, y = stack[-2], stack[-1]
+            if op == OpCode.OP_DIVIDE:
+                if y == 0:
+                    raise Abort("division by zero")
+                self.binary("div", float, a, b, self.snapshot(ip))
+            elif self.types[a] is int and self.types[b] is int:
+                result = x + y if op == OpCode.OP_ADD else x - y if op == OpCode.OP_SUBTRACT else x * y
+                value_type(result)
+                self.binary(ARITHMETIC[op], int, a, b, self.snapshot(ip))
+            else:
+                self.binary(ARITHMETIC[op], float, a, b, None)
+            frame.ip = ip + 1
+        elif op == OpCode.OP_NOT:
+            self.sym.append(self.emit("not", bool, self.pop()))
+            stack.append(not stack.pop())
+            frame.ip = ip + 1
+        elif op == OpCode.OP_NEGATE:
+            a = self.top()
+            if self.types[a] is bool:
+                raise Abort("negated bool")
+            if self.types[a] is int:
+                value_type(-stack[-1])
+            exit = self.snapshot(ip) if self.types[a] is int else None
+            self.sym[-1] = self.emit("neg", self.types[a], a, exit)
+            stack.append(-stack.pop())
+            frame.ip = ip + 1
+        elif op in BRANCHES:
+            jump_if, pops = BRANCHES[op]
+            offset = (self.code[ip + 1] << 8) | self.code[ip + 2]
+            condition = self.top()
+            if pops:
+                self.sym.pop()
+            truthy = vm.is_truthy(stack.pop() if pops else stack[-1])
+            taken = truthy == jump_if
+            target = ip + 3 + offset if taken else ip + 3
+            self.body.append(("guard", None, condition, truthy, self.snapshot(ip + 3 + offset if not taken else ip + 3)))
+            frame.ip = target
+        elif op == OpCode.OP_JUMP:
+            frame.ip = ip + 3 + ((self.code[ip + 1] << 8) | self.code[ip + 2])
+        elif op == OpCode.OP_LOOP:
+            target = ip + 3 - ((self.code[ip + 1] << 8) | self.code[ip + 2])
+            if target != self.header:
+                raise Abort("inner loop")
+            frame.ip = target
+            return True
+        elif op == OpCode.OP_FOR_RANGE:
+            return self.for_range(ip, self.constants[self.code[ip + 1]])
+        else:
+            raise Abort(f"{op.name[3:]} instruction")
+        return False
+
+    def for_range(self, ip, loop):
+        vm, stack = self.vm, self.vm.stack
+        if loop.body_start != self.header:
+            raise Abort("inner loop")
+        if loop.limit_kind == RangeLoop.LIMIT_CONSTANT:
+            limit_value = loop.limit
+        elif loop.limit_kind == RangeLoop.LIMIT_LOCAL:
+            limit_value = stack[self.base + loop.limit]
+        elif loop.limit in vm.globals:
+            limit_value = vm.globals[loop.limit]
+        else:
+            raise Abort(f"undefined global '{loop.limit}'")
+        counter = stack[self.base + loop.slot]
+        if type(counter) is not int or value_type(limit_value) is bool:
+            raise Abort("non-integer loop counter")
+        value_type(counter + loop.step)
+        if not loop.compare(counter + loop.step, limit_value):
+            raise Abort("loop ends while recording")
+
+        i = self.emit("add", int, self.read(loop.slot), self.constant(loop.step), self.snapshot(ip))
+        self.sym[loop.slot] = i
+        stack[self.base + loop.slot] = counter + loop.step
+        if loop.limit_kind == RangeLoop.LIMIT_CONSTANT:
+            limit = self.constant(limit_value)
+        elif loop.limit_kind == RangeLoop.LIMIT_LOCAL:
+            limit = self.read(loop.limit)
+        else:
+            limit = self.get_global(loop.limit)
+        condition = self.emit(loop.compare.__name__, bool, i, limit, None) # operator.lt and friends
+        self.body.append(("guard", None, condition, True, self.snapshot(ip + 2)))
+        self.frame.ip = loop.body_start
+        return True
+
+    def top(self):
+        if self.sym[-1] is None:
+            return self.read(len(self.sym) - 1)
+        return self.sym[-1]
+
+    def pop(self):
+        value = self.top()
+        self.sym.pop()
+        return value
+
+    def get_global(self, name):
+        if name not in self.globals:
+            value = self.vm.globals[name]
+            self.entry_globals.setdefault(name, value)
+            self.globals[name] = self.input("global", name, value)
+        return self.globals[name]
+
+    def operands(self, stack, numeric):
+        b = self.top()
+        a = self.sym[-2] if self.sym[-2] is not None else self.read(len(self.sym) - 2)
+        if numeric and (self.types[a] is bool or self.types[b] is bool):
+            raise Abort("arithmetic on bool")
+        return a, b
+
+    def binary(self, op, kind, a, b, exit):
+        stack = self.vm.stack
+        y = stack.pop()
+        x = stack.pop()
+        self.sym[-2:] = [self.emit(op, kind, a, b, exit)]
+        if op == "add": stack.append(x + y)
+        elif op == "sub": stack.append(x - y)
+        elif op == "mul": stack.append(x * y)
+        elif op == "div": stack.append(x / y)
+        elif op == "eq": stack.append(x == y)
+        elif op == "gt": stack.append(x > y)
+        else: stack.append(x < y)
+
+    # Finishing
+
+    def finish(self):
+        if len(self.sym) != self.height:
+            raise Abort("stack height changes across iterations")
+        carried = {}
+        for slot, value in enumerate(self.sym):
+            if value is not None and value != self.inputs.get(("local", slot)):
+                carried[self.input("local", slot, self.entry_stack[slot])] = value
+        for name, value in self.globals.items():
+            if value != self.inputs.get(("global", name)):
+                carried[self.input("global", name, self.entry_globals[name])] = value
+        for start, end in carried.items():
+            if self.types[start] is not self.types[end]:
+                raise Abort("a variable changes type across iterations")
+
+        exits = []
+        for ip, sym, globals in self.snapshots:
+            writes = []
+            for slot, value in enumerate(sym):
+                key = ("local", slot)
+                if value is None and key in self.inputs and self.inputs[key] in carried:
+                    value = self.inputs[key]
+                if value is not None:
+                    writes.append(("local", slot, value))
+            for (kind, name), start in self.inputs.items():
+                if kind == "global" and (start in carried or globals.get(name, start) != start):
+                    writes.append(("global", name, globals.get(name, start)))
+            exits.append((ip, len(sym), writes))
+        inputs = [(kind, key, value) for (kind, key), value in self.inputs.items()]
+        return Trace(self.header, self.height, self.types, inputs, carried, self.body, exits)
+
+# Backends
+
+def compile_python(trace):
+    """Compile a trace to a Python function; Python ints cannot overflow, so only
+    branch and division guards remain."""
+    names = lambda values: "".join(f"v{v}, " for v in values)
+    returns = [f"return {k}, ({names(value for _, _, value in writes)})"
+               for k, (_, _, writes) in enumerate(trace.exits)]
+    lines = [f"def trace({', '.join(f'v{value}' for _, _, value in trace.inputs)}):", "    while True:"]
+    for op, dest, *operands in trace.body:
+        if op == "const":
+            lines.append(f"        v{dest} = {operands[0]!r}")
+        elif op == "guard":
+            condition, expected, exit = operands
+            lines.append(f"        if {'not ' if expected else ''}v{condition}: {returns[exit]}")
+        elif op == "not":
+            lines.append(f"        v{dest} = not v{operands[0]}")
+        elif op == "neg":
+            lines.append(f"        v{dest} = -v{operands[0]}")
+        else:
+            a, b, exit = operands
+            if op == "div":
+                lines.append(f"        if v{b} == 0: {returns[exit]}")
+            lines.append(f"        v{dest} = v{a} {PYTHON_OPS[op]} v{b}")
+    if trace.carried:
+        lines.append(f"        {names(trace.carried)}= {names(trace.carried.values())}")
+    namespace = {}
+    exec(compile("\n".join(lines), "<reyna trace>", "exec"), namespace)
+    function = namespace["trace"]
+    trace.run = lambda values: function(*values)
+
+def compile_llvm(trace, jit):
+    """Compile a trace to a native loop. Inputs and outputs travel through one
+    int64 buffer (floats bit-cast, bools widened); the return value is the exit taken."""
+    import llvmlite.ir as ir
+    i64, double, i1 = ir.IntType(64), ir.DoubleType(), ir.IntType(1)
+    types = {int: i64, float: double, bool: i1}
+    module = ir.Module(name="reyna_trace")
+    func = ir.Function(module, ir.FunctionType(ir.IntType(32), [i64.as_pointer()]), name="trace")
+    io = func.args[0]
+    entry = func.append_basic_block("entry")
+    builder = ir.IRBuilder(entry)
+    values = {}
+
+    def unbox(raw, kind):
+        if kind is float: return builder.bitcast(raw, double)
+        if kind is bool: return builder.trunc(raw, i1)
+        return raw
+
+    def to_double(value):
+        return builder.sitofp(values[value], double) if trace.types[value] is int else values[value]
+
+    def exit_to(k, condition):
+        # Branch to exit k when condition holds, otherwise continue in a new block
+        exit_block = func.append_basic_block(f"exit{k}")
+        next_block = func.append_basic_block()
+        builder.cbranch(condition, exit_block, next_block)
+        with builder.goto_block(exit_block):
+            for slot, (_, _, value) in enumerate(trace.exits[k][2]):
+                out, kind = values[value], trace.types[value]
+                raw = builder.bitcast(out, i64) if kind is float else builder.zext(out, i64) if kind is bool else out
+                builder.store(raw, builder.gep(io, [ir.Constant(i64, slot)]))
+            builder.ret(ir.Constant(ir.IntType(32), k))
+        builder.position_at_end(next_block)
+
+    for slot, (_, _, value) in enumerate(trace.inputs):
+        values[value] = unbox(builder.load(builder.gep(io, [ir.Constant(i64, slot)])), trace.types[value])
+    loop = func.append_basic_block("loop")
+    builder.branch(loop)
+    builder.position_at_end(loop)
+    phis = {}
+    for value in trace.carried:
+        phis[value] = builder.phi(types[trace.types[value]])
+        phis[value].add_incoming(values[value], entry)
+        values[value] = phis[value]
+
+    for op, dest, *operands in trace.body:
+        if op == "const":
+            values[dest] = ir.Constant(types[trace.types[dest]], operands[0])
+        elif op == "guard":
+            condition, expected, exit = operands
+            value, kind = values[condition], trace.types[condition]
+            if kind is int:
+                value = builder.icmp_signed("!=", value, ir.Constant(i64, 0))
+            elif kind is float:
+                value = builder.fcmp_unordered("!=", value, ir.Constant(double, 0.0))
+            exit_to(exit, builder.not_(value) if expected else value)
+        elif op == "not":
+            value, kind = values[operands[0]], trace.types[operands[0]]
+            if kind is int:
+                values[dest] = builder.icmp_signed("==", value, ir.Constant(i64, 0))
+            elif kind is float:
+                values[dest] = builder.fcmp_ordered("==", value, ir.Constant(double, 0.0))
+            else:
+                values[dest] = builder.not_(value)
+        elif op == "neg":
+            a, exit = operands
+            if trace.types[dest] is int:
+                result = builder.ssub_with_overflow(ir.Constant(i64, 0), values[a])
+                exit_to(exit, builder.extract_value(result, 1))
+                values[dest] = builder.extract_value(result, 0)
+            else:
+                values[dest] = builder.fneg(values[a])
+        else:
+            a, b, exit = operands
+            both_int = trace.types[a] is int and trace.types[b] is int
+            if op == "div":
+                divisor = values[b]
+                zero = builder.icmp_signed("==", divisor, ir.Constant(i64, 0)) if trace.types[b] is int \
+                    else builder.fcmp_ordered("==", divisor, ir.Constant(double, 0.0))
+                exit_to(exit, zero)
+                values[dest] = builder.fdiv(to_double(a), to_double(b))
+            elif op in ("add", "sub", "mul") and both_int:
+                result = getattr(builder, f"s{op}_with_overflow")(values[a], values[b])
+                exit_to(exit, builder.extract_value(result, 1))
+                values[dest] = builder.extract_value(result, 0)
+            elif op in ("add", "sub", "mul"):
+                values[dest] = getattr(builder, f"f{op}")(to_double(a), to_double(b))
+            elif trace.types[a] is bool:
+                values[dest] = builder.icmp_unsigned("==", values[a], values[b])
+            elif both_int:
+                values[dest] = builder.icmp_signed(PYTHON_OPS[op], values[a], values[b])
+            else:
+                values[dest] = builder.fcmp_ordered(PYTHON_OPS[op], to_double(a), to_double(b))
+
+    for value, end in trace.carried.items():
+        phis[value].add_incoming(values[end], builder.block)
+    builder.branch(loop)
+
+    library = jit.link(module, ["trace"])
+    entry_point = ctypes.CFUNCTYPE(ctypes.c_int32, ctypes.POINTER(ctypes.c_int64))(library["trace"])
+    size = max([len(trace.inputs)] + [len(writes) for _, _, writes in trace.exits])
+
+    def run(inputs):
+        buffer = (ctypes.c_int64 * size)()
+        floats = ctypes.cast(buffer, ctypes.POINTER(ctypes.c_double))
+        for slot, ((_, _, value), given) in enumerate(zip(trace.inputs, inputs)):
+            if trace.types[value] is float:
+                floats[slot] = given
+            else:
+                buffer[slot] = given
+        k = entry_point(buffer)
+        outputs = []
+        for slot, (_, _, value) in enumerate(trace.exits[k][2]):
+            kind = trace.types[value]
+            outputs.append(floats[slot] if kind is float else bool(buffer[slot]) if kind is bool else buffer[slot])
+        return k, outputs
+    trace.run = run
+    trace.library = library
+
+class Tracer:
+    """Counts loop back-edges for one VM and runs loops through their traces."""
+    FAILED = None
+
+    def __init__(self, vm, jit=None, verbose=False):
+        self.vm = vm
+        self.jit = jit # ReynaJIT, or None to compile traces to Python
+        self.verbose = verbose
+        self.counts = {}
+        self.traces = {} # (chunk, header offset) -> Trace, or FAILED
+
+    def backedge(self, frame):
+        chunk = frame.closure.function.chunk
+        key = (chunk, frame.ip)
+        if key in self.traces:
+            trace = self.traces[key]
+            if trace is not self.FAILED:
+                self.enter(trace, frame)
+            return
+        count = self.counts.get(key, 0) + 1
+        self.counts[key] = count
+        if count >= HOT_LOOP:
+            self.traces[key] = self.record(frame, chunk.lines[frame.ip])
+
+    def record(self, frame, line):
+        try:
+            trace = Recorder(self.vm, frame).record()
+        except Abort as e:
+            if self.verbose:
+                print(f"trace: loop at line {line} stays interpreted ({e})")
+            return self.FAILED
+        if self.jit is not None:
+            compile_llvm(trace, self.jit)
+        else:
+            compile_python(trace)
+        if self.verbose:
+            target = "native code" if self.jit is not None else "Python"
+            print(f"trace: loop at line {line} compiled to {target} "
+                  f"({len(trace.body)} operations, {len(trace.exits)} exits)")
+        return trace
+
+    def enter(self, trace, frame):
+        stack, globals = self.vm.stack, self.vm.globals
+        base = frame.slots
+        if len(stack) - base != trace.height:
+            return
+        inputs = []
+        for kind, key, value in trace.inputs:
+            given = stack[base + key] if kind == "local" else globals.get(key)
+            expected = trace.types[value]
+            if type(given) is not expected or expected is int and not INT64_MIN <= given <= INT64_MAX:
+                return # Interpret this iteration instead
+            inputs.append(given)
+
+        k, outputs = trace.run(inputs)
+        ip, height, writes = trace.exits[k]
+        pushed = []
+        for (kind, key, _), value in zip(writes, outputs):
+            if kind == "global":
+                globals[key] = value
+            elif key < trace.height:
+                stack[base + key] = value
+            else:
+                pushed.append(value)
+        del stack[base + min(height, trace.height):]
+        stack.extend(pushed)
+        frame.ip = ip
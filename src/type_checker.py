@@ -1,9 +1,18 @@
 import ast_nodes
+from analysis import walk
+from stdlib import MATH
 from token_type import TokenType
 
 class TypeCheckError(Exception):
     pass
 
+def element_type(type_name):
+    """Element type of a typed array type such as `float64[]` or `Point[]`, else None.
+    Typed arrays hold exactly that type; plain `array` holds anything."""
+    if isinstance(type_name, str) and type_name.endswith("[]"):
+        return type_name[:-2]
+    return None
+
 class TypeChecker:
     def __init__(self):
         # symbol_table: [ {name: type_str} ] (stack of scopes)
@@ -12,7 +21,16 @@ class TypeChecker:
         self.functions = {}
         # struct_defs: name -> {field: type}
         self.structs = {}
+        self.struct_decls = {} # name -> StructDecl, for the tiered JIT
         self.classes = set()
+        # Class hierarchy facts for devirtualizing method calls
+        self.class_methods = {}     # class name -> {method name: FnDecl}
+        self.superclasses = {}      # class name -> superclass name or None
+        self.class_decls = {}       # class name -> number of declarations
+        self.top_level_classes = set()
+        self.assigned_fields = set()
+        self.assigned_names = set()
+        self.method_calls = []      # (Call, receiver class, method name)
         self.current_return_type = None
         self.current_class = None
 
@@ -20,6 +38,7 @@ class TypeChecker:
         try:
             for stmt in statements:
                 self.visit(stmt)
+            self.resolve_method_calls()
             return True
         except TypeCheckError as e:
             print(f"Type Error: {e}")
@@ -30,7 +49,23 @@ class TypeChecker:
             return False
 
     def visit(self, node):
-        return node.accept(self)
+        result = node.accept(self)
+        if isinstance(node, ast_nodes.Expr):
+            node.static_type = result # Read by the loop optimizer
+        return result
+
+    def assignable(self, expected, actual, expr):
+        """Whether a value of type actual, produced by expr, may go where expected is declared."""
+        if actual == expected:
+            return True
+        if expected == "array" and element_type(actual):
+            return True
+        if element_type(expected) and isinstance(expr, ast_nodes.ArrayLiteral):
+            # A literal is typed by its declaration when every element matches exactly
+            if all(el.static_type == element_type(expected) for el in expr.elements):
+                expr.static_type = expected
+                return True
+        return False
 
     # --- Scopes ---
     def begin_scope(self):
@@ -78,10 +113,16 @@ class TypeChecker:
         for f_name, f_type in stmt.fields:
             fields[f_name.lexeme] = f_type.lexeme
         self.structs[name] = fields
+        self.struct_decls[name] = stmt
 
     def visit_class_decl(self, stmt):
         name = stmt.name.lexeme
         self.classes.add(name)
+        self.class_methods[name] = {m.name.lexeme: m for m in stmt.methods}
+        self.superclasses[name] = stmt.superclass.name.lexeme if stmt.superclass else None
+        self.class_decls[name] = self.class_decls.get(name, 0) + 1
+        if len(self.scopes) == 1:
+            self.top_level_classes.add(name)
         
         previous_class = self.current_class
         self.current_class = name
@@ -107,7 +148,7 @@ class TypeChecker:
         
         if stmt.initializer:
             init_type = self.visit(stmt.initializer)
-            if declared_type and init_type != declared_type:
+            if declared_type and not self.assignable(declared_type, init_type, stmt.initializer):
                  # Auto-casting or error? Strict for now.
                  if declared_type == "float64" and init_type == "int64": return # Allow int->float
                  raise TypeCheckError(f"Variable '{name}' expects {declared_type}, got {init_type}")
@@ -141,7 +182,7 @@ class TypeChecker:
         if stmt.value:
             val_type = self.visit(stmt.value)
         
-        if self.current_return_type and val_type != self.current_return_type:
+        if self.current_return_type and not self.assignable(self.current_return_type, val_type, stmt.value):
              raise TypeCheckError(f"Return expects {self.current_return_type}, got {val_type}")
 
     def visit_expression_stmt(self, stmt):
@@ -176,6 +217,18 @@ class TypeChecker:
         # Use base path (examples directory or current)
         base_path = "."
         module_path = os.path.join(base_path, stmt.path)
+
+        from native_lib import is_native_library, read_signatures
+        if is_native_library(module_path):
+            # Compiled with --emit so: only the exported signatures are known
+            try:
+                signatures = read_signatures(module_path)
+            except (OSError, ValueError):
+                return
+            for name, params, ret in signatures:
+                if stmt.names is None or name in [n.lexeme for n in stmt.names]:
+                    self.functions[name] = (params, ret)
+            return
         
         try:
             with open(module_path, 'r') as f:
@@ -199,13 +252,20 @@ class TypeChecker:
 
     def visit_match_expr(self, expr):
         # Type check subject and all cases
-        self.visit(expr.subject)
+        subject_type = self.visit(expr.subject)
         for case in expr.cases:
-            self.visit(case.pattern)
+            self.begin_scope()
+            if isinstance(case.pattern, ast_nodes.Variable):
+                # Identifier patterns bind the subject; `_` is a wildcard
+                if case.pattern.name.lexeme != "_":
+                    self.declare(case.pattern.name.lexeme, subject_type)
+            else:
+                self.visit(case.pattern)
             if case.guard:
                 self.visit(case.guard)
             if hasattr(case.body, 'accept'):
                 self.visit(case.body)
+            self.end_scope()
         return "any"  # Match can return any type
 
     def visit_array_literal(self, expr):
@@ -213,6 +273,12 @@ class TypeChecker:
             self.visit(el)
         return "array"
 
+    def visit_map_literal(self, expr):
+        for key, value in expr.entries:
+            self.visit(key)
+            self.visit(value)
+        return "map"
+
     def visit_await_expr(self, expr):
         # Await resolves to the inner value type
         return self.visit(expr.value)
@@ -233,9 +299,13 @@ class TypeChecker:
             if op in [TokenType.PLUS, TokenType.MINUS, TokenType.STAR, TokenType.SLASH]:
                 if left_type == "float64" or right_type == "float64": return "float64"
                 return "int64"
-            if op in [TokenType.GREATER, TokenType.LESS, TokenType.LESS_EQUAL, TokenType.GREATER_EQUAL, TokenType.EQUAL_EQUAL]:
+            if op in [TokenType.GREATER, TokenType.LESS, TokenType.LESS_EQUAL, TokenType.GREATER_EQUAL, TokenType.EQUAL_EQUAL, TokenType.BANG_EQUAL]:
                 return "bool"
         
+        # Equality between values of the same type
+        if left_type == right_type and op in [TokenType.EQUAL_EQUAL, TokenType.BANG_EQUAL]:
+            return "bool"
+        
         # String concat
         if (left_type == "string" or right_type == "string") and op == TokenType.PLUS:
             return "string"
@@ -272,15 +342,17 @@ class TypeChecker:
             return expr.name.lexeme
             
         # Check globals or stdlib?
-        if expr.name.lexeme in ["clock", "input", "read_file", "write_file", "python"]:
+        if expr.name.lexeme in ["clock", "input", "read_file", "write_file", "python", "len", "push", "pop", "insert", "extend", "slice", "copy", "keys", "values", "has"] \
+                or expr.name.lexeme in MATH:
             return "any" 
             
         raise TypeCheckError(f"Undefined variable '{expr.name.lexeme}'")
 
     def visit_assign_expr(self, expr):
+        self.assigned_names.add(expr.name.lexeme)
         var_type = self.resolve(expr.name.lexeme)
         val_type = self.visit(expr.value)
-        if var_type and val_type != var_type:
+        if var_type and not self.assignable(var_type, val_type, expr.value):
              raise TypeCheckError(f"Cannot assign {val_type} to variable of type {var_type}")
         return val_type
 
@@ -294,7 +366,7 @@ class TypeChecker:
                     raise TypeCheckError(f"Function {name} expects {len(params)} args, got {len(expr.arguments)}")
                 for i, arg in enumerate(expr.arguments):
                     t = self.visit(arg)
-                    if t != params[i] and not (params[i] == "float64" and t == "int64"):
+                    if not self.assignable(params[i], t, arg) and not (params[i] == "float64" and t == "int64"):
                          raise TypeCheckError(f"Argument {i} expected {params[i]}, got {t}")
                 return ret
             # Check Struct/Class Instantiation
@@ -314,16 +386,71 @@ class TypeChecker:
                 
                 return name
             
+            if name in MATH:
+                arg_types = [self.visit(arg) for arg in expr.arguments]
+                if len(arg_types) != MATH[name] or any(t not in ("int64", "float64", "any") for t in arg_types):
+                    raise TypeCheckError(f"{name} expects {MATH[name]} number argument(s), got {', '.join(arg_types) or 'none'}")
+                return "float64"
+
             # Stdlib
-            if name in ["print", "clock", "str", "int", "float", "input", "write_file", "read_file", "python"]:
-                for arg in expr.arguments: self.visit(arg)
+            if name in ["print", "clock", "str", "int", "float", "input", "write_file", "read_file", "python",
+                        "len", "push", "pop", "insert", "extend", "slice", "copy", "keys", "values", "has"]:
+                arg_types = [self.visit(arg) for arg in expr.arguments]
+                if name in ["push", "insert", "pop"] and arg_types and element_type(arg_types[0]):
+                    element = element_type(arg_types[0])
+                    if name != "pop" and arg_types[-1] != element:
+                        raise TypeCheckError(f"Cannot {name} {arg_types[-1]} into {arg_types[0]}")
+                    if name == "pop": return element
                 if name in ["str", "input", "read_file"]: return "string"
-                if name in ["int"]: return "int64"
+                if name in ["int", "len", "push", "insert", "extend"]: return "int64"
+                if name in ["pop"]: return "any"
+                if name in ["slice", "copy", "keys", "values"]: return "array"
+                if name in ["has"]: return "bool"
                 if name in ["float", "clock"]: return "float64"
                 return "void"
 
+        if isinstance(expr.callee, ast_nodes.Get) and isinstance(expr.callee.obj, (ast_nodes.Variable, ast_nodes.This)):
+            receiver = self.visit(expr.callee.obj)
+            for arg in expr.arguments: self.visit(arg)
+            if receiver in self.classes:
+                self.method_calls.append((expr, receiver, expr.callee.name.lexeme))
+
         return "any"
 
+    def resolve_method_calls(self):
+        """Mark calls whose target method is fixed at compile time.
+
+        The receiver's static class C (or a subclass, for `this`) must be a
+        top-level class declared once and never reassigned. The method must
+        resolve in C's superclass chain to a method that does not use `super`
+        (so it needs no upvalues), no subclass of C may override it, and no
+        field anywhere is assigned under the method's name, since fields
+        shadow methods. Sets call.devirtualized = (defining class, method).
+        """
+        def fixed(name):
+            return name in self.top_level_classes and self.class_decls.get(name) == 1 \
+                and name not in self.assigned_names
+
+        def ancestors(name):
+            seen = set()
+            while name is not None and name not in seen:
+                seen.add(name)
+                yield name
+                name = self.superclasses.get(name)
+
+        for call, receiver, method in self.method_calls:
+            if method == "init" or method in self.assigned_fields or not fixed(receiver):
+                continue
+            owner = next((c for c in ancestors(receiver) if method in self.class_methods.get(c, {})), None)
+            if owner is None or not fixed(owner):
+                continue
+            if any(isinstance(n, ast_nodes.Super) for n in walk(self.class_methods[owner][method])):
+                continue
+            overridden = any(method in methods and receiver in ancestors(self.superclasses.get(c))
+                             for c, methods in self.class_methods.items())
+            if not overridden:
+                call.devirtualized = (owner, method)
+
     def visit_get_expr(self, expr):
         obj_type = self.visit(expr.obj)
         
@@ -346,6 +473,7 @@ class TypeChecker:
         return "any"
 
     def visit_set_expr(self, expr):
+        self.assigned_fields.add(expr.name.lexeme)
         obj_type = self.visit(expr.obj)
         val_type = self.visit(expr.value)
         
@@ -375,15 +503,26 @@ class TypeChecker:
     def visit_index_get(self, expr):
         # Handle Index node that uses .target attribute
         target = getattr(expr, 'target', None) or getattr(expr, 'obj', None)
-        if target:
-            self.visit(target)
+        target_type = self.visit(target) if target else None
         self.visit(expr.index)
-        return "any" 
-
-    def visit_index_set_expr(self, expr):
-        self.visit(expr.target)
+        return element_type(target_type) or "any"
+
+    def visit_slice_expr(self, expr):
+        target_type = self.visit(expr.target)
+        for bound in (expr.start, expr.end):
+            if bound:
+                t = self.visit(bound)
+                if t not in ["int64", "any", "nil"]:
+                    raise TypeCheckError(f"Slice bounds must be int64, got {t}")
+        return "string" if target_type == "string" else "array"
+
+    def visit_index_set(self, expr):
+        target_type = self.visit(expr.obj)
         self.visit(expr.index)
-        return self.visit(expr.value)
+        val_type = self.visit(expr.value)
+        if element_type(target_type) and val_type != element_type(target_type):
+            raise TypeCheckError(f"Cannot store {val_type} in {target_type}")
+        return val_type
     
     def visit_logical_expr(self, expr):
         l = self.visit(expr.left)
@@ -1,7 +1,9 @@
-from reyna_chunk import OpCode
+from bisect import insort
+from reyna_chunk import OpCode, RangeLoop
 from token_type import TokenType
 import reyna_vals as object
 from reyna_gc import GC
+from stdlib import slice_value
 
 class InterpretResult:
     OK = 0
@@ -14,20 +16,17 @@ class CallFrame:
         self.ip = ip
         self.slots = slots
 
-class ExceptionHandler:
-    def __init__(self, catch_ip, stack_depth, frame_depth):
-        self.catch_ip = catch_ip     # IP to jump to on exception
-        self.stack_depth = stack_depth  # Stack size when try was entered
-        self.frame_depth = frame_depth  # Call frame depth when try was entered
-
 class VM:
     def __init__(self):
         self.frames = []
         self.stack = []
         self.globals = {} 
-        self.open_upvalues = [] # Linked list of open upvalues
+        self.open_upvalues = {} # Stack slot -> open ObjUpvalue
+        self.open_slots = [] # Slots with an open upvalue, kept sorted
         self.gc = GC(self) # Initialize GC
-        self.exception_handlers = []  # Stack of exception handlers
+        self.strings = {} # Interned map keys: str -> ObjString
+        self.frame_floor = 0 # run() also returns once a call brings the frame count back to this
+        self.tracer = None # Sees every taken loop back-edge (tracing.py)
         
         # Load Stdlib
         import stdlib
@@ -84,6 +83,8 @@ class VM:
                 while len(self.stack) > frame.slots:
                     self.pop()
                 self.push(result)
+                if len(self.frames) == self.frame_floor:
+                    return InterpretResult.OK
                 continue
             
             elif instruction == OpCode.OP_CONSTANT:
@@ -97,6 +98,9 @@ class VM:
             elif instruction == OpCode.OP_POP:
                 if len(self.stack) > 0: self.pop()
 
+            elif instruction == OpCode.OP_DUP:
+                self.push(self.stack[-1])
+
             elif instruction == OpCode.OP_GET_LOCAL:
                 slot = self.read_byte()
                 val = self.stack[self.frames[-1].slots + slot]
@@ -112,12 +116,56 @@ class VM:
                 offset = self.read_short()
                 if not self.is_truthy(self.peek(0)):
                     self.frames[-1].ip += offset
+            elif instruction == OpCode.OP_JUMP_IF_TRUE:
+                offset = self.read_short()
+                if self.is_truthy(self.peek(0)):
+                    self.frames[-1].ip += offset
+            elif instruction == OpCode.OP_POP_JUMP_IF_FALSE:
+                offset = self.read_short()
+                if not self.is_truthy(self.pop()):
+                    self.frames[-1].ip += offset
+            elif instruction == OpCode.OP_POP_JUMP_IF_TRUE:
+                offset = self.read_short()
+                if self.is_truthy(self.pop()):
+                    self.frames[-1].ip += offset
             elif instruction == OpCode.OP_JUMP:
                 offset = self.read_short()
                 self.frames[-1].ip += offset
             elif instruction == OpCode.OP_LOOP:
                 offset = self.read_short()
                 self.frames[-1].ip -= offset
+                if self.tracer is not None:
+                    self.tracer.backedge(self.frames[-1])
+
+            elif instruction == OpCode.OP_FOR_RANGE:
+                loop = self.read_constant()
+                frame = self.frames[-1]
+                slot = frame.slots + loop.slot
+                i = self.stack[slot] + loop.step
+                self.stack[slot] = i
+                if loop.limit_kind == RangeLoop.LIMIT_CONSTANT:
+                    limit = loop.limit
+                elif loop.limit_kind == RangeLoop.LIMIT_LOCAL:
+                    limit = self.stack[frame.slots + loop.limit]
+                elif loop.limit in self.globals:
+                    limit = self.globals[loop.limit]
+                else:
+                    print(f"Undefined variable '{loop.limit}'.")
+                    return InterpretResult.RUNTIME_ERROR
+                if loop.compare(i, limit):
+                    frame.ip = loop.body_start
+                    if self.tracer is not None:
+                        self.tracer.backedge(frame)
+
+            elif instruction == OpCode.OP_MATCH_TABLE:
+                table = self.read_constant()
+                subject = self.pop()
+                # Tables are keyed by raw int/str values
+                key = subject.value if isinstance(subject, object.ObjString) else subject
+                try:
+                    self.frames[-1].ip = table.targets.get(key, table.default)
+                except TypeError: # Unhashable subject can't equal any case
+                    self.frames[-1].ip = table.default
                 
             elif instruction == OpCode.OP_GET_GLOBAL:
                 name_idx = self.read_byte()
@@ -163,22 +211,8 @@ class VM:
                 a = self.pop()
                 if isinstance(a, (int, float)) and isinstance(b, (int, float)):
                     self.push(a + b)
-                # Handle String concat
-                elif isinstance(a, object.ObjString) or isinstance(b, object.ObjString):
-                    str_a = a.value if isinstance(a, object.ObjString) else str(a)
-                    str_b = b.value if isinstance(b, object.ObjString) else str(b)
-                    
-                    res = object.ObjString(str_a + str_b)
-                    self.gc.allocate(res)
-                    self.push(res)
-                else:
-                    # Fallback for maybe other objects?
-                    # For now just try python add
-                    try:
-                        self.push(a + b)
-                    except:
-                        print(f"Runtime Error: Cannot add {type(a)} {type(b)}")
-                        return InterpretResult.RUNTIME_ERROR
+                elif not self.add(a, b):
+                    return InterpretResult.RUNTIME_ERROR
 
             elif instruction == OpCode.OP_SUBTRACT:
                 b = self.pop()
@@ -214,32 +248,14 @@ class VM:
             elif instruction == OpCode.OP_GET_FIELD:
                 name_idx = self.read_byte()
                 name = self.frames[-1].closure.function.chunk.constants[name_idx]
-                obj = self.pop()
-                if isinstance(obj, object.ObjInstance):
-                    if name in obj.fields:
-                         self.push(obj.fields[name])
-                    elif isinstance(obj.struct, object.ObjClass) and name in obj.struct.methods:
-                         method = obj.struct.methods[name]
-                         bound = object.ObjBoundMethod(obj, method)
-                         self.gc.allocate(bound)
-                         self.push(bound)
-                    else:
-                        print(f"Undefined property '{name}'.")
-                        return InterpretResult.RUNTIME_ERROR
-                else:
-                    print(f"Only instances have properties. Got {obj}.")
+                if not self.get_field(self.pop(), name):
                     return InterpretResult.RUNTIME_ERROR
 
             elif instruction == OpCode.OP_SET_FIELD:
                 name_idx = self.read_byte()
                 name = self.frames[-1].closure.function.chunk.constants[name_idx]
                 val = self.pop()
-                obj = self.pop()
-                if isinstance(obj, object.ObjInstance):
-                    obj.fields[name] = val
-                    self.push(val)
-                else:
-                    print("Only instances have properties.")
+                if not self.set_field(self.pop(), name, val):
                     return InterpretResult.RUNTIME_ERROR
             
             elif instruction == OpCode.OP_CALL:
@@ -248,6 +264,15 @@ class VM:
                 if not self.call_value(callee, arg_count):
                     return InterpretResult.RUNTIME_ERROR
 
+            elif instruction == OpCode.OP_INVOKE_DIRECT:
+                closure = self.read_constant()
+                arg_count = self.read_byte()
+                if not isinstance(self.stack[-arg_count - 1], object.ObjInstance):
+                    print(f"Only instances have methods. Got {self.stack[-arg_count - 1]}.")
+                    return InterpretResult.RUNTIME_ERROR
+                if not self.call(closure, arg_count):
+                    return InterpretResult.RUNTIME_ERROR
+
             elif instruction == OpCode.OP_CLASS:
                 name_idx = self.read_byte()
                 name = self.frames[-1].closure.function.chunk.constants[name_idx]
@@ -279,25 +304,50 @@ class VM:
                 arr = object.ObjArray(elements)
                 self.gc.allocate(arr)
                 self.push(arr)
+
+            elif instruction == OpCode.OP_BUILD_MAP:
+                count = self.read_byte()
+                base = len(self.stack) - 2 * count
+                entries = {}
+                for i in range(base, len(self.stack), 2):
+                    entries[self.intern(self.stack[i])] = self.stack[i + 1]
+                del self.stack[base:]
+                map_obj = object.ObjMap(entries)
+                self.gc.allocate(map_obj)
+                self.push(map_obj)
             
-            elif instruction == OpCode.OP_GET_INDEX:
-                index = self.pop()
-                arr = self.pop()
-                if isinstance(arr, object.ObjArray):
-                    if isinstance(index, (int, float)):
-                        idx = int(index)
-                        if 0 <= idx < len(arr.elements):
-                            self.push(arr.elements[idx])
-                        else:
-                            print(f"Index {idx} out of bounds for array of length {len(arr.elements)}.")
-                            return InterpretResult.RUNTIME_ERROR
+            elif instruction == OpCode.OP_GET_INDEX or instruction == OpCode.OP_GET_INDEX_UNCHECKED:
+                if instruction == OpCode.OP_GET_INDEX_UNCHECKED and type(self.stack[-2]) is object.ObjArray:
+                    # The index is a non-negative int by construction. If the
+                    # array shrank inside the loop, fall through to the checked
+                    # path below so the usual error is reported.
+                    try:
+                        value = self.stack[-2].elements[self.stack[-1]]
+                    except IndexError:
+                        pass
                     else:
-                        print(f"Array index must be a number, got {type(index).__name__}.")
-                        return InterpretResult.RUNTIME_ERROR
-                else:
-                    print(f"Can only index arrays, got {type(arr).__name__}.")
+                        del self.stack[-1]
+                        self.stack[-1] = value
+                        continue
+                index = self.pop()
+                if not self.get_index(self.pop(), index):
                     return InterpretResult.RUNTIME_ERROR
-            
+
+            elif instruction == OpCode.OP_SET_INDEX:
+                val = self.pop()
+                index = self.pop()
+                if not self.set_index(self.pop(), index, val):
+                    return InterpretResult.RUNTIME_ERROR
+
+            elif instruction == OpCode.OP_SLICE:
+                end = self.pop()
+                start = self.pop()
+                target = self.pop()
+                result = slice_value(target, start, end)
+                if result is None: return InterpretResult.RUNTIME_ERROR
+                self.gc.allocate(result)
+                self.push(result)
+
 
             elif instruction == OpCode.OP_CLOSURE:
                 fn = self.read_constant()
@@ -305,13 +355,14 @@ class VM:
                 self.gc.allocate(closure)
                 self.push(closure)
                 
-                for i in range(fn.upvalue_count):
-                    is_local = self.read_byte()
-                    index = self.read_byte()
-                    if is_local:
-                         closure.upvalues.append(self.capture_upvalue(self.frames[-1].slots + index))
+                frame = self.frames[-1]
+                for is_local, index, direct in fn.upvalue_descriptors:
+                    if not is_local:
+                        closure.upvalues.append(frame.closure.upvalues[index])
+                    elif direct:
+                        closure.upvalues.append(frame.slots + index)
                     else:
-                         closure.upvalues.append(self.frames[-1].closure.upvalues[index]) 
+                        closure.upvalues.append(self.capture_upvalue(frame.slots + index))
 
             elif instruction == OpCode.OP_INHERIT:
                 superclass = self.peek(0)
@@ -363,63 +414,195 @@ class VM:
                 else:
                      upvalue.closed = val
             
+            elif instruction == OpCode.OP_GET_UPVALUE_DIRECT:
+                slot = self.read_byte()
+                self.push(self.stack[self.frames[-1].closure.upvalues[slot]])
+
+            elif instruction == OpCode.OP_SET_UPVALUE_DIRECT:
+                slot = self.read_byte()
+                self.stack[self.frames[-1].closure.upvalues[slot]] = self.peek(0)
+
             elif instruction == OpCode.OP_CLOSE_UPVALUE:
                 self.close_upvalues(len(self.stack) - 1)
                 self.pop()
 
-            elif instruction == OpCode.OP_TRY_BEGIN:
-                # Read offset to catch block
-                catch_offset = self.read_short()
-                catch_ip = self.frames[-1].ip + catch_offset - 2  # Adjust for already read bytes
-                handler = ExceptionHandler(catch_ip, len(self.stack), len(self.frames))
-                self.exception_handlers.append(handler)
-
-            elif instruction == OpCode.OP_TRY_END:
-                # Successfully completed try block, pop handler
-                if self.exception_handlers:
-                    self.exception_handlers.pop()
-
             elif instruction == OpCode.OP_THROW:
                 exception = self.pop()
-                if not self.exception_handlers:
-                    # No handler, runtime error
-                    print(f"Uncaught exception: {exception}")
-                    return InterpretResult.RUNTIME_ERROR
-                
-                # Find handler and unwind
-                handler = self.exception_handlers.pop()
-                
-                # Unwind call stack
-                while len(self.frames) > handler.frame_depth:
-                    self.frames.pop()
-                
-                # Unwind value stack
-                while len(self.stack) > handler.stack_depth:
-                    self.pop()
-                
-                # Push exception value for catch variable
-                self.push(exception)
-                
-                # Jump to catch block
-                self.frames[-1].ip = handler.catch_ip
+                if not self.throw(exception):
+                    return self.uncaught(exception)
+
+    def throw(self, exception):
+        """Unwind to the innermost handler covering the current IP.
+
+        Searches each frame's exception table, discarding frames that have no
+        matching entry. Returns False if the exception escapes every frame this
+        run() owns (all of them unless a register function started it).
+        """
+        while len(self.frames) > self.frame_floor:
+            frame = self.frames[-1]
+            # ip has moved past the throwing instruction (or the call operand)
+            ip = frame.ip - 1
+            for entry in frame.closure.function.chunk.exception_table:
+                if entry.start <= ip < entry.end:
+                    depth = frame.slots + entry.stack_depth
+                    self.close_upvalues(depth)
+                    del self.stack[depth:]
+                    self.push(exception) # Becomes the catch variable
+                    frame.ip = entry.handler
+                    return True
+            self.close_upvalues(frame.slots)
+            self.frames.pop()
+        return False
+
+    def uncaught(self, exception):
+        print(f"Uncaught exception: {exception}")
+        return InterpretResult.RUNTIME_ERROR
+
+    def intern(self, key):
+        """Canonicalize string keys so equal strings share one ObjString."""
+        if isinstance(key, object.ObjString):
+            return self.strings.setdefault(key.value, key)
+        return key
+
+    def view_index(self, view, index):
+        """Translate an index into a view to an index into its buffer, or None."""
+        if not isinstance(index, (int, float)):
+            print(f"Array index must be a number, got {type(index).__name__}.")
+            return None
+        idx = int(index)
+        if not 0 <= idx < view.length:
+            print(f"Index {idx} out of bounds for view of length {view.length}.")
+            return None
+        if view.start + idx >= len(view.array.elements):
+            print(f"Index {idx} is past the end of the view's array (it was shrunk).")
+            return None
+        return view.start + idx
 
     def capture_upvalue(self, local_idx):
-        for up in self.open_upvalues:
-            if up.location == local_idx: return up
-        created = object.ObjUpvalue(local_idx)
-        self.open_upvalues.append(created)
-        return created
+        up = self.open_upvalues.get(local_idx)
+        if up is None:
+            up = object.ObjUpvalue(local_idx)
+            self.open_upvalues[local_idx] = up
+            insort(self.open_slots, local_idx)
+        return up
 
     def close_upvalues(self, last):
-        i = 0
-        while i < len(self.open_upvalues):
-            up = self.open_upvalues[i]
-            if up.location >= last:
-                up.closed = self.stack[up.location]
-                up.location = None
-                self.open_upvalues.pop(i)
+        # Open slots are sorted, so everything at or above `last` is a suffix
+        slots = self.open_slots
+        while slots and slots[-1] >= last:
+            up = self.open_upvalues.pop(slots.pop())
+            up.closed = self.stack[up.location]
+            up.location = None
+
+    # Operations shared with the register VM. Like call_value, each pushes
+    # its result and returns False after reporting a runtime error.
+
+    def add(self, a, b):
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+            self.push(a + b)
+        # Handle String concat
+        elif isinstance(a, object.ObjString) or isinstance(b, object.ObjString):
+            str_a = a.value if isinstance(a, object.ObjString) else str(a)
+            str_b = b.value if isinstance(b, object.ObjString) else str(b)
+            
+            res = object.ObjString(str_a + str_b)
+            self.gc.allocate(res)
+            self.push(res)
+        else:
+            # Fallback for maybe other objects?
+            # For now just try python add
+            try:
+                self.push(a + b)
+            except:
+                print(f"Runtime Error: Cannot add {type(a)} {type(b)}")
+                return False
+        return True
+
+    def get_field(self, obj, name):
+        if isinstance(obj, object.ObjInstance):
+            if name in obj.fields:
+                 self.push(obj.fields[name])
+            elif isinstance(obj.struct, object.ObjClass) and name in obj.struct.methods:
+                 method = obj.struct.methods[name]
+                 bound = object.ObjBoundMethod(obj, method)
+                 self.gc.allocate(bound)
+                 self.push(bound)
+            else:
+                print(f"Undefined property '{name}'.")
+                return False
+        else:
+            print(f"Only instances have properties. Got {obj}.")
+            return False
+        return True
+
+    def set_field(self, obj, name, val):
+        if isinstance(obj, object.ObjInstance):
+            obj.fields[name] = val
+            self.push(val)
+            return True
+        print("Only instances have properties.")
+        return False
+
+    def get_index(self, arr, index):
+        if isinstance(arr, object.ObjArray):
+            if isinstance(index, (int, float)):
+                idx = int(index)
+                if 0 <= idx < len(arr.elements):
+                    self.push(arr.elements[idx])
+                else:
+                    print(f"Index {idx} out of bounds for array of length {len(arr.elements)}.")
+                    return False
             else:
-                 i += 1
+                print(f"Array index must be a number, got {type(index).__name__}.")
+                return False
+        elif isinstance(arr, object.ObjArrayView):
+            idx = self.view_index(arr, index)
+            if idx is None: return False
+            self.push(arr.array.elements[idx])
+        elif isinstance(arr, object.ObjMap):
+            key = self.intern(index)
+            if key in arr.entries:
+                self.push(arr.entries[key])
+            else:
+                print(f"Key {key!r} not found in map.")
+                return False
+        else:
+            print(f"Can only index arrays, got {type(arr).__name__}.")
+            return False
+        return True
+
+    def set_index(self, arr, index, val):
+        if isinstance(arr, object.ObjArray):
+            if isinstance(index, (int, float)):
+                idx = int(index)
+                if 0 <= idx < len(arr.elements):
+                    # Mutate in place; assignment evaluates to the value
+                    arr.writable((val,))[idx] = val
+                    self.push(val)
+                else:
+                    print(f"Index {idx} out of bounds for array of length {len(arr.elements)}.")
+                    return False
+            else:
+                print(f"Array index must be a number, got {type(index).__name__}.")
+                return False
+        elif isinstance(arr, object.ObjArrayView):
+            idx = self.view_index(arr, index)
+            if idx is None: return False
+            if not arr.owns_buffer:
+                # Copy-on-write: detach the window from the parent
+                private = object.ObjArray(arr.window())
+                self.gc.allocate(private)
+                idx -= arr.start
+                arr.array, arr.start, arr.owns_buffer = private, 0, True
+            arr.array.writable((val,))[idx] = val
+            self.push(val)
+        elif isinstance(arr, object.ObjMap):
+            arr.entries[self.intern(index)] = val
+            self.push(val)
+        else:
+            print(f"Can only index arrays, got {type(arr).__name__}.")
+            return False
+        return True
 
     def call_value(self, callee, arg_count):
         if isinstance(callee, object.ObjBoundMethod):
@@ -458,9 +641,11 @@ class VM:
             self.stack[-1] = instance
             return True
         elif isinstance(callee, object.ObjNative):
-            args = self.stack[-arg_count:]
+            base = len(self.stack) - arg_count
+            args = self.stack[base:]
             result = callee.fn(args)
-            self.stack = self.stack[:-arg_count-1]
+            # Drop callee and args in place rather than rebuilding the stack
+            del self.stack[base - 1:]
             self.push(result)
             return True
         else:
@@ -0,0 +1,68 @@
+import os
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+sys.path.insert(0, str(ROOT / "src"))
+
+try:
+    import llvmlite # noqa: F401
+except ImportError:
+    llvmlite = None
+
+import main
+
+class JITSessionTest(unittest.TestCase):
+    """REPL lines in --mode jit, each linked as a library of its own."""
+
+    def setUp(self):
+        self.session = {}
+
+    def run_line(self, line):
+        # Native code prints through C's stdout, so capture file descriptor 1
+        sys.stdout.flush()
+        saved = os.dup(1)
+        with tempfile.TemporaryFile() as out:
+            os.dup2(out.fileno(), 1)
+            try:
+                main.run(line, "jit", session=self.session)
+                sys.stdout.flush()
+            finally:
+                os.dup2(saved, 1)
+                os.close(saved)
+            out.seek(0)
+            return out.read().decode().splitlines()
+
+    def libraries(self):
+        return set(self.session["jit"].sessions)
+
+    def library_of(self, name):
+        return self.session["jit"].definitions[name][1]
+
+    @unittest.skipIf(llvmlite is None, "llvmlite is not installed")
+    def test_redefinition_frees_unused_library(self):
+        self.run_line("fn f() -> int64 { return 1; }")
+        old = self.library_of("f")
+        self.assertEqual(self.run_line("print f();"), ["1"])
+        self.assertEqual(self.libraries(), {old}) # The print line's library is gone
+        self.run_line("fn f() -> int64 { return 2; }")
+        self.assertNotIn(old, self.libraries())
+        self.assertEqual(self.run_line("print f();"), ["2"])
+
+    @unittest.skipIf(llvmlite is None, "llvmlite is not installed")
+    def test_redefinition_keeps_library_still_called(self):
+        self.run_line("fn f() -> int64 { return 1; }")
+        old = self.library_of("f")
+        self.run_line("fn g() -> int64 { return f() + 10; }")
+        self.run_line("fn f() -> int64 { return 2; }")
+        self.assertIn(old, self.libraries()) # g was compiled against the old f
+        self.assertEqual(self.run_line("print g();"), ["11"])
+        self.run_line("fn g() -> int64 { return f() + 20; }")
+        self.assertNotIn(old, self.libraries())
+        self.assertEqual(self.run_line("print g();"), ["22"])
+
+if __name__ == "__main__":
+    unittest.main()
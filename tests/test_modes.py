@@ -0,0 +1,99 @@
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+EXAMPLES = sorted((ROOT / "examples").glob("*.reyna"))
+TIME = re.compile(r"^-?\d+\.\d+(e[-+]?\d+)?$") # A printed clock() reading
+
+def run(path, mode):
+    result = subprocess.run([sys.executable, str(ROOT / "main.py"), "--mode", mode, str(path)],
+                            cwd=ROOT, stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=120)
+    lines = (result.stdout + result.stderr).splitlines()
+    if "clock()" in path.read_text():
+        lines = ["<time>" if TIME.match(line) else line for line in lines]
+    return lines
+
+def run_source(source, mode):
+    with tempfile.TemporaryDirectory() as temp:
+        path = Path(temp) / "program.reyna"
+        path.write_text(source)
+        return run(path, mode)
+
+DEEP = """
+fn depth(n: int64) -> int64 {
+    if (n == 0) { return 0; }
+    return 1 + depth(n - 1);
+}
+print depth(20000);
+"""
+
+class RegisterVMTest(unittest.TestCase):
+    """Every example prints the same under the register VM as under the stack VM."""
+
+    def test_examples(self):
+        for path in EXAMPLES:
+            with self.subTest(example=path.name):
+                self.assertEqual(run(path, "regvm"), run(path, "vm"))
+
+    def test_deep_recursion(self):
+        # Register calls nest Python calls; running out of them is a Reyna error
+        self.assertEqual(run_source(DEEP, "vm"), ["20000"])
+        for mode in ("regvm", "pyvm"):
+            with self.subTest(mode=mode):
+                self.assertEqual(run_source(DEEP, mode), ["Stack overflow."])
+
+PACKED_SLICE = """
+fn total(xs: int64[]) -> int64 {
+    let s = 0;
+    let i = 0;
+    while (i < len(xs)) { s = s + xs[i]; i = i + 1; }
+    return s;
+}
+let arr: int64[] = [1, 2, 3, 4];
+let k = 0;
+while (k < 1100) { total(arr); k = k + 1; }
+print arr[1:3];
+print "view " + arr[1:3];
+"""
+
+OVERFLOW = """
+fn fact(n: int64) -> int64 {
+    if (n <= 1) { return 1; }
+    return n * fact(n - 1);
+}
+let i = 0;
+while (i < 1001) { fact(20); i = i + 1; }
+print fact(25);
+print fact(20);
+"""
+
+INT_AS_FLOAT = """
+fn id(x: float64) -> float64 { return x; }
+let i = 0;
+while (i < 1001) { id(1.5); i = i + 1; }
+print id(3);
+print id(2.5);
+"""
+
+class TieredVMTest(unittest.TestCase):
+    """Native code called from the tiered VM leaves the program's output unchanged."""
+
+    def assertSameAsVM(self, source):
+        self.assertEqual(run_source(source, "tiered"), run_source(source, "vm"))
+
+    def test_int64_overflow(self):
+        self.assertSameAsVM(OVERFLOW)
+
+    def test_int_argument_for_float64(self):
+        self.assertSameAsVM(INT_AS_FLOAT)
+
+    def test_slice_of_packed_array(self):
+        # Calling total natively packs arr into an array.array buffer
+        self.assertSameAsVM(PACKED_SLICE)
+
+if __name__ == "__main__":
+    unittest.main()